@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+"""
+Response compression benchmark.
+
+Compresses typical payloads (a products page, a merchants page and an NDJSON export
+of `--rows` rows) with every available encoder at a few levels, `--repeat` times, and
+reports the compressed size, the CPU time per response and the bytes saved per CPU
+millisecond. Streamed payloads are also compressed the way the app sends them, one
+flushed block per chunk, to show what incremental delivery costs in ratio.
+
+    $ python -m benchmarks.compression --rows 500 --repeat 20
+"""
+import argparse
+
+from marketplace import create_app
+from marketplace.http.compression import GzipEncoder, ZstdEncoder, zstandard
+from marketplace.http.serializer import compiled
+
+from benchmarks.serializer import make_rows, timed
+
+LEVELS = {'gzip': (1, 6, 9), 'zstd': (1, 3, 9)}
+
+
+def make_payloads(rows, batch):
+    from marketplace.merchant.v1.serializers import merchants_schema
+    from marketplace.product.v1.serializers import products_schema
+    products, merchants = compiled(products_schema), compiled(merchants_schema)
+    lines = [products.dumps(item).encode('utf-8') + b'\n' for item in rows['products']]
+    return {
+        'products': products.dumps_many(rows['products']).encode('utf-8'),
+        'merchants': merchants.dumps_many(rows['merchants']).encode('utf-8'),
+        # Chunked like `stream_ndjson`, one chunk per batch of rows
+        'ndjson': [b''.join(lines[i:i + batch]) for i in range(0, len(lines), batch)],
+    }
+
+
+def streamed(encoder, chunks):
+    compress, flush, finish = encoder.stream()
+    return sum(len(compress(chunk) + flush()) for chunk in chunks) + len(finish())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--config', default='test')
+    parser.add_argument('--rows', type=int, default=500)
+    parser.add_argument('--batch', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    create_app(args.config)
+    payloads = make_payloads(make_rows(args.rows), args.batch)
+    encoders = [GzipEncoder(level) for level in LEVELS['gzip']]
+    if zstandard is not None:
+        encoders += [ZstdEncoder(level) for level in LEVELS['zstd']]
+    else:
+        print('zstandard is not installed, gzip only\n')
+
+    print('{:<16} {:<8} {:>10} {:>10} {:>7} {:>9} {:>9} {:>12}'.format(
+        'payload', 'encoder', 'bytes', 'encoded', 'ratio', 'cpu ms', 'MB/s', 'saved KB/ms'))
+    for name, payload in payloads.items():
+        chunked = isinstance(payload, list)
+        size = sum(map(len, payload)) if chunked else len(payload)
+        for encoder in encoders:
+            label = '{}-{}'.format(encoder.name, encoder.level)
+            modes = [('', lambda: len(encoder.compress(b''.join(payload) if chunked
+                                                       else payload)))]
+            if chunked:
+                modes.append((' (stream)', lambda: streamed(encoder, payload)))
+            for mode, run in modes:
+                encoded = run()
+                cpu = timed(run, args.repeat)
+                print('{:<16} {:<8} {:>10} {:>10} {:>6.1f}x {:>9.2f} {:>9.0f} {:>12.1f}'.format(
+                    name + mode, label, size, encoded, size / encoded, cpu * 1000,
+                    size / cpu / 1e6, (size - encoded) / 1024 / (cpu * 1000)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+"""
+Endpoint benchmark suite.
+
+Builds the app with `create_app(--config)` against its (local Postgres) database, seeds
+a catalog of each `--sizes` product count (topping up the rows left by a previous run),
+then fires `--requests` requests per scenario from `--concurrency` threads and records
+throughput and p50/p95/p99 latency. Results are written to `--output` as JSON; with
+`--compare` the run is checked against an earlier results file and the command exits
+with status 1 when a scenario regressed past `--threshold`.
+
+    $ python -m benchmarks.endpoints --sizes 1k,100k,1m --output bench.json
+    $ python -m benchmarks.endpoints --sizes 1k --compare bench.json --threshold 0.15
+"""
+import argparse
+import json
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from sqlalchemy import func, insert
+
+from benchmarks.login_throughput import percentile
+from marketplace import create_app, db
+from marketplace.auth.utils import generate_token
+from marketplace.persistence.model import (Merchant, ProductCategory, ProductItem,
+                                           ProductStatus, User)
+
+USERNAME = 'bench_user'
+PASSWORD = 'this15secret'
+SKU_PREFIX = 'BENCH-'
+CATEGORY_COUNT = 20
+SEED_BATCH = 5000
+
+ADJECTIVES = ('red', 'blue', 'organic', 'vintage', 'compact', 'wireless', 'leather',
+              'wooden', 'steel', 'classic', 'premium', 'portable')
+NOUNS = ('chair', 'lamp', 'phone', 'jacket', 'kettle', 'backpack', 'speaker', 'watch',
+         'bottle', 'keyboard', 'sofa', 'camera', 'blender', 'sneaker', 'guitar')
+
+SIZES = {'1k': 1000, '10k': 10000, '100k': 100000, '1m': 1000000}
+
+# Metrics that can be compared against a baseline, and whether higher is better
+HIGHER_IS_BETTER = {'rps': True, 'p50_ms': False, 'p95_ms': False, 'p99_ms': False}
+
+
+def parse_size(value):
+    value = value.strip().lower()
+    return SIZES[value] if value in SIZES else int(value)
+
+
+# Seeding
+
+def seed(app, size, seed_value):
+    """
+    Make sure `size` benchmark products (and their user/categories) exist. Row `i` only
+    depends on `seed_value` and `i`, so topping up gives the same catalog as seeding
+    from scratch.
+    """
+    with app.app_context():
+        db.create_all()
+        user = User.query.filter_by(username=USERNAME).first()
+        if user is None:
+            user = User(username=USERNAME)
+            user.password = PASSWORD
+            user.save()
+
+        categories = [row.id for row in ProductCategory.query
+                      .filter(ProductCategory.name.like('bench %'))
+                      .order_by(ProductCategory.name)]
+        for i in range(len(categories), CATEGORY_COUNT):
+            category = ProductCategory(name='bench {:02d}'.format(i))
+            db.session.add(category)
+            db.session.flush()
+            categories.append(category.id)
+        db.session.commit()
+
+        existing = db.session.query(func.count(ProductItem.id)).filter(
+            ProductItem.sku.like(SKU_PREFIX + '%')).scalar()
+        started = time.perf_counter()
+        for offset in range(existing, size, SEED_BATCH):
+            rows = [product_row(i, categories, seed_value)
+                    for i in range(offset, min(size, offset + SEED_BATCH))]
+            db.session.execute(insert(ProductItem.__table__), rows)
+            db.session.commit()
+        if size > existing:
+            print('seeded {} products in {:.1f}s'.format(
+                size - existing, time.perf_counter() - started), file=sys.stderr)
+        return user.id, categories
+
+
+def product_row(i, categories, seed_value):
+    rng = random.Random(seed_value * 1000000007 + i)
+    created = datetime(2024, 1, 1) + timedelta(seconds=i)
+    adjective, noun = rng.choice(ADJECTIVES), rng.choice(NOUNS)
+    return {
+        'id': uuid.UUID(int=rng.getrandbits(128), version=4),
+        'seller_id': uuid.UUID(int=rng.getrandbits(128), version=4),
+        'category_id': categories[i % len(categories)],
+        'name': '{} {} {}'.format(adjective, noun, i).title(),
+        'description': 'A {} {} for every day use'.format(adjective, noun),
+        'price': Decimal(rng.randint(100, 500000)) / 100,
+        'currency': 'USD',
+        'stock_quantity': rng.randint(0, 100),
+        'status': ProductStatus.ACTIVE,
+        'images': [],
+        'tags': [adjective, noun],
+        'sku': '{}{:08d}'.format(SKU_PREFIX, i),
+        'attributes': {},
+        'created_at': created,
+        'updated_at': created,
+    }
+
+
+# Scenarios, each a function(client, context, i) -> response
+
+def health(client, context, i):
+    return client.get('/health/ping')
+
+
+def login(client, context, i):
+    return client.post('/user/auth/login', json={'username': USERNAME, 'password': PASSWORD})
+
+
+def product_list(client, context, i):
+    category = context['categories'][i % len(context['categories'])]
+    return client.get('/product/items/?limit=50&category_id={}'.format(category))
+
+
+def product_search(client, context, i):
+    return client.get('/product/items/search?limit=20&q={}'.format(NOUNS[i % len(NOUNS)]))
+
+
+def product_create(client, context, i):
+    return client.post('/product/items/', headers=context['headers'], json={
+        'seller_id': str(uuid.uuid4()),
+        'category_id': str(context['categories'][i % len(context['categories'])]),
+        'name': 'Bench created {}'.format(i),
+        'price': 9.99,
+        'currency': 'USD',
+    })
+
+
+def merchant_create(client, context, i):
+    return client.post('/merchant/', headers=context['headers'], json={
+        'name': 'bench merchant {}'.format(uuid.uuid4().hex), 'city': 'Jakarta'})
+
+
+def merchant_get(client, context, i):
+    return client.get('/merchant/{}'.format(context['merchants'][i % len(context['merchants'])]))
+
+
+def merchant_update(client, context, i):
+    merchant_id = context['merchants'][i % len(context['merchants'])]
+    return client.put('/merchant/{}'.format(merchant_id), headers=context['headers'],
+                      json={'city': 'City {}'.format(i)})
+
+
+def merchant_delete(client, context, i):
+    return client.delete('/merchant/{}'.format(context['doomed'].pop()),
+                         headers=context['headers'])
+
+
+SCENARIOS = {
+    'health': health,
+    'login': login,
+    'product_list': product_list,
+    'product_search': product_search,
+    'product_create': product_create,
+    'merchant_create': merchant_create,
+    'merchant_get': merchant_get,
+    'merchant_update': merchant_update,
+    'merchant_delete': merchant_delete,
+}
+
+
+def make_merchants(app, owner_id, count):
+    with app.app_context():
+        merchants = [Merchant(name='bench merchant {}'.format(uuid.uuid4().hex),
+                              city='Jakarta', owner_id=owner_id) for _ in range(count)]
+        db.session.add_all(merchants)
+        db.session.commit()
+        return [merchant.id for merchant in merchants]
+
+
+def measure(app, scenario, context, requests, concurrency):
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def call(i):
+        client = app.test_client()
+        start = time.perf_counter()
+        response = scenario(client, context, i)
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            if response.status_code >= 400:
+                errors.append(response.status_code)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(call, range(requests)))
+    elapsed = time.perf_counter() - started
+
+    return {
+        'requests': requests,
+        'errors': len(errors),
+        'rps': requests / elapsed,
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p95_ms': percentile(latencies, 95) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+    }
+
+
+def run(app, sizes, scenarios, requests, concurrency, seed_value):
+    results = {}
+    for size in sizes:
+        user_id, categories = seed(app, size, seed_value)
+        with app.app_context():
+            token = generate_token(user_id)
+        context = {
+            'categories': categories,
+            'headers': {'Authorization': 'Bearer {}'.format(token)},
+            'merchants': make_merchants(app, user_id, 100),
+            'doomed': make_merchants(app, user_id, requests),
+        }
+
+        results[str(size)] = {}
+        for name in scenarios:
+            if name != 'merchant_delete':
+                # One untimed request first, so lazy per-worker caches are warm
+                SCENARIOS[name](app.test_client(), context, 0)
+            result = measure(app, SCENARIOS[name], context, requests, concurrency)
+            results[str(size)][name] = result
+            print('{:>8} {:<16} {:>9.1f} rps  p50 {:>7.2f}  p95 {:>7.2f}  p99 {:>7.2f} ms'
+                  '  errors {}'.format(size, name, result['rps'], result['p50_ms'],
+                                       result['p95_ms'], result['p99_ms'], result['errors']))
+    return results
+
+
+# Comparison
+
+def compare(baseline, current, threshold, gated=('rps', 'p95_ms')):
+    """Human readable regressions of `current` against `baseline` past `threshold`"""
+    regressions = []
+    for size, scenarios in current['results'].items():
+        for name, result in scenarios.items():
+            before = baseline['results'].get(size, {}).get(name)
+            if before is None:
+                continue
+            for metric in gated:
+                higher_is_better = HIGHER_IS_BETTER[metric]
+                old, new = before[metric], result[metric]
+                if not old:
+                    continue
+                change = (new - old) / old
+                worse = -change if higher_is_better else change
+                if worse > threshold:
+                    regressions.append('{} {} {}: {:.2f} -> {:.2f} ({:+.0%})'.format(
+                        size, name, metric, old, new, change))
+    return regressions
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--config', default='test')
+    parser.add_argument('--sizes', default='1k', help='e.g. 1k,100k,1m')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=42, help='dataset random seed')
+    parser.add_argument('--response-cache', action='store_true',
+                        help='keep the response cache on (off by default so reads hit the DB)')
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--compare', help='baseline results JSON file')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='allowed relative regression, 0.10 = 10%%')
+    parser.add_argument('--gate', default='rps,p95_ms',
+                        help='metrics checked by --compare: {}'.format(','.join(HIGHER_IS_BETTER)))
+    args = parser.parse_args()
+
+    scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error('unknown scenarios: {}'.format(', '.join(sorted(unknown))))
+    unknown = {metric.strip() for metric in args.gate.split(',')} - set(HIGHER_IS_BETTER) - {''}
+    if unknown:
+        parser.error('unknown --gate metrics: {}'.format(', '.join(sorted(unknown))))
+
+    app = create_app(args.config)
+    if not args.response_cache:
+        app.config['RESPONSE_CACHE_URL'] = 'null://'
+        from marketplace.http.cache import response_cache
+        response_cache.init_app(app)
+
+    sizes = [parse_size(size) for size in args.sizes.split(',')]
+    current = {
+        'meta': {
+            'revision': git_revision(),
+            'started_at': datetime.utcnow().isoformat(),
+            'config': args.config,
+            'python': platform.python_version(),
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'seed': args.seed,
+        },
+        'results': run(app, sorted(sizes), scenarios, args.requests, args.concurrency,
+                       args.seed),
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(current, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        gated = [metric.strip() for metric in args.gate.split(',') if metric.strip()]
+        regressions = compare(baseline, current, args.threshold, gated)
+        for regression in regressions:
+            print('REGRESSION', regression)
+        if regressions:
+            sys.exit(1)
+        print('no regressions past {:.0%} against {}'.format(args.threshold, args.compare))
+
+
+if __name__ == '__main__':
+    main()
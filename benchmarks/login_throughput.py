@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""
+Login throughput benchmark.
+
+Fires `--requests` logins from `--concurrency` threads at `/user/auth/login` while a
+background thread keeps pinging `/health/ping`, and reports login throughput plus the
+health check latency, i.e. how much a login burst starves the other endpoints.
+
+    $ python -m benchmarks.login_throughput --config test --rounds 12 --bcrypt-concurrency 2
+"""
+import argparse
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from marketplace import create_app, db
+from marketplace.persistence.model import User
+
+USERNAME = 'bench_login_user'
+PASSWORD = 'this15secret'
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def ensure_user(app):
+    with app.app_context():
+        db.create_all()
+        user = User.query.filter_by(username=USERNAME).first() or User(username=USERNAME)
+        user.password = PASSWORD
+        user.save()
+
+
+def run(app, requests, concurrency):
+    payload = {'username': USERNAME, 'password': PASSWORD}
+    login_latencies = []
+    health_latencies = []
+    done = threading.Event()
+
+    def login(_):
+        client = app.test_client()
+        start = time.perf_counter()
+        response = client.post('/user/auth/login', json=payload)
+        login_latencies.append(time.perf_counter() - start)
+        assert response.status_code == 200, response.data
+
+    def ping():
+        client = app.test_client()
+        while not done.is_set():
+            start = time.perf_counter()
+            client.get('/health/ping')
+            health_latencies.append(time.perf_counter() - start)
+
+    pinger = threading.Thread(target=ping, daemon=True)
+    pinger.start()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(login, range(requests)))
+    elapsed = time.perf_counter() - started
+    done.set()
+    pinger.join()
+
+    return {
+        'logins_per_second': requests / elapsed,
+        'login_p50_ms': statistics.median(login_latencies) * 1000,
+        'login_p99_ms': percentile(login_latencies, 99) * 1000,
+        'health_p50_ms': statistics.median(health_latencies) * 1000,
+        'health_p99_ms': percentile(health_latencies, 99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--config', default='test')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--rounds', type=int, default=12, help='bcrypt work factor')
+    parser.add_argument('--bcrypt-concurrency', type=int, default=2,
+                        help='bcrypt hashes at once per worker')
+    args = parser.parse_args()
+
+    app = create_app(args.config)
+    app.config['BCRYPT_LOG_ROUNDS'] = args.rounds
+    app.config['BCRYPT_CONCURRENCY'] = args.bcrypt_concurrency
+    from marketplace.auth.hashing import password_hasher
+    password_hasher.init_app(app)
+
+    ensure_user(app)
+    result = run(app, args.requests, args.concurrency)
+    for name, value in result.items():
+        print('{:<20} {:>10.2f}'.format(name, value))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""
+Rate limiter benchmark.
+
+Times `--decisions` rate limit decisions per storage, both the bare bucket update and
+the whole per-request check (principal, key hash, every limit of the route), then forks
+`--workers` processes that all hit one bucket of `--limit` requests per day and checks
+that exactly `--limit` of their requests were let through in total.
+
+    $ python -m benchmarks.rate_limit --decisions 100000 --workers 4
+"""
+import argparse
+import os
+import statistics
+import time
+
+from marketplace import create_app
+from marketplace.http.ratelimit import BucketTable, limiter, parse_limits
+
+from benchmarks.login_throughput import percentile
+
+KEYS = 10000
+
+
+def time_decisions(decide, count):
+    """Per-decision latencies in microseconds, timed in batches of 100"""
+    samples = []
+    for start in range(0, count, 100):
+        began = time.perf_counter()
+        for i in range(start, start + 100):
+            decide(i)
+        samples.append((time.perf_counter() - began) / 100 * 1e6)
+    return samples
+
+
+def forked_hits(storage, limit, workers, attempts):
+    pids = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            allowed = sum(storage.hit(1, limit, time.monotonic())[0] for _ in range(attempts))
+            os._exit(min(allowed, 255))
+        pids.append(pid)
+    return sum(os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1]) for pid in pids)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--config', default='test')
+    parser.add_argument('--decisions', type=int, default=100000)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--limit', type=int, default=200, help='At most 255')
+    args = parser.parse_args()
+
+    app = create_app(args.config)
+    app.config['RATELIMIT_ENABLED'] = True
+    generous = parse_limits('1000000 per second')[0]
+
+    print('{:<22} {:>8} {:>8} {:>8}'.format('decision', 'p50 us', 'p99 us', 'mean us'))
+    for url in ('memory://', 'shm://'):
+        app.config['RATELIMIT_STORAGE_URL'] = url
+        app.config['RATELIMIT_DEFAULT'] = '1000000 per second'
+        limiter.init_app(app)
+        storage = limiter.storage
+        rows = [('bucket ' + url, time_decisions(
+            lambda i: storage.hit(i % KEYS * 2 + 1, generous, time.monotonic()),
+            args.decisions))]
+        with app.test_request_context('/merchant/', environ_base={'REMOTE_ADDR': '10.0.0.1'}):
+            app.preprocess_request()
+            rows.append(('request ' + url, time_decisions(
+                lambda i: limiter._before_request(), args.decisions)))
+        for name, samples in rows:
+            print('{:<22} {:>8.2f} {:>8.2f} {:>8.2f}'.format(
+                name, statistics.median(samples), percentile(samples, 99),
+                statistics.mean(samples)))
+
+    storage = BucketTable(shared=True)
+    allowed = forked_hits(storage, parse_limits('{} per day'.format(args.limit))[0],
+                          args.workers, args.limit)
+    print('\n{} workers x {} requests against {} per day: {} allowed'.format(
+        args.workers, args.limit, args.limit, allowed))
+    if allowed != args.limit:
+        raise SystemExit('Shared buckets let {} requests through instead of {}'.format(
+            allowed, args.limit))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""
+Serializer benchmark.
+
+Renders `--rows` in-memory rows of every list schema `--repeat` times, once through
+`schema.dump()` + `json.dumps(default=json_default)` and once through the compiled
+serializer, checks both produce the same text and reports rows/s for each path.
+
+    $ python -m benchmarks.serializer --rows 500 --repeat 20
+"""
+import argparse
+import json
+import time
+import uuid
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from marketplace import create_app
+from marketplace.http.encoding import json_default
+from marketplace.http.serializer import compiled
+from marketplace.persistence.model import (Merchant, ProductItem, ProductPricing,
+                                           ProductStatus, User)
+
+
+def make_rows(count):
+    now = datetime.utcnow()
+    rows = {'products': [], 'pricing': [], 'merchants': [], 'users': []}
+    for i in range(count):
+        created = now - timedelta(minutes=i)
+        product_id = uuid.uuid4()
+        rows['products'].append(ProductItem(
+            id=product_id, seller_id=uuid.uuid4(), category_id=uuid.uuid4(),
+            name='Product {}'.format(i), description='Description of product {}'.format(i),
+            price=Decimal('{}.99'.format(i)), currency='USD', stock_quantity=i % 50,
+            status=ProductStatus.ACTIVE, images=['https://img.example/{}.png'.format(i)],
+            tags=['tag{}'.format(i % 7), 'sale'], sku='SKU-{:06d}'.format(i),
+            attributes={'color': 'red', 'size': i % 5}, created_at=created, updated_at=created))
+        rows['pricing'].append(ProductPricing(
+            id=uuid.uuid4(), product_id=product_id, base_price=Decimal('{}.99'.format(i)),
+            discount_price=Decimal('{}.49'.format(i)) if i % 2 else None, currency='USD',
+            valid_from=created, valid_to=None, created_at=created, updated_at=created))
+        rows['merchants'].append(Merchant(
+            id=i, name='Merchant {}'.format(i), description=None, city='Jakarta',
+            owner_id=i, created_at=created, updated_at=created))
+        rows['users'].append(User(
+            id=i, username='user{}'.format(i), fullname='User {}'.format(i),
+            phone='+62800{:06d}'.format(i), created_at=created, updated_at=created))
+    return rows
+
+
+def timed(render, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        render()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--config', default='test')
+    parser.add_argument('--rows', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    create_app(args.config)
+    from marketplace.merchant.v1.serializers import merchants_schema
+    from marketplace.product.v1.serializers import pricings_schema, products_schema
+    from marketplace.user.v1.serializers import users_schema
+    schemas = {'products': products_schema, 'pricing': pricings_schema,
+               'merchants': merchants_schema, 'users': users_schema}
+
+    rows = make_rows(args.rows)
+    print('{:<10} {:>14} {:>14} {:>8}'.format('schema', 'dump rows/s', 'compiled rows/s',
+                                              'speedup'))
+    for name, schema in schemas.items():
+        items = rows[name]
+        serializer = compiled(schema)
+        expected = json.dumps(schema.dump(items), default=json_default)
+        assert serializer.dumps_many(items) == expected, name
+
+        dump = timed(lambda: json.dumps(schema.dump(items), default=json_default), args.repeat)
+        fast = timed(lambda: serializer.dumps_many(items), args.repeat)
+        print('{:<10} {:>14.0f} {:>14.0f} {:>7.1f}x'.format(
+            name, len(items) / dump, len(items) / fast, dump / fast))
+
+
+if __name__ == '__main__':
+    main()
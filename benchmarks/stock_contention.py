@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+"""
+Stock reservation contention benchmark.
+
+Puts `--stock` units of one hot SKU on sale and lets `--buyers` threads reserve
+`--quantity` units each through `/product/reservations/` until it is sold out. With
+`--basket-size` above 1 every basket also holds other SKUs, in random order, to show
+overlapping baskets queue up rather than deadlock. Checks no more than `--stock` units
+were sold and reports reservations/s and latency.
+
+`--naive` runs the same buyers with a read-modify-write in Python instead, to show the
+overselling the conditional UPDATE prevents.
+
+    $ python -m benchmarks.stock_contention --config test --buyers 32 --stock 1000
+"""
+import argparse
+import random
+import statistics
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from marketplace import create_app, db
+from marketplace.auth.utils import generate_token
+from marketplace.persistence.model import (ProductCategory, ProductItem, StockReservation,
+                                           StockReservationItem, User)
+
+from benchmarks.login_throughput import percentile
+
+USERNAME = 'bench_stock_user'
+HOT_SKU = 'BENCH-HOT'
+OTHER_SKU = 'BENCH-SKU-{:03d}'
+
+
+def setup(app, stock, other_skus):
+    """Reset the benchmark products, returns the buyer's token"""
+    with app.app_context():
+        db.create_all()
+        user = User.query.filter_by(username=USERNAME).first()
+        if user is None:
+            user = User(username=USERNAME)
+            user.password = uuid.uuid4().hex
+            user.save()
+        skus = [HOT_SKU] + [OTHER_SKU.format(i) for i in range(other_skus)]
+        reservations = (StockReservationItem.query
+                        .filter(StockReservationItem.sku.in_(skus))
+                        .with_entities(StockReservationItem.reservation_id))
+        ids = [row.reservation_id for row in reservations]
+        StockReservationItem.query.filter(
+            StockReservationItem.reservation_id.in_(ids)).delete(synchronize_session=False)
+        StockReservation.query.filter(StockReservation.id.in_(ids)).delete(
+            synchronize_session=False)
+
+        category = ProductCategory.query.filter_by(name='Benchmark').first()
+        if category is None:
+            category = ProductCategory(name='Benchmark')
+            db.session.add(category)
+            db.session.flush()
+        for sku in skus:
+            product = ProductItem.query.filter_by(sku=sku).first()
+            if product is None:
+                product = ProductItem(seller_id=uuid.uuid4(), category_id=category.id,
+                                      name=sku, price=1, currency='USD', sku=sku)
+                db.session.add(product)
+            # Plenty of every other SKU, the hot one is what runs out
+            product.stock_quantity = stock if sku == HOT_SKU else stock * 100
+        db.session.commit()
+        return generate_token(user.id)
+
+
+def remaining(app):
+    with app.app_context():
+        return ProductItem.query.filter_by(sku=HOT_SKU).first().stock_quantity
+
+
+def reserve_atomic(app, token):
+    client = app.test_client()
+    headers = {'Authorization': 'Bearer {}'.format(token)}
+
+    def reserve(basket):
+        items = [{'sku': sku, 'quantity': quantity} for sku, quantity in basket]
+        response = client.post('/product/reservations/', json={'items': items},
+                               headers=headers)
+        assert response.status_code in (201, 409), response.data
+        return response.status_code == 201
+
+    return reserve
+
+
+def reserve_naive(app, token):
+    def reserve(basket):
+        # Read, check and write back in Python: two buyers reading the same stock both
+        # succeed and the second write overwrites the first
+        with app.app_context():
+            products = []
+            for sku, quantity in basket:
+                product = ProductItem.query.filter_by(sku=sku).first()
+                if product.stock_quantity < quantity:
+                    db.session.rollback()
+                    return False
+                products.append((product, quantity))
+            for product, quantity in products:
+                product.stock_quantity = product.stock_quantity - quantity
+            db.session.commit()
+            return True
+
+    return reserve
+
+
+def run(reserve, buyers, quantity, basket_size, other_skus):
+    latencies = []
+    sold = []
+    sold_out = threading.Event()
+
+    def buyer(_):
+        rng = random.Random()
+        while not sold_out.is_set():
+            basket = [(HOT_SKU, quantity)] + [
+                (OTHER_SKU.format(i), 1)
+                for i in rng.sample(range(other_skus), min(basket_size - 1, other_skus))]
+            rng.shuffle(basket)
+            start = time.perf_counter()
+            ok = reserve(basket)
+            latencies.append(time.perf_counter() - start)
+            if ok:
+                sold.append(quantity)
+            else:
+                sold_out.set()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=buyers) as pool:
+        list(pool.map(buyer, range(buyers)))
+    elapsed = time.perf_counter() - started
+    return sum(sold), len(sold), latencies, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--config', default='test')
+    parser.add_argument('--buyers', type=int, default=32)
+    parser.add_argument('--stock', type=int, default=1000)
+    parser.add_argument('--quantity', type=int, default=1, help='Hot SKU units per basket')
+    parser.add_argument('--basket-size', type=int, default=3, help='SKUs per basket')
+    parser.add_argument('--skus', type=int, default=20, help='Other SKUs to fill baskets')
+    parser.add_argument('--naive', action='store_true',
+                        help='Read-modify-write in Python instead of the reservation API')
+    args = parser.parse_args()
+
+    app = create_app(args.config)
+    token = setup(app, args.stock, args.skus)
+    reserve = (reserve_naive if args.naive else reserve_atomic)(app, token)
+    units, reservations, latencies, elapsed = run(reserve, args.buyers, args.quantity,
+                                                  args.basket_size, args.skus)
+    left = remaining(app)
+
+    print('{:<20} {:>10}'.format('stock', args.stock))
+    print('{:<20} {:>10}'.format('units sold', units))
+    print('{:<20} {:>10}'.format('units left', left))
+    print('{:<20} {:>10}'.format('oversold', max(units + left - args.stock, 0)))
+    print('{:<20} {:>10.2f}'.format('reservations/s', reservations / elapsed))
+    print('{:<20} {:>10.2f}'.format('attempt_p50_ms', statistics.median(latencies) * 1000))
+    print('{:<20} {:>10.2f}'.format('attempt_p99_ms', percentile(latencies, 99) * 1000))
+    if not args.naive and (units + left != args.stock or left < 0):
+        raise SystemExit('Stock is inconsistent: {} sold + {} left != {}'.format(
+            units, left, args.stock))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+gunicorn settings, picked up automatically from the working directory:
+
+    $ gunicorn wsgi:app
+
+Tuned through the environment: WEB_CONCURRENCY (workers, default derived from the CPUs
+this process may run on), GUNICORN_WORKER_CLASS (`gthread` by default, `sync` for one
+request per process), GUNICORN_THREADS, GUNICORN_MAX_REQUESTS and GUNICORN_TIMEOUT.
+The worker and thread counts are exported back so the app sizes its connection pools
+for them, set them here rather than with `-w`/`--threads`.
+"""
+import os
+import tempfile
+
+
+def cpu_count():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', 4)) if worker_class == 'gthread' else 1
+# Sync workers block on every query, so more processes than cores keep the CPUs busy.
+# gthread workers overlap I/O within a process and need about one process per core.
+default_workers = cpu_count() * 2 + 1 if threads == 1 else cpu_count() + 1
+workers = int(os.environ.get('WEB_CONCURRENCY') or default_workers)
+
+os.environ['WEB_CONCURRENCY'] = str(workers)
+os.environ['GUNICORN_THREADS'] = str(threads)
+# One directory for every worker's metrics snapshot, so /metrics adds them up
+os.environ.setdefault('METRICS_MULTIPROC_DIR',
+                      os.path.join(tempfile.gettempdir(), 'marketplace-metrics'))
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 180))
+graceful_timeout = 30
+keepalive = 5
+
+# Import the app once in the master and fork it: workers start faster and share the
+# memory of everything loaded at import, including the `shm://` rate limit buckets
+preload_app = True
+
+# Recycle workers now and then so slow leaks cannot grow without bound; the jitter
+# keeps them from all restarting at the same time
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 10000))
+max_requests_jitter = max_requests // 10
+
+accesslog = '-'
+errorlog = '-'
+
+
+def post_fork(server, worker):
+    # The preloaded app's engines may hold connections opened in the master, each
+    # worker must start from its own empty pools
+    from marketplace import db
+    from marketplace.persistence.pooling import dispose_engines
+    dispose_engines(worker.app.wsgi(), db)
@@ -1,18 +1,22 @@
 #!/usr/bin/env python
 import os
 import sys
+import time
 
-import coverage
+import click
 from flask_migrate import Migrate
 
 from marketplace import create_app, db
 
-COV = coverage.coverage(config_file='.coveragerc')
+COV = None
 
 environ = None
-if sys.argv[1] in ['cov', 'test']:
+command = sys.argv[1] if len(sys.argv) > 1 else None
+if command in ['cov', 'test']:
     environ = os.getenv('FLASK_CONFIG') or 'test'
-    if sys.argv[1] == 'cov':
+    if command == 'cov':
+        import coverage
+        COV = coverage.coverage(config_file='.coveragerc')
         COV.start()
 else:
     environ = os.getenv('FLASK_CONFIG') or 'development'
@@ -46,6 +50,100 @@ def init_db_command():
     print('Initialized the database.')
 
 
+@app.cli.command("create-db-functions")
+def create_db_functions_command():
+    """Create or replace the SQL functions the schema depends on, run before `db upgrade`."""
+    from sqlalchemy import text
+    from marketplace.persistence.model import DB_FUNCTIONS
+    from marketplace.persistence.routing import WRITE_BIND
+
+    engine = db.engines.get(WRITE_BIND, db.engine)
+    if engine.dialect.name != 'postgresql':
+        print('Nothing to create on {}.'.format(engine.dialect.name))
+        return
+    with engine.begin() as connection:
+        for statement in DB_FUNCTIONS:
+            connection.execute(text(statement))
+    print('Created database functions.')
+
+
+@app.cli.command("seed")
+@click.option('--seed', 'seed_value', default=0, show_default=True,
+              help='Random seed, the same seed gives the same rows')
+@click.option('--users', default=1000, show_default=True)
+@click.option('--merchants', default=100, show_default=True)
+@click.option('--depth', default=3, show_default=True, help='Category tree depth')
+@click.option('--fanout', default=5, show_default=True, help='Children per category')
+@click.option('--products-per-category', default=10, show_default=True)
+@click.option('--prices-per-product', default=1, show_default=True)
+@click.option('--password', default='this15secret', show_default=True,
+              help='Password of every generated user')
+@click.option('--jobs', default=4, show_default=True, help='Parallel COPY connections')
+@click.option('--truncate', is_flag=True, help='Empty all tables first')
+def seed_command(seed_value, users, merchants, depth, fanout, products_per_category,
+                 prices_per_product, password, jobs, truncate):
+    """Load a synthetic dataset through COPY."""
+    import logging
+    from marketplace.persistence.routing import WRITE_BIND
+    from marketplace.persistence.seed import Seeder, log
+
+    log.setLevel(logging.INFO)
+    log.addHandler(logging.StreamHandler())
+    seeder = Seeder(db.engines.get(WRITE_BIND, db.engine), seed=seed_value, users=users,
+                    merchants=merchants, depth=depth, fanout=fanout,
+                    products_per_category=products_per_category,
+                    prices_per_product=prices_per_product, password=password,
+                    rounds=app.config.get('BCRYPT_LOG_ROUNDS', 12), jobs=jobs)
+    started = time.perf_counter()
+    counts = seeder.run(truncate=truncate)
+    for table, count in counts.items():
+        print('{:<20} {:>10}'.format(table, count))
+    print('Seeded in {:.1f}s'.format(time.perf_counter() - started))
+
+
+@app.cli.command("rebuild-merchant-stats")
+def rebuild_merchant_stats_command():
+    """Recount the per-city merchant summary from the merchants table."""
+    from marketplace.merchant import stats
+    from marketplace.persistence.routing import WRITE_BIND
+
+    with db.engines.get(WRITE_BIND, db.engine).begin() as connection:
+        stats.rebuild(connection)
+    print('Rebuilt merchant stats.')
+
+
+@app.cli.command("release-expired-reservations")
+@click.option('--batch-size', default=1000, show_default=True)
+def release_expired_reservations_command(batch_size):
+    """Put the stock of expired, uncommitted reservations back."""
+    from marketplace.product import stock
+
+    print('Released {} reservations.'.format(stock.release_expired(batch_size)))
+
+
+@app.cli.command("normalize-currencies")
+def normalize_currencies_command():
+    """Uppercase the currency codes stored before they were normalized on write."""
+    from sqlalchemy import func, update
+    from marketplace.persistence.model import ProductItem, ProductPricing
+    from marketplace.persistence.routing import WRITE_BIND
+
+    with db.engines.get(WRITE_BIND, db.engine).begin() as connection:
+        for model in (ProductItem, ProductPricing):
+            updated = connection.execute(
+                update(model).where(model.currency != func.upper(model.currency))
+                .values(currency=func.upper(model.currency))).rowcount
+            print('Normalized {} {} rows.'.format(updated, model.__tablename__))
+
+
+@app.cli.command("purge-expired-entries")
+def purge_expired_entries_command():
+    """Delete the expired entries of the `database://` backend (idempotency keys)."""
+    from marketplace.http.cache import DatabaseBackend
+
+    print('Purged {} entries.'.format(DatabaseBackend().purge_expired()))
+
+
 @app.cli.command("test")
 def test():
     """Run the unit tests."""
@@ -58,7 +156,11 @@ def test():
 def coverage_report():
     """Run the unit tests with coverage."""
     import unittest
-    COV.start()
+    global COV
+    if COV is None:
+        import coverage
+        COV = coverage.coverage(config_file='.coveragerc')
+        COV.start()
     tests = unittest.TestLoader().discover('test')
     unittest.TextTestRunner(verbosity=2).run(tests)
     COV.stop()
@@ -5,8 +5,10 @@ from flask_restx import Api
 from flask_sqlalchemy import SQLAlchemy
 
 from config import config_by_name
+from marketplace.http.encoding import json_default
+from marketplace.persistence import pooling, profiling, routing
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': routing.RoutingSession})
 ma = Marshmallow()
 migrate = Migrate()
 
@@ -39,16 +41,41 @@ def create_app(config_name='development'):
     app.config.SWAGGER_UI_OPERATION_ID = True
     app.config.SWAGGER_UI_REQUEST_DURATION = True
 
+    # Let flask-restx encode Decimal/Enum values left as-is by the marshmallow schemas
+    app.config.setdefault('RESTX_JSON', {'default': json_default})
+
+    pooling.configure(app)
     db.init_app(app)
+    routing.init_app(app, db)
+    profiling.init_app(app, db)
     ma.init_app(app)
     migrate.init_app(app, db)
     api.init_app(app)
 
+    from marketplace.auth.hashing import HasherBusy, busy_response, password_hasher
+    from marketplace.auth.principal_cache import principal_cache
+    from marketplace.http.cache import response_cache
+    from marketplace.http.compression import compression
+    from marketplace.http.idempotency import idempotency
+    from marketplace.http.metrics import metrics
+    from marketplace.http.ratelimit import limiter
+    password_hasher.init_app(app)
+    api.errorhandler(HasherBusy)(busy_response)
+    principal_cache.init_app(app)
+    response_cache.init_app(app)
+    idempotency.init_app(app)
+    metrics.init_app(app)
+    # After metrics too, so rejected requests are still counted and timed
+    limiter.init_app(app)
+    # After metrics: after_request hooks run last-registered first, so the metrics see
+    # the compressed sizes
+    compression.init_app(app)
+
     # Register blueprints and namespaces
     from marketplace.user.v1.routes import auth_ns, users_ns
     from marketplace.merchant.v1.routes import merchant_ns
     from marketplace.health.routes import health_ns
-    from marketplace.product.v1 import category_ns, product_ns, pricing_ns
+    from marketplace.product.v1 import category_ns, product_ns, pricing_ns, reservation_ns
 
     api.add_namespace(auth_ns, path='/user/auth')
     api.add_namespace(users_ns, path='/user/users')
@@ -57,5 +84,6 @@ def create_app(config_name='development'):
     api.add_namespace(category_ns, path='/product/categories')
     api.add_namespace(product_ns, path='/product/items')
     api.add_namespace(pricing_ns, path='/product/pricing')
+    api.add_namespace(reservation_ns, path='/product/reservations')
 
     return app
@@ -0,0 +1,96 @@
+import math
+import os
+import threading
+
+import bcrypt
+
+
+class HasherBusy(TimeoutError):
+    """No bcrypt slot freed up within BCRYPT_TIMEOUT seconds, the server is overloaded"""
+
+    def __init__(self, timeout):
+        super().__init__('No bcrypt slot freed up within {}s'.format(timeout))
+        self.retry_after = max(math.ceil(timeout), 1)
+
+
+def busy_response(error):
+    """API error handler of `HasherBusy`: a 503 the client may retry after a while"""
+    return ({'message': 'Too many password checks in progress, try again later'}, 503,
+            {'Retry-After': str(error.retry_after)})
+
+
+class PasswordHasher:
+    """
+    Runs bcrypt in the calling thread, at most `BCRYPT_CONCURRENCY` hashes at a time.
+
+    bcrypt releases the GIL while it works, so the other request threads of a `gthread`
+    worker keep running during a hash, and the semaphore caps how many cores a login
+    burst can take at once. Threads over the cap wait up to `BCRYPT_TIMEOUT` seconds,
+    then get `HasherBusy` (a 503 through the API). The work factor comes from
+    `BCRYPT_LOG_ROUNDS`.
+    """
+
+    def __init__(self, rounds=12, concurrency=2, timeout=30):
+        self.rounds = rounds
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._dummy_hash = None
+
+    def init_app(self, app):
+        self.rounds = app.config.get('BCRYPT_LOG_ROUNDS', self.rounds)
+        self.concurrency = app.config.get('BCRYPT_CONCURRENCY', self.concurrency)
+        self.timeout = app.config.get('BCRYPT_TIMEOUT', self.timeout)
+        self._slots = threading.BoundedSemaphore(self.concurrency)
+        self._dummy_hash = None
+
+    def hash(self, password):
+        salt = bcrypt.gensalt(rounds=self.rounds)
+        hashed = self._run(bcrypt.hashpw, password.encode('utf-8'), salt)
+        return hashed.decode('utf-8')
+
+    def verify(self, password, password_hash):
+        """
+        Check `password` against `password_hash`. Without a hash (unknown user) a dummy
+        one is checked anyway, so the response time does not tell which users exist.
+        """
+        if not password:
+            return False
+        if not password_hash:
+            self._run(bcrypt.checkpw, password.encode('utf-8'), self._dummy())
+            return False
+        return self._run(bcrypt.checkpw, password.encode('utf-8'),
+                         password_hash.encode('utf-8'))
+
+    def needs_rehash(self, password_hash):
+        """True when `password_hash` was made with a different work factor"""
+        try:
+            return int(password_hash.split('$')[2]) != self.rounds
+        except (AttributeError, IndexError, ValueError):
+            return True
+
+    def _dummy(self):
+        # Made with the current work factor, so it costs as much as a real check
+        if self._dummy_hash is None:
+            self._dummy_hash = self._run(bcrypt.hashpw, os.urandom(16),
+                                         bcrypt.gensalt(rounds=self.rounds))
+        return self._dummy_hash
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise HasherBusy(self.timeout)
+        try:
+            return fn(*args)
+        finally:
+            self._slots.release()
+
+    def _after_fork(self):
+        # A slot held by another thread at fork() time would never be released in the
+        # child, each gunicorn worker starts with all of them free
+        self._slots = threading.BoundedSemaphore(self.concurrency)
+
+
+password_hasher = PasswordHasher()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=password_hasher._after_fork)
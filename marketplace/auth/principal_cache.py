@@ -0,0 +1,140 @@
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import make_transient_to_detached, object_session
+
+from marketplace import db
+from marketplace.persistence.model import User
+
+
+UNCACHED_COLUMNS = ('is_admin',)
+
+
+class PrincipalCache:
+    """
+    Bounded LRU of verified JWTs and a column snapshot of the `User` they resolve to.
+
+    An entry lives until the earlier of its TTL and the token's own `exp`, so a hit can
+    skip both `jwt.decode` and the users lookup. The cache is per worker process: a
+    committed write to a user invalidates this worker's entries straight away, other
+    workers converge within `AUTH_PRINCIPAL_CACHE_TTL` seconds. Columns that grant
+    privileges (UNCACHED_COLUMNS) are left out of the snapshot and read from the database
+    when a handler checks them, so revoking them takes effect in every worker at once.
+    """
+
+    def __init__(self, maxsize=10000, ttl=30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._tokens_by_user = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def init_app(self, app):
+        self.maxsize = app.config.get('AUTH_PRINCIPAL_CACHE_SIZE', self.maxsize)
+        self.ttl = app.config.get('AUTH_PRINCIPAL_CACHE_TTL', self.ttl)
+        self.clear()
+
+    def get(self, token):
+        """Return the cached (user_id, values) of `token`, or None"""
+        if not self.maxsize:
+            return None
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, user_id, values = entry
+            if expires_at <= time.time():
+                self._discard(token)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(token)
+            self.hits += 1
+            return user_id, values
+
+    def set(self, token, user, token_exp):
+        if not self.maxsize:
+            return
+        values = {attr.key: getattr(user, attr.key) for attr in inspect(User).column_attrs
+                  if attr.key not in UNCACHED_COLUMNS}
+        expires_at = min(time.time() + self.ttl, token_exp)
+        with self._lock:
+            self._discard(token)
+            self._entries[token] = (expires_at, user.id, values)
+            self._tokens_by_user.setdefault(user.id, set()).add(token)
+            while len(self._entries) > self.maxsize:
+                oldest = next(iter(self._entries))
+                self._discard(oldest)
+                self.evictions += 1
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            for token in self._tokens_by_user.pop(user_id, ()):
+                self._entries.pop(token, None)
+            self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tokens_by_user.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
+
+    def _discard(self, token):
+        entry = self._entries.pop(token, None)
+        if entry is not None:
+            tokens = self._tokens_by_user.get(entry[1])
+            if tokens is not None:
+                tokens.discard(token)
+                if not tokens:
+                    del self._tokens_by_user[entry[1]]
+
+
+principal_cache = PrincipalCache()
+
+
+def attach_principal(values):
+    """
+    Rebuild a `User` from a cached snapshot and attach it to the current session
+    without a round trip (`merge(load=False)`), so handlers get a regular instance.
+    UNCACHED_COLUMNS are unloaded and fetched by primary key on first access (which
+    `token_required` does right away), raising ObjectDeletedError if the user was
+    deleted meanwhile.
+    """
+    user = User(**values)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+# Writes are only acted on once committed: invalidating at flush time would let a
+# request racing the transaction cache the row as it was before the write
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _written_principal(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        session.info.setdefault('written_users', set()).add(target.id)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _invalidate_principals(session):
+    for user_id in session.info.pop('written_users', ()):
+        principal_cache.invalidate_user(user_id)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_principals(session):
+    session.info.pop('written_users', None)
@@ -3,7 +3,10 @@ from functools import wraps
 
 import jwt
 from flask import request, current_app
+from sqlalchemy.orm.exc import ObjectDeletedError
 
+from marketplace import db
+from marketplace.auth.principal_cache import UNCACHED_COLUMNS, attach_principal, principal_cache
 from marketplace.persistence.model import User
 
 
@@ -26,7 +29,7 @@ def generate_token(user_id):
 
 def token_required(f):
     @wraps(f)
-    def decorated(*args, **kwargs):
+    def decorated(resource, *args, **kwargs):
         token = None
         if 'Authorization' in request.headers:
             auth_header = request.headers['Authorization']
@@ -38,6 +41,20 @@ def token_required(f):
         if not token:
             return {'message': 'Token is missing'}, 401
 
+        cached = principal_cache.get(token)
+        if cached is not None:
+            current_user = attach_principal(cached[1])
+            try:
+                # Load the uncached columns now, so a user deleted through another worker
+                # since it was cached fails here and not halfway through the handler
+                for column in UNCACHED_COLUMNS:
+                    getattr(current_user, column)
+            except ObjectDeletedError:
+                db.session.rollback()
+                principal_cache.invalidate_user(cached[0])
+                return {'message': 'Invalid token'}, 401
+            return f(resource, current_user, *args, **kwargs)
+
         try:
             payload = jwt.decode(
                 token,
@@ -50,7 +67,11 @@ def token_required(f):
         except jwt.InvalidTokenError:
             return {'message': 'Invalid token'}, 401
 
-        return f(current_user, *args, **kwargs)
+        if current_user is None:
+            return {'message': 'Invalid token'}, 401
+
+        principal_cache.set(token, current_user, payload['exp'])
+        return f(resource, current_user, *args, **kwargs)
 
     return decorated
 
@@ -58,9 +79,9 @@ def token_required(f):
 def admin_required(f):
     @wraps(f)
     @token_required
-    def decorated(current_user, *args, **kwargs):
+    def decorated(resource, current_user, *args, **kwargs):
         if not current_user.is_admin:
             return {'message': 'Admin privilege required'}, 403
-        return f(current_user, *args, **kwargs)
+        return f(resource, current_user, *args, **kwargs)
 
     return decorated
@@ -2,6 +2,7 @@ from flask_restx import Namespace, Resource, fields
 from sqlalchemy.sql import text
 
 from marketplace import db
+from marketplace.http.ratelimit import limiter
 
 # Create namespace instead of blueprint
 health_ns = Namespace("health", description="Health check operations")
@@ -21,6 +22,7 @@ class HealthCheck(Resource):
     @health_ns.doc("health_check")
     @health_ns.response(200, "Service is healthy", health_response)
     @health_ns.response(503, "Service is unhealthy", health_response)
+    @limiter.exempt
     def get(self):
         """Check the health status of the service"""
         try:
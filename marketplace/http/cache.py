@@ -0,0 +1,411 @@
+import hashlib
+import json
+import mmap
+import multiprocessing
+import struct
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from functools import wraps
+from urllib.parse import urlencode
+
+from flask import Response, request
+from flask_restx.utils import unpack
+from sqlalchemy import delete, insert, or_, select
+from sqlalchemy.exc import IntegrityError
+
+from marketplace import db
+from marketplace.http.streaming import wants_ndjson
+from marketplace.persistence.model import SharedEntry
+from marketplace.persistence.routing import WRITE_BIND
+
+
+class MemoryBackend:
+    """Per-worker LRU with TTL, also the local stand-in for the shared backend"""
+
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._get(key, time.monotonic())
+
+    def get_many(self, keys):
+        with self._lock:
+            now = time.monotonic()
+            return [self._get(key, now) for key in keys]
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._set(key, value, ttl)
+
+    def add(self, key, value, ttl=None):
+        """Set `key` only if it is absent, True when this call set it"""
+        with self._lock:
+            if self._get(key, time.monotonic()) is not None:
+                return False
+            self._set(key, value, ttl)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def _get(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at is not None and expires_at <= now:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def _set(self, key, value, ttl):
+        expires_at = time.monotonic() + ttl if ttl else None
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+class RedisBackend:
+    """Backend shared by every worker, needs the optional `redis` package"""
+
+    def __init__(self, url):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('RESPONSE_CACHE_URL={} requires the redis package'.format(url))
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        return self._client.get(key)
+
+    def get_many(self, keys):
+        return self._client.mget(keys)
+
+    def set(self, key, value, ttl=None):
+        self._client.set(key, value, ex=ttl or None)
+
+    def add(self, key, value, ttl=None):
+        return bool(self._client.set(key, value, ex=ttl or None, nx=True))
+
+    def delete(self, key):
+        self._client.delete(key)
+
+
+class DatabaseBackend:
+    """
+    Backend in the application database (the `master` bind), shared by every worker and
+    host without another service. One round trip per call, so it suits low-volume state
+    like idempotency keys. Expired rows are skipped on read and removed by
+    `flask purge-expired-entries`.
+    """
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def get_many(self, keys):
+        table = self._table()
+        with self._engine().connect() as connection:
+            values = dict(connection.execute(
+                select(table.c.key, table.c.value)
+                .where(table.c.key.in_(keys), self._live(table, datetime.utcnow()))
+            ).all())
+        return [values.get(key) for key in keys]
+
+    def set(self, key, value, ttl=None):
+        table = self._table()
+        try:
+            with self._engine().begin() as connection:
+                connection.execute(delete(table).where(table.c.key == key))
+                connection.execute(insert(table).values(key=key, value=value,
+                                                        expires_at=self._expires_at(ttl)))
+        except IntegrityError:
+            # A concurrent set() of the same key won, its value is as good as ours
+            pass
+
+    def add(self, key, value, ttl=None):
+        """Set `key` only if it is absent, True when this call set it"""
+        table = self._table()
+        now = datetime.utcnow()
+        try:
+            with self._engine().begin() as connection:
+                connection.execute(delete(table).where(table.c.key == key,
+                                                       ~self._live(table, now)))
+                connection.execute(insert(table).values(key=key, value=value,
+                                                        expires_at=self._expires_at(ttl)))
+        except IntegrityError:
+            # The primary key decides between concurrent adds
+            return False
+        return True
+
+    def delete(self, key):
+        table = self._table()
+        with self._engine().begin() as connection:
+            connection.execute(delete(table).where(table.c.key == key))
+
+    def purge_expired(self):
+        """Delete the expired entries, returns how many were deleted"""
+        table = self._table()
+        with self._engine().begin() as connection:
+            return connection.execute(
+                delete(table).where(table.c.expires_at <= datetime.utcnow())).rowcount
+
+    @staticmethod
+    def _live(table, now):
+        return or_(table.c.expires_at.is_(None), table.c.expires_at > now)
+
+    @staticmethod
+    def _expires_at(ttl):
+        return datetime.utcnow() + timedelta(seconds=ttl) if ttl else None
+
+    @staticmethod
+    def _table():
+        return SharedEntry.__table__
+
+    @staticmethod
+    def _engine():
+        return db.engines.get(WRITE_BIND, db.engine)
+
+
+GENERATION_SLOT = struct.Struct('Qd')
+
+
+class GenerationTable:
+    """
+    Tag generations of a per-worker (`memory://`) response cache: a fixed table of
+    (counter, bumped_at) slots that tags are hashed to.
+
+    `shared` tables live in anonymous shared memory like the rate limit buckets (see
+    marketplace.http.ratelimit.BucketTable), so an invalidation in one gunicorn worker
+    changes the keys of every worker forked after the table was made (`preload_app`).
+    Tags sharing a slot are invalidated together, which only costs extra misses.
+    """
+
+    def __init__(self, slots=65536, stripes=64, shared=False):
+        self.slots = max(slots, stripes)
+        self.stripes = stripes
+        size = GENERATION_SLOT.size * self.slots
+        if shared:
+            self._memory = mmap.mmap(-1, size)
+            self._locks = [multiprocessing.Lock() for _ in range(stripes)]
+        else:
+            self._memory = bytearray(size)
+            self._locks = [threading.Lock() for _ in range(stripes)]
+
+    def get_many(self, tags):
+        """`'<bumped_at>-<counter>'` of each tag, bumped_at is 0 for a tag never bumped"""
+        generations = []
+        for tag in tags:
+            slot = self._slot(tag)
+            with self._locks[slot % self.stripes]:
+                counter, bumped_at = GENERATION_SLOT.unpack_from(
+                    self._memory, slot * GENERATION_SLOT.size)
+            generations.append('{:.6f}-{}'.format(bumped_at, counter))
+        return generations
+
+    def bump(self, tag):
+        slot = self._slot(tag)
+        offset = slot * GENERATION_SLOT.size
+        with self._locks[slot % self.stripes]:
+            counter, _ = GENERATION_SLOT.unpack_from(self._memory, offset)
+            GENERATION_SLOT.pack_into(self._memory, offset, counter + 1, time.time())
+
+    def _slot(self, tag):
+        # Not hash(), it differs between processes started apart
+        digest = hashlib.blake2b(tag.encode(), digest_size=8).digest()
+        return int.from_bytes(digest, 'big') % self.slots
+
+
+def make_backend(url, max_entries=4096):
+    scheme = url.split('://', 1)[0]
+    if scheme == 'null':
+        return None
+    if scheme == 'memory':
+        return MemoryBackend(max_entries)
+    if scheme == 'database':
+        return DatabaseBackend()
+    if scheme in ('redis', 'rediss', 'unix'):
+        return RedisBackend(url)
+    raise ValueError('Unsupported RESPONSE_CACHE_URL: {}'.format(url))
+
+
+def as_response(resource, rv):
+    """The Response of a Resource method's return value, which may be a (data, code) tuple"""
+    if isinstance(rv, Response):
+        return rv
+    data, code, headers = unpack(rv)
+    return resource.api.make_response(data, code, headers=headers)
+
+
+def dump_response(response):
+    """Bytes of `response` for a backend, see `load_response`"""
+    headers = [(name, value) for name, value in response.headers.items()
+               if name not in ('Content-Length', 'Set-Cookie', 'X-Cache')]
+    head = json.dumps([response.status_code, headers]).encode()
+    return head + b'\n' + response.get_data()
+
+
+def load_response(entry):
+    head, body = entry.split(b'\n', 1)
+    status, headers = json.loads(head)
+    return Response(body, status=status, headers=headers)
+
+
+class ResponseCache:
+    """
+    Cache of serialized GET responses, keyed by path, query string and tag generations.
+
+    Every cached view declares tags (`'merchants'`, `'merchant:{id}'`, formatted with the
+    view arguments) and write handlers call `invalidate()` with the tags they touched.
+    Invalidating a tag gives it a new generation, so every key built from the old one is
+    never looked up again and simply ages out. Generations carry the time they were
+    bumped: for SQLALCHEMY_STICKY_SECONDS afterwards responses are served but not stored,
+    since they may have been read from a replica that has not caught up with the write.
+
+    On a miss, one request per key renders the response while concurrent requests for
+    the same key wait up to RESPONSE_CACHE_LOCK_SECONDS for it to be stored, or render
+    it themselves as soon as that request is done without storing anything.
+
+    Generations live in the backend when it is shared (redis). With the per-worker
+    `memory://` backend they live in a shared `GenerationTable` instead, so a write
+    handled by one worker invalidates the responses cached by all of them.
+    """
+
+    POLL_INTERVAL = 0.05
+
+    def __init__(self):
+        self.backend = None
+        self.generations = None
+        self.ttl = 30
+        self.lock_seconds = 5
+        self.settle_seconds = 0
+
+    def init_app(self, app):
+        self.backend = make_backend(app.config.get('RESPONSE_CACHE_URL', 'memory://'),
+                                    app.config.get('RESPONSE_CACHE_MAX_ENTRIES', 4096))
+        if isinstance(self.backend, MemoryBackend):
+            self.generations = GenerationTable(
+                app.config.get('RESPONSE_CACHE_GENERATION_SLOTS', 65536), shared=True)
+        else:
+            self.generations = None
+        self.ttl = app.config.get('RESPONSE_CACHE_TTL', self.ttl)
+        self.lock_seconds = app.config.get('RESPONSE_CACHE_LOCK_SECONDS', self.lock_seconds)
+        if app.config.get('SQLALCHEMY_READ_REPLICA_ENABLED') and app.config.get('SQLALCHEMY_BINDS'):
+            self.settle_seconds = app.config.get('SQLALCHEMY_STICKY_SECONDS', 0)
+        else:
+            self.settle_seconds = 0
+
+    @property
+    def enabled(self):
+        return self.backend is not None and self.ttl > 0
+
+    def cached(self, *tags):
+        """Cache the 200 responses of a Resource GET method under `tags`"""
+        def decorator(f):
+            @wraps(f)
+            def decorated(resource, *args, **kwargs):
+                if not self.enabled or request.method not in ('GET', 'HEAD') or wants_ndjson():
+                    return f(resource, *args, **kwargs)
+                return self._serve(f, resource, args, kwargs,
+                                   [tag.format(**kwargs) for tag in tags])
+            return decorated
+        return decorator
+
+    def invalidate(self, *tags):
+        if not self.enabled:
+            return
+        for tag in tags:
+            if self.generations is not None:
+                self.generations.bump(tag)
+            else:
+                self.backend.set(self._generation_key(tag), self._new_generation())
+
+    def _serve(self, f, resource, args, kwargs, tags):
+        key, settled = self._key(tags)
+        entry = self.backend.get(key)
+        if entry is not None:
+            return self._hit(entry)
+
+        if not settled:
+            # Nothing would be stored, so there is nothing for other requests to wait for
+            return self._render(f, resource, args, kwargs)
+
+        lock_key = key + ':lock'
+        if not self.backend.add(lock_key, b'1', self.lock_seconds):
+            deadline = time.monotonic() + self.lock_seconds
+            while time.monotonic() < deadline:
+                time.sleep(self.POLL_INTERVAL)
+                entry = self.backend.get(key)
+                if entry is not None:
+                    return self._hit(entry)
+                if self.backend.get(lock_key) is None:
+                    # The leader finished without storing (304, error, ...)
+                    break
+            return self._render(f, resource, args, kwargs)
+
+        try:
+            response = self._render(f, resource, args, kwargs)
+            if response.status_code == 200:
+                self.backend.set(key, dump_response(response), self.ttl)
+            return response
+        finally:
+            self.backend.delete(lock_key)
+
+    def _key(self, tags):
+        """Cache key of this request and whether every tag is past its settle window"""
+        if self.generations is not None:
+            generations = self.generations.get_many(tags)
+        else:
+            generations = self._stored_generations(tags)
+        now = time.time()
+        settled = all(now - float(generation.split('-', 1)[0]) >= self.settle_seconds
+                      for generation in generations)
+
+        query = urlencode(sorted(request.args.items(multi=True)))
+        raw = '\n'.join([request.path, query] + generations)
+        return 'resp:' + hashlib.sha1(raw.encode()).hexdigest(), settled
+
+    def _stored_generations(self, tags):
+        generation_keys = [self._generation_key(tag) for tag in tags]
+        generations = self.backend.get_many(generation_keys)
+        for i, generation in enumerate(generations):
+            if generation is None:
+                # Never invalidated (or evicted): pin a generation so the key stays valid
+                generation = self._new_generation(bumped_at=0)
+                if not self.backend.add(generation_keys[i], generation):
+                    generation = self.backend.get(generation_keys[i]) or generation
+            if isinstance(generation, bytes):
+                generation = generation.decode()
+            generations[i] = generation
+        return generations
+
+    def _render(self, f, resource, args, kwargs):
+        response = as_response(resource, f(resource, *args, **kwargs))
+        response.headers['X-Cache'] = 'MISS'
+        return response
+
+    def _hit(self, entry):
+        response = load_response(entry)
+        response.headers['X-Cache'] = 'HIT'
+        return response.make_conditional(request)
+
+    @staticmethod
+    def _generation_key(tag):
+        return 'resp-gen:' + tag
+
+    @staticmethod
+    def _new_generation(bumped_at=None):
+        if bumped_at is None:
+            bumped_at = time.time()
+        return '{:.6f}-{}'.format(bumped_at, uuid.uuid4().hex[:12])
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,142 @@
+import threading
+import zlib
+
+from flask import request
+
+try:
+    import zstandard
+except ImportError:  # optional, gzip only without it
+    zstandard = None
+
+COMPRESSIBLE_MIMETYPES = ('application/json', 'application/x-ndjson', 'text/plain',
+                          'text/html', 'text/css', 'application/javascript')
+
+
+class GzipEncoder:
+    name = 'gzip'
+
+    def __init__(self, level):
+        self.level = level
+
+    def compress(self, data):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        return compressor.compress(data) + compressor.flush()
+
+    def stream(self):
+        """(compress, flush, finish) of one incremental gzip stream"""
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        return (compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH),
+                compressor.flush)
+
+
+class ZstdEncoder:
+    name = 'zstd'
+
+    def __init__(self, level):
+        self.level = level
+        # A ZstdCompressor must not be shared between threads, keep one per thread
+        self._local = threading.local()
+
+    def compress(self, data):
+        compressor = getattr(self._local, 'compressor', None)
+        if compressor is None:
+            compressor = self._local.compressor = zstandard.ZstdCompressor(level=self.level)
+        return compressor.compress(data)
+
+    def stream(self):
+        compressor = zstandard.ZstdCompressor(level=self.level).compressobj()
+        return (compressor.compress,
+                lambda: compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK),
+                compressor.flush)
+
+
+class Compression:
+    """
+    Compresses responses with the best encoding the client accepts.
+
+    zstd (with the optional `zstandard` package) is preferred over gzip at equal quality.
+    Buffered bodies are compressed at once when they reach COMPRESSION_MIN_SIZE bytes.
+    Streamed bodies are compressed chunk by chunk: every chunk the view yields is
+    flushed as a complete compressed block, so NDJSON lines reach the client as they
+    are produced instead of waiting for the compressor's window to fill. Strong ETags
+    are weakened since the bytes now depend on the encoding.
+    """
+
+    def __init__(self):
+        self.encoders = {}
+        self.min_size = 1024
+        self.mimetypes = COMPRESSIBLE_MIMETYPES
+
+    def init_app(self, app):
+        if not app.config.get('COMPRESSION_ENABLED', True):
+            return
+        self.encoders = {'gzip': GzipEncoder(app.config.get('COMPRESSION_GZIP_LEVEL', 6))}
+        if zstandard is not None and app.config.get('COMPRESSION_ZSTD', True):
+            self.encoders['zstd'] = ZstdEncoder(app.config.get('COMPRESSION_ZSTD_LEVEL', 3))
+        self.min_size = app.config.get('COMPRESSION_MIN_SIZE', self.min_size)
+        self.mimetypes = tuple(app.config.get('COMPRESSION_MIMETYPES', self.mimetypes))
+        app.after_request(self._after_request)
+
+    def negotiate(self, accept_encodings):
+        """The encoder to use for an `Accept-Encoding` header, None for identity"""
+        best, best_quality = None, 0
+        # Iterated best first on ties, so zstd wins over gzip at the same quality
+        for name in ('zstd', 'gzip'):
+            encoder = self.encoders.get(name)
+            if encoder is None:
+                continue
+            quality = accept_encodings[name]
+            if quality > best_quality:
+                best, best_quality = encoder, quality
+        return best
+
+    def _after_request(self, response):
+        if response.mimetype not in self.mimetypes:
+            return response
+        response.vary.add('Accept-Encoding')
+        if not self._transformable(response):
+            return response
+
+        encoder = self.negotiate(request.accept_encodings)
+        if encoder is None:
+            return response
+
+        if response.is_streamed:
+            response.response = self._stream(encoder, response.response)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < self.min_size:
+                return response
+            response.set_data(encoder.compress(data))
+
+        response.headers['Content-Encoding'] = encoder.name
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
+
+    @staticmethod
+    def _transformable(response):
+        if response.status_code < 200 or response.status_code in (204, 206, 304):
+            return False
+        return 'Content-Encoding' not in response.headers and \
+            not response.cache_control.no_transform
+
+    @staticmethod
+    def _stream(encoder, chunks):
+        compress, flush, finish = encoder.stream()
+        try:
+            for chunk in chunks:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode('utf-8')
+                if chunk:
+                    yield compress(chunk) + flush()
+            yield finish()
+        finally:
+            close = getattr(chunks, 'close', None)
+            if close is not None:
+                close()
+
+
+compression = Compression()
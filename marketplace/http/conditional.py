@@ -0,0 +1,42 @@
+import hashlib
+from collections import namedtuple
+from datetime import timezone
+
+from flask import Response, request
+from werkzeug.http import http_date, quote_etag
+
+
+def is_conditional():
+    """True when the request carries If-None-Match or If-Modified-Since"""
+    return bool(request.if_none_match) or request.if_modified_since is not None
+
+
+class Validators(namedtuple('Validators', ['etag', 'last_modified'])):
+    """ETag/Last-Modified pair of a representation, derived from `updated_at` values"""
+
+    @classmethod
+    def build(cls, last_modified, *parts):
+        raw = ':'.join(str(part) for part in (last_modified,) + parts)
+        return cls(hashlib.sha1(raw.encode('utf-8')).hexdigest(), last_modified)
+
+    def matches(self):
+        """Whether the client's cached copy is still current (If-None-Match wins)"""
+        if request.if_none_match:
+            return request.if_none_match.contains_weak(self.etag)
+        since = request.if_modified_since
+        if since is None or self.last_modified is None:
+            return False
+        return self._last_modified_utc() <= since
+
+    def headers(self):
+        headers = {'ETag': quote_etag(self.etag, weak=True)}
+        if self.last_modified is not None:
+            headers['Last-Modified'] = http_date(self._last_modified_utc())
+        return headers
+
+    def not_modified(self):
+        return Response(status=304, headers=self.headers())
+
+    def _last_modified_utc(self):
+        # HTTP dates have second resolution, updated_at is naive UTC
+        return self.last_modified.replace(microsecond=0, tzinfo=timezone.utc)
@@ -0,0 +1,17 @@
+import enum
+import uuid
+from datetime import date, datetime
+from decimal import Decimal
+
+
+def json_default(value):
+    """Fallback encoder for values marshmallow leaves untouched (Decimal, Enum, ...)"""
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, enum.Enum):
+        return value.value
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
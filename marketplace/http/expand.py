@@ -0,0 +1,63 @@
+from collections import namedtuple
+
+from flask_restx import reqparse
+
+
+class Expansion(namedtuple('Expansion', ['options', 'resolve'])):
+    """
+    A related object `?expand=` can embed in a resource.
+
+    `options` are loader options (`joinedload`/`selectinload`) added to the query so the
+    related rows arrive with the page, `resolve(objs)` returns the embedded (JSON-able)
+    value of each object in `objs`, called once per page or batch rather than per row.
+    """
+
+
+class Expandable:
+    """The expansions a resource offers, and the `?expand=` parser that picks them"""
+
+    def __init__(self, **expansions):
+        self.expansions = expansions
+        self.parser = reqparse.RequestParser()
+        # reqparse checks `choices` against the whole split list, validate each name instead
+        self.parser.add_argument('expand', type=self._name, action='split', location='args',
+                                 help='Comma separated related objects to embed: {}.'.format(
+                                     ', '.join(expansions)))
+
+    def _name(self, value):
+        value = value.strip()
+        if value not in self.expansions:
+            raise ValueError("'{}' cannot be expanded".format(value))
+        return value
+
+    def requested(self):
+        """(name, Expansion) pairs asked for by the current request, in request order"""
+        names = self.parser.parse_args()['expand'] or ()
+        return [(name, self.expansions[name]) for name in dict.fromkeys(names)]
+
+
+def with_expansions(query, requested):
+    """`query` loading everything the `requested` expansions embed up front"""
+    for _, expansion in requested:
+        if expansion.options:
+            query = query.options(*expansion.options)
+    return query
+
+
+def embedded(requested, objs):
+    """
+    [(name, value), ...] to add to each object of `objs`, None when nothing was requested.
+    """
+    if not requested:
+        return None
+    columns = [[(name, value) for value in expansion.resolve(objs)]
+               for name, expansion in requested]
+    return [list(values) for values in zip(*columns)] if objs else []
+
+
+def expanded_dump(schema, obj, requested):
+    """`schema.dump(obj)` with the `requested` expansions embedded"""
+    data = schema.dump(obj)
+    for name, value in (embedded(requested, [obj]) or [[]])[0]:
+        data[name] = value
+    return data
@@ -0,0 +1,103 @@
+import hashlib
+import time
+from functools import wraps
+
+from flask import request
+
+from marketplace.http.cache import as_response, dump_response, load_response, make_backend
+from marketplace.http.ratelimit import principal
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+
+
+class Idempotency:
+    """
+    Replays the stored response of a write retried with the same `Idempotency-Key`.
+
+    A key is scoped to the principal (see marketplace.http.ratelimit) and the route, and
+    bound to a fingerprint of the request body: reusing it for a different body is a
+    422. The first request claims the key with an in-progress marker, runs the handler
+    and stores its response for IDEMPOTENCY_TTL seconds, unless it is a 5xx the client
+    should be free to retry. Duplicates arriving meanwhile wait up to
+    IDEMPOTENCY_LOCK_SECONDS for that response instead of running the handler again,
+    and take over the key if the first request died without storing anything.
+
+    Keys only dedupe across workers with a shared IDEMPOTENCY_URL (`database://`, the
+    default, or redis). `memory://` is per process, so it is refused when the app runs
+    in more than one (SERVER_PROCESSES).
+    """
+
+    POLL_INTERVAL = 0.05
+
+    def __init__(self):
+        self.backend = None
+        self.ttl = 86400
+        self.lock_seconds = 30
+
+    def init_app(self, app):
+        url = app.config.get('IDEMPOTENCY_URL', 'database://')
+        if url.startswith('memory://') and app.config.get('SERVER_PROCESSES', 1) > 1:
+            # A retry landing on another worker would run the write a second time
+            raise RuntimeError('IDEMPOTENCY_URL=memory:// is per process, use database:// '
+                               'or redis:// with SERVER_PROCESSES > 1')
+        self.backend = make_backend(url, app.config.get('IDEMPOTENCY_MAX_ENTRIES', 10000))
+        self.ttl = app.config.get('IDEMPOTENCY_TTL', self.ttl)
+        self.lock_seconds = app.config.get('IDEMPOTENCY_LOCK_SECONDS', self.lock_seconds)
+
+    def idempotent(self, f):
+        """Honor `Idempotency-Key` on a Resource write method"""
+        @wraps(f)
+        def decorated(resource, *args, **kwargs):
+            key = request.headers.get(HEADER)
+            if key is None or self.backend is None:
+                return f(resource, *args, **kwargs)
+            if not key or len(key) > MAX_KEY_LENGTH:
+                return {'message': '{} must be 1 to {} characters'.format(
+                    HEADER, MAX_KEY_LENGTH)}, 400
+            return self._serve(f, resource, args, kwargs, key)
+        return decorated
+
+    def _serve(self, f, resource, args, kwargs, key):
+        scope = '\n'.join([principal(), request.method, request.path, key])
+        key = 'idem:' + hashlib.sha1(scope.encode()).hexdigest()
+        lock_key = key + ':lock'
+        fingerprint = hashlib.sha256(request.get_data()).hexdigest().encode()
+
+        deadline = time.monotonic() + self.lock_seconds
+        while True:
+            entry = self.backend.get(key)
+            if entry is not None:
+                return self._replay(entry, fingerprint)
+            if self.backend.add(lock_key, fingerprint, self.lock_seconds):
+                break
+            holder = self.backend.get(lock_key)
+            if holder is not None and holder != fingerprint:
+                return self._mismatch()
+            if time.monotonic() >= deadline:
+                return {'message': 'A request with this {} is still in progress'.format(
+                    HEADER)}, 409
+            time.sleep(self.POLL_INTERVAL)
+
+        try:
+            response = as_response(resource, f(resource, *args, **kwargs))
+            if response.status_code < 500 and not response.is_streamed:
+                self.backend.set(key, fingerprint + b'\n' + dump_response(response), self.ttl)
+            return response
+        finally:
+            self.backend.delete(lock_key)
+
+    def _replay(self, entry, fingerprint):
+        stored, entry = entry.split(b'\n', 1)
+        if stored != fingerprint:
+            return self._mismatch()
+        response = load_response(entry)
+        response.headers['Idempotent-Replayed'] = 'true'
+        return response
+
+    @staticmethod
+    def _mismatch():
+        return {'message': '{} was already used for a different request'.format(HEADER)}, 422
+
+
+idempotency = Idempotency()
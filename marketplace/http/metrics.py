@@ -0,0 +1,349 @@
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+
+from flask import Response, g, request
+
+log = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+HISTOGRAMS = {
+    'http_request_duration_seconds': ('Time spent serving a request, until the last byte',
+                                      ('endpoint', 'method', 'status')),
+    'http_response_size_bytes': ('Size of the response body',
+                                 ('endpoint', 'method', 'status')),
+}
+GAUGES = {
+    'http_requests_in_flight': ('Requests being served right now', ('endpoint', 'method')),
+}
+
+ARCHIVE = 'archive.json'
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets, counts=None, total=0.0):
+        self.buckets = buckets
+        # Per-bucket (not cumulative) counts, the last one is +Inf
+        self.counts = counts or [0] * (len(buckets) + 1)
+        self.sum = total
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def merge(self, counts, total):
+        for i, count in enumerate(counts):
+            self.counts[i] += count
+        self.sum += total
+
+
+class Metrics:
+    """
+    Request latency, response size and in-flight metrics in Prometheus text format.
+
+    Every worker keeps its own metrics in memory. With METRICS_MULTIPROC_DIR set (one
+    directory shared by all gunicorn workers), a background thread writes a snapshot to
+    `<pid>.json` there every METRICS_FLUSH_SECONDS and `/metrics` merges the snapshots
+    of all workers: histograms are summed across every file, gauges only across workers
+    that are still alive. Snapshots of dead workers are folded into `archive.json` so
+    counts survive worker restarts without the directory growing. Without the directory
+    `/metrics` reports the serving process alone.
+    """
+
+    def __init__(self):
+        self.directory = None
+        self.flush_seconds = 1.0
+        self.buckets = {'http_request_duration_seconds': LATENCY_BUCKETS,
+                        'http_response_size_bytes': SIZE_BUCKETS}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._reset()
+
+    def init_app(self, app):
+        if not app.config.get('METRICS_ENABLED', True):
+            return
+        self.directory = app.config.get('METRICS_MULTIPROC_DIR')
+        self.flush_seconds = app.config.get('METRICS_FLUSH_SECONDS', self.flush_seconds)
+        self.buckets['http_request_duration_seconds'] = tuple(
+            app.config.get('METRICS_LATENCY_BUCKETS', LATENCY_BUCKETS))
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+        self._reset()
+
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+        app.add_url_rule('/metrics', 'metrics', self.exposition)
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._histograms = {name: {} for name in HISTOGRAMS}
+        self._gauges = {name: {} for name in GAUGES}
+        self._dirty = False
+        self._flusher = None
+
+    # Request hooks
+
+    def _before_request(self):
+        g.metrics_started = time.perf_counter()
+        g.metrics_in_flight = (request.endpoint or 'none', request.method)
+        self._add_gauge('http_requests_in_flight', g.metrics_in_flight, 1)
+
+    def _after_request(self, response):
+        labels = g.pop('metrics_in_flight', None)
+        if labels is None:
+            return response
+        started = g.pop('metrics_started')
+        status = str(response.status_code)
+
+        if not response.is_streamed:
+            self._finish(labels, status, started, response.calculate_content_length() or 0)
+            return response
+
+        # Streamed bodies are timed and measured when the server closes them, which it
+        # does whether or not they were sent to the end, or iterated at all
+        chunks = response.response
+        size = 0
+        finished = False
+
+        def counted():
+            nonlocal size
+            for chunk in chunks:
+                size += len(chunk)
+                yield chunk
+
+        def finish():
+            nonlocal finished
+            if not finished:
+                finished = True
+                self._finish(labels, status, started, size)
+
+        response.response = counted()
+        if hasattr(chunks, 'close'):
+            response.call_on_close(chunks.close)
+        response.call_on_close(finish)
+        return response
+
+    def _teardown_request(self, exc):
+        # after_request did not run (e.g. the response could not be built)
+        labels = g.pop('metrics_in_flight', None)
+        if labels is not None:
+            self._finish(labels, '500', g.pop('metrics_started'), 0)
+
+    def _finish(self, labels, status, started, size):
+        elapsed = time.perf_counter() - started
+        endpoint, method = labels
+        with self._lock:
+            self._check_pid()
+            self._observe('http_request_duration_seconds', (endpoint, method, status), elapsed)
+            self._observe('http_response_size_bytes', (endpoint, method, status), size)
+            gauges = self._gauges['http_requests_in_flight']
+            gauges[labels] = gauges.get(labels, 0) - 1
+            self._dirty = True
+        self._start_flusher()
+
+    def _observe(self, name, labels, value):
+        histogram = self._histograms[name].get(labels)
+        if histogram is None:
+            histogram = self._histograms[name][labels] = Histogram(self.buckets[name])
+        histogram.observe(value)
+
+    def _add_gauge(self, name, labels, value):
+        with self._lock:
+            self._check_pid()
+            gauges = self._gauges[name]
+            gauges[labels] = gauges.get(labels, 0) + value
+            self._dirty = True
+        self._start_flusher()
+
+    def _check_pid(self):
+        # A forked worker starts from empty metrics instead of the master's copy
+        if self._pid != os.getpid():
+            self._reset()
+
+    # Multi-process snapshots
+
+    def _start_flusher(self):
+        if not self.directory or self._flusher is not None:
+            return
+        with self._lock:
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_loop, daemon=True,
+                                                 name='metrics-flush')
+                self._flusher.start()
+
+    def _flush_loop(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            time.sleep(self.flush_seconds)
+            try:
+                self.flush()
+            except OSError as e:
+                log.warning('Could not write metrics snapshot: %s', e)
+
+    def flush(self):
+        """Write this worker's snapshot if anything changed since the last one"""
+        if not self.directory:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            snapshot = self._snapshot()
+            self._dirty = False
+        path = os.path.join(self.directory, '{}.json'.format(os.getpid()))
+        with self._flush_lock:
+            tmp = path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(snapshot, f)
+            os.replace(tmp, path)
+
+    def _snapshot(self):
+        return {
+            'histograms': _dump_histograms(self._histograms),
+            'gauges': {name: [[list(labels), value] for labels, value in series.items()]
+                       for name, series in self._gauges.items()},
+        }
+
+    def collect(self):
+        """Merged (histograms, gauges) of every worker"""
+        if not self.directory:
+            with self._lock:
+                return self._merge([self._snapshot()], [self._snapshot()])
+
+        self.flush()
+        with open(os.path.join(self.directory, '.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                archive, live = self._read_snapshots()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return self._merge([archive] + live, live)
+
+    def _read_snapshots(self):
+        """The archive and live snapshots, folding those of dead workers into the archive"""
+        archive_path = os.path.join(self.directory, ARCHIVE)
+        archive = _load(archive_path) or {'histograms': {}, 'gauges': {}}
+        live, dead = [], []
+        for filename in os.listdir(self.directory):
+            pid, ext = os.path.splitext(filename)
+            if ext != '.json' or not pid.isdigit():
+                continue
+            path = os.path.join(self.directory, filename)
+            snapshot = _load(path)
+            if snapshot is None:
+                continue
+            if _alive(int(pid)):
+                live.append(snapshot)
+            else:
+                dead.append((path, snapshot))
+
+        if dead:
+            histograms, _ = self._merge([archive] + [s for _, s in dead], [])
+            archive = {'histograms': _dump_histograms(histograms), 'gauges': {}}
+            tmp = archive_path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(archive, f)
+            os.replace(tmp, archive_path)
+            for path, _ in dead:
+                os.unlink(path)
+        return archive, live
+
+    def _merge(self, histogram_snapshots, gauge_snapshots):
+        histograms = {name: {} for name in HISTOGRAMS}
+        for snapshot in histogram_snapshots:
+            for name, series in snapshot['histograms'].items():
+                if name not in histograms:
+                    continue
+                for labels, counts, total in series:
+                    if len(counts) != len(self.buckets[name]) + 1:
+                        continue  # taken with other buckets than the current ones
+                    labels = tuple(labels)
+                    histogram = histograms[name].get(labels)
+                    if histogram is None:
+                        histograms[name][labels] = Histogram(self.buckets[name],
+                                                             list(counts), total)
+                    else:
+                        histogram.merge(counts, total)
+
+        gauges = {name: {} for name in GAUGES}
+        for snapshot in gauge_snapshots:
+            for name, series in snapshot['gauges'].items():
+                if name not in gauges:
+                    continue
+                for labels, value in series:
+                    labels = tuple(labels)
+                    gauges[name][labels] = gauges[name].get(labels, 0) + value
+        return histograms, gauges
+
+    # Exposition
+
+    def exposition(self):
+        histograms, gauges = self.collect()
+        lines = []
+        for name, (help_text, label_names) in HISTOGRAMS.items():
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} histogram'.format(name))
+            for labels, histogram in sorted(histograms[name].items()):
+                base = list(zip(label_names, labels))
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(
+                        name, _labels(base + [('le', _number(bound))]), cumulative))
+                lines.append('{}_sum{} {}'.format(name, _labels(base), _number(histogram.sum)))
+                lines.append('{}_count{} {}'.format(name, _labels(base), cumulative))
+        for name, (help_text, label_names) in GAUGES.items():
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} gauge'.format(name))
+            for labels, value in sorted(gauges[name].items()):
+                lines.append('{}{} {}'.format(
+                    name, _labels(zip(label_names, labels)), _number(value)))
+        return Response('\n'.join(lines) + '\n', content_type=CONTENT_TYPE)
+
+
+def _dump_histograms(histograms):
+    return {name: [[list(labels), list(h.counts), h.sum] for labels, h in series.items()]
+            for name, series in histograms.items()}
+
+
+def _labels(pairs):
+    escaped = ('{}="{}"'.format(key, str(value).replace('\\', r'\\').replace('"', r'\"')
+                                .replace('\n', r'\n')) for key, value in pairs)
+    return '{' + ','.join(escaped) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _load(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+metrics = Metrics()
@@ -0,0 +1,134 @@
+import base64
+import binascii
+import json
+from collections import namedtuple
+from datetime import datetime
+
+from flask import current_app
+from flask_restx import abort, reqparse
+from sqlalchemy import func, literal, tuple_
+
+from marketplace.http.conditional import Validators
+from marketplace.http.encoding import json_default
+
+pagination_parser = reqparse.RequestParser()
+pagination_parser.add_argument('limit', type=int, location='args',
+                               help='Maximum number of items to return')
+pagination_parser.add_argument('cursor', type=str, location='args',
+                               help='Opaque cursor taken from a previous `next_cursor`')
+
+Page = namedtuple('Page', ['items', 'next_cursor', 'validators'], defaults=[None])
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(values):
+    """Pack the sort key of the last row into an opaque, URL-safe token"""
+    raw = json.dumps(list(values), default=json_default, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).rstrip(b'=').decode('ascii')
+
+
+def decode_cursor(cursor, keys):
+    """Reverse of `encode_cursor`, coercing each value back to its key column type"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except (binascii.Error, UnicodeError, ValueError) as e:
+        raise InvalidCursor(str(e))
+
+    if not isinstance(values, list) or len(values) != len(keys):
+        raise InvalidCursor('cursor does not match the sort key')
+
+    # Crafted cursors may hold any JSON type, UUID() given a number raises AttributeError
+    try:
+        return tuple(_coerce(key, value) for key, value in zip(keys, values))
+    except (TypeError, ValueError, AttributeError) as e:
+        raise InvalidCursor(str(e))
+
+
+def _coerce(key, value):
+    python_type = key.type.python_type
+    if python_type is datetime:
+        return datetime.fromisoformat(value)
+    return python_type(value)
+
+
+def _row_key(row, keys):
+    return tuple(getattr(row, key.key) for key in keys)
+
+
+def _window(query, keys, cursor, limit, descending):
+    """`query` narrowed to the rows of one page, plus the one that tells if more follow"""
+    default_limit = current_app.config.get('PAGINATION_DEFAULT_LIMIT', 50)
+    max_limit = current_app.config.get('PAGINATION_MAX_LIMIT', 500)
+    limit = min(max(limit or default_limit, 1), max_limit)
+
+    if cursor:
+        try:
+            values = decode_cursor(cursor, keys)
+        except InvalidCursor:
+            abort(400, 'Invalid cursor')
+        position = tuple_(*keys)
+        boundary = tuple_(*[literal(value, key.type) for key, value in zip(keys, values)])
+        query = query.filter(position < boundary if descending else position > boundary)
+
+    order_by = [key.desc() if descending else key.asc() for key in keys]
+    return query.order_by(*order_by).limit(limit + 1), limit
+
+
+def paginate(query, keys, cursor=None, limit=None, descending=False, row_key=_row_key,
+             updated_at=None, fields=None):
+    """
+    Keyset pagination over `keys` (e.g. `(Model.created_at, Model.id)`).
+
+    The page is located with a row-value comparison against the last key of the previous
+    page, so with a matching composite index every page costs the same index range scan
+    no matter how deep the client is.
+
+    With `updated_at`, the page also carries the validators `page_validators` computes
+    for it, taken from the loaded rows (`fields` being the requested sparse fieldset).
+
+    :return: Page(items, next_cursor, validators), `next_cursor` is None on the last page
+    """
+    window, limit = _window(query, keys, cursor, limit, descending)
+    rows = window.all()
+
+    validators = None
+    if updated_at is not None:
+        modified = [getattr(row, updated_at.key) for row in rows]
+        positions = [getattr(row, keys[0].key) for row in rows]
+        validators = _validators(max(filter(None, modified), default=None), len(rows),
+                                 max(positions, default=None), fields)
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(row_key(rows[-1], keys))
+
+    return Page(rows, next_cursor, validators)
+
+
+def page_validators(query, keys, updated_at, fields=None, cursor=None, limit=None,
+                    descending=False):
+    """
+    ETag/Last-Modified of the page `paginate` would return, from the row count and
+    max(updated_at) of the same keyset window, without loading or dumping the rows: one
+    aggregate query, only worth it to answer a conditional request with a 304.
+    The window's last key is folded in so rows shifting into the page are noticed too,
+    and the sparse fieldset since it changes the representation.
+    """
+    window, _ = _window(query, keys, cursor, limit, descending)
+    rows = window.with_entities(updated_at.label('updated_at'),
+                                keys[0].label('position')).subquery()
+    count, last_modified, position = query.session.query(
+        func.count(), func.max(rows.c.updated_at), func.max(rows.c.position)
+    ).one()
+    return _validators(last_modified, count, position, fields)
+
+
+def _validators(last_modified, count, position, fields):
+    # Over the window of `limit + 1` rows, so a row appearing after the page (which
+    # changes `next_cursor`) changes the ETag too
+    return Validators.build(last_modified, count, position, ','.join(fields or ()))
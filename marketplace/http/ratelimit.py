@@ -0,0 +1,258 @@
+import hashlib
+import math
+import mmap
+import multiprocessing
+import re
+import struct
+import threading
+import time
+from collections import namedtuple
+
+import jwt
+from flask import current_app, g, jsonify, request
+from flask_restx import Resource
+
+from marketplace.auth.principal_cache import principal_cache
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+LIMIT_PATTERN = re.compile(r'^\s*(\d+)\s*(?:/|per)\s*(\d+)?\s*(second|minute|hour|day)s?\s*$')
+
+
+class Limit(namedtuple('Limit', ['count', 'period', 'text'])):
+    """`count` requests per `period` seconds, a token bucket refilling one every `interval`"""
+
+    @property
+    def interval(self):
+        return self.period / self.count
+
+
+def parse_limits(text):
+    """Limits of a `'10 per minute; 100 per hour'` string, all of them apply"""
+    limits = []
+    for part in filter(None, (part.strip() for part in text.split(';'))):
+        match = LIMIT_PATTERN.match(part.lower())
+        if match is None or int(match.group(1)) < 1:
+            raise ValueError('Invalid rate limit: {!r}'.format(part))
+        count, multiple, unit = match.groups()
+        limits.append(Limit(int(count), int(multiple or 1) * PERIODS[unit], part))
+    return limits
+
+
+def gcra(tat, now, interval, burst):
+    """
+    One token bucket decision, with the bucket stored as its theoretical arrival time
+    (`tat`): the instant it would be full again, 0 for a new bucket.
+
+    :return: (new tat or None when rejected, seconds until a token is available)
+    """
+    tat = max(tat, now)
+    allow_at = tat - (burst - 1) * interval
+    if allow_at > now:
+        return None, allow_at - now
+    return tat + interval, 0.0
+
+
+SLOT = struct.Struct('Qd')
+
+
+class BucketTable:
+    """
+    Fixed-size open-addressing table of buckets: (64-bit key hash, tat) slots.
+
+    `shared` tables live in anonymous shared memory and are guarded by process-shared
+    locks, so gunicorn workers forked after it was created (`preload_app`) all see the
+    same buckets. Slots are split in stripes with a lock each, and a key is looked for
+    in PROBES slots of its stripe. When they are all taken by other keys the one
+    closest to full is reused, which can only ever make a limit more lenient.
+    """
+
+    PROBES = 4
+
+    def __init__(self, slots=65536, stripes=64, shared=False):
+        self.stripes = stripes
+        self.per_stripe = max(slots // stripes, self.PROBES)
+        size = SLOT.size * self.per_stripe * stripes
+        if shared:
+            self._memory = mmap.mmap(-1, size)
+            self._locks = [multiprocessing.Lock() for _ in range(stripes)]
+        else:
+            self._memory = bytearray(size)
+            self._locks = [threading.Lock() for _ in range(stripes)]
+
+    def hit(self, key, limit, now):
+        """Take a token from the bucket of `key` (a non-zero int), see `gcra`"""
+        stripe = key % self.stripes
+        base = stripe * self.per_stripe
+        start = key // self.stripes
+        memory = self._memory
+        with self._locks[stripe]:
+            offset, oldest, tat = None, math.inf, 0.0
+            for probe in range(self.PROBES):
+                candidate = (base + (start + probe) % self.per_stripe) * SLOT.size
+                slot_key, slot_tat = SLOT.unpack_from(memory, candidate)
+                if slot_key == key:
+                    offset, tat = candidate, slot_tat
+                    break
+                if slot_tat < oldest:
+                    offset, oldest = candidate, slot_tat
+            new_tat, retry_after = gcra(tat, now, limit.interval, limit.count)
+            if new_tat is not None:
+                SLOT.pack_into(memory, offset, key, new_tat)
+                return True, int((now + limit.period - new_tat) / limit.interval)
+            return False, retry_after
+
+
+def make_storage(url, slots=65536):
+    scheme = url.split('://', 1)[0]
+    if scheme == 'null':
+        return None
+    if scheme == 'memory':
+        return BucketTable(slots)
+    if scheme == 'shm':
+        return BucketTable(slots, shared=True)
+    raise ValueError('Unsupported RATELIMIT_STORAGE_URL: {}'.format(url))
+
+
+def client_address():
+    """The client IP, read from the X-Forwarded-For entries of RATELIMIT_PROXY_COUNT proxies"""
+    proxies = current_app.config.get('RATELIMIT_PROXY_COUNT', 0)
+    if proxies:
+        forwarded = [address.strip()
+                     for address in request.headers.get('X-Forwarded-For', '').split(',')]
+        if len(forwarded) >= proxies and forwarded[-proxies]:
+            return forwarded[-proxies]
+    return request.remote_addr or ''
+
+
+def principal():
+    """
+    Who a request counts against: the user of a valid bearer token, otherwise the client
+    address, so made-up tokens cannot buy fresh buckets.
+    """
+    header = request.headers.get('Authorization', '')
+    token = header[7:] if header.startswith('Bearer ') else None
+    if token:
+        cached = principal_cache.get(token)
+        if cached is not None:
+            return 'user:{}'.format(cached[0])
+        try:
+            payload = jwt.decode(token, current_app.config.get('SECRET_KEY'),
+                                 algorithms=['HS256'])
+            return 'user:{}'.format(payload['sub'])
+        except (jwt.InvalidTokenError, KeyError):
+            pass
+    return 'ip:' + client_address()
+
+
+class RateLimiter:
+    """
+    Token bucket rate limits per route and per principal.
+
+    Every API resource method is limited by RATELIMIT_DEFAULT unless it names its own
+    limits with `limit()` or opts out with `exempt`. Views outside the API (metrics,
+    Swagger) are not limited. A rejected request gets a 429 with `Retry-After`, allowed
+    ones carry the `X-RateLimit-*` headers of their tightest limit. Each decision is
+    a hash and one bucket update under a striped lock, in shared memory with the
+    `shm://` storage.
+    """
+
+    def __init__(self):
+        self.storage = None
+        self._routes = {}
+        self._limits = {}
+
+    def init_app(self, app):
+        self._routes = {}
+        self._limits = {}
+        if not app.config.get('RATELIMIT_ENABLED', True):
+            self.storage = None
+            return
+        self.storage = make_storage(app.config.get('RATELIMIT_STORAGE_URL', 'memory://'),
+                                    app.config.get('RATELIMIT_SLOTS', 65536))
+        # Parsed now so a typo fails at startup rather than on the first request
+        self._config_limits(app.config, 'RATELIMIT_DEFAULT')
+        if 'rate_limiter' not in app.extensions:
+            app.extensions['rate_limiter'] = self
+            app.before_request(self._before_request)
+            app.after_request(self._after_request)
+
+    @staticmethod
+    def limit(name, key=None):
+        """
+        Limit a Resource method by the limits of config value `name` instead of the
+        default, counted per `key()` (default: `principal()`). Stackable.
+        """
+        def decorator(f):
+            f.rate_limits = [(name, key)] + list(getattr(f, 'rate_limits', None) or [])
+            return f
+        return decorator
+
+    @staticmethod
+    def exempt(f):
+        f.rate_limits = []
+        return f
+
+    def _config_limits(self, config, name):
+        text = config.get(name) or ''
+        limits = self._limits.get(text)
+        if limits is None:
+            limits = self._limits[text] = parse_limits(text)
+        return limits
+
+    def _route_limits(self):
+        route = (request.endpoint, request.method)
+        limits = self._routes.get(route)
+        if limits is None:
+            resource = getattr(current_app.view_functions.get(request.endpoint),
+                               'view_class', None)
+            method = getattr(resource, request.method.lower(), None)
+            if method is None or not issubclass(resource, Resource) or \
+                    not resource.__module__.startswith('marketplace.'):
+                limits = []
+            else:
+                limits = getattr(method, 'rate_limits', None)
+                if limits is None:
+                    limits = [('RATELIMIT_DEFAULT', None)]
+            limits = self._routes[route] = [(self._config_limits(current_app.config, name), key)
+                                            for name, key in limits]
+        return limits
+
+    def _before_request(self):
+        if self.storage is None or request.endpoint is None:
+            return None
+        route_limits = self._route_limits()
+        if not route_limits:
+            return None
+
+        now = time.monotonic()
+        tightest = None
+        for limits, key in route_limits:
+            who = (key or principal)()
+            for limit in limits:
+                bucket = hashlib.blake2b('{}|{}|{}|{}'.format(
+                    request.endpoint, request.method, who, limit.text).encode(),
+                    digest_size=8).digest()
+                allowed, value = self.storage.hit(
+                    int.from_bytes(bucket, 'little') | 1, limit, now)
+                if not allowed:
+                    response = jsonify(message='Too many requests')
+                    response.status_code = 429
+                    response.headers['Retry-After'] = str(max(math.ceil(value), 1))
+                    response.headers['X-RateLimit-Limit'] = limit.text
+                    response.headers['X-RateLimit-Remaining'] = '0'
+                    return response
+                if tightest is None or value < tightest[1]:
+                    tightest = (limit, value)
+        g.rate_limit = tightest
+        return None
+
+    @staticmethod
+    def _after_request(response):
+        tightest = g.pop('rate_limit', None)
+        if tightest is not None:
+            response.headers['X-RateLimit-Limit'] = tightest[0].text
+            response.headers['X-RateLimit-Remaining'] = str(tightest[1])
+        return response
+
+
+limiter = RateLimiter()
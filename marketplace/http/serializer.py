@@ -0,0 +1,161 @@
+import enum
+import json
+import uuid
+from datetime import date, datetime
+from decimal import Decimal
+from json.encoder import c_make_encoder, encode_basestring_ascii
+
+from flask import Response, current_app
+from flask_restx.representations import output_json
+from sqlalchemy import inspect
+
+from marketplace.http.encoding import json_default
+
+if c_make_encoder is not None:
+    # One reusable C encoder with json.dumps' settings, saves building it on every call
+    _c_encoder = c_make_encoder(None, json_default, encode_basestring_ascii, None,
+                                ': ', ', ', False, False, True)
+
+    def _encode(value):
+        return ''.join(_c_encoder(value, 0))
+else:
+    _encode = json.JSONEncoder(default=json_default).encode
+
+_UNLOADED = object()
+
+
+def _quoted(value):
+    return '"{}"'.format(value)
+
+
+def _isoformat(value):
+    return '"{}"'.format(value.isoformat())
+
+
+def _enum(value):
+    return _encode(value.value)
+
+
+# JSON text of a value of exactly this type, as marshmallow's inferred fields followed by
+# json.dumps(..., default=json_default) would render it
+CONVERTERS = {
+    str: encode_basestring_ascii,
+    int: int.__repr__,
+    bool: lambda value: 'true' if value else 'false',
+    uuid.UUID: _quoted,
+    Decimal: _quoted,
+    datetime: _isoformat,
+    date: _isoformat,
+}
+
+
+def _column_type(model, name):
+    """Python type the mapped column `name` loads as, None when unknown"""
+    column = inspect(model).columns.get(name)
+    if column is None:
+        return None
+    try:
+        return column.type.python_type
+    except NotImplementedError:
+        return None
+
+
+class CompiledSerializer:
+    """
+    JSON writer generated once from a marshmallow schema's `Meta.fields`.
+
+    Every dumped field gets its quoted key and a converter chosen from the mapped column
+    type up front, so serializing a row is a flat loop of reads from the instance
+    `__dict__` (skipping the ORM attribute descriptors, unloaded attributes fall back to
+    `getattr`) and string conversions, instead of a field-by-field `dump()` and a
+    second `json.dumps` pass over the result. Values of any other type (e.g. pending
+    objects not yet coerced by the database) go through the schema field itself, so
+    the output is always byte-for-byte `json.dumps(schema.dump(obj), default=json_default)`.
+    """
+
+    def __init__(self, schema):
+        self.schema = schema
+        model = schema.Meta.model
+        self._fields = []
+        for i, (name, field) in enumerate(schema.dump_fields.items()):
+            expected = _column_type(model, field.attribute or name)
+            if expected is not None and issubclass(expected, enum.Enum):
+                convert = _enum
+            else:
+                convert = CONVERTERS.get(expected, _encode)
+            prefix = ('{' if i == 0 else ', ') + encode_basestring_ascii(name) + ': '
+            self._fields.append((prefix, field.attribute or name, expected, convert,
+                                 name, field))
+
+    def dumps(self, obj, extra=None):
+        """JSON text of a single object, followed by the (key, value) pairs of `extra`"""
+        if not self._fields:
+            return '{}'
+        parts = []
+        state = getattr(obj, '__dict__', {})
+        for prefix, attribute, expected, convert, name, field in self._fields:
+            value = state.get(attribute, _UNLOADED)
+            if value is _UNLOADED:
+                value = getattr(obj, attribute)
+            if value is None:
+                parts.append(prefix + 'null')
+            elif value.__class__ is expected:
+                parts.append(prefix + convert(value))
+            else:
+                parts.append(prefix + _encode(field.serialize(name, obj)))
+        for name, value in extra or ():
+            parts.append(', ' + encode_basestring_ascii(name) + ': ' + _encode(value))
+        parts.append('}')
+        return ''.join(parts)
+
+    def dumps_many(self, objs, extras=None):
+        """JSON text of a list of objects, `extras` holds each one's additional pairs"""
+        if extras is None:
+            return '[' + ', '.join([self.dumps(obj) for obj in objs]) + ']'
+        return '[' + ', '.join([self.dumps(obj, extra)
+                                for obj, extra in zip(objs, extras)]) + ']'
+
+
+_compiled = {}
+
+
+def compiled(schema):
+    """The CompiledSerializer of `schema`, built on first use"""
+    key = (type(schema), tuple(sorted(schema.only or ())), tuple(sorted(schema.exclude)))
+    serializer = _compiled.get(key)
+    if serializer is None:
+        serializer = _compiled[key] = CompiledSerializer(schema)
+    return serializer
+
+
+def page_response(schema, page, headers=None, extras=None):
+    """
+    A keyset `page` as the `{"items": [...], "next_cursor": ...}` JSON response, written
+    straight from the compiled serializer of `schema` (same bytes flask-restx would send).
+    `extras` are additional (key, value) pairs per item, see marketplace.http.expand.
+    The validators of the page, if it carries any, are sent along with `headers`.
+
+    The compiled serializer only writes compact JSON, with any other RESTX_JSON settings
+    (or the indent flask-restx adds in debug mode) the page is dumped through the schema
+    and flask-restx's own `output_json` instead.
+    """
+    if page.validators is not None:
+        headers = dict(headers or {}, **page.validators.headers())
+    if not _compact_json():
+        items = schema.dump(page.items, many=True)
+        if extras is not None:
+            items = [dict(item, **dict(extra or ())) for item, extra in zip(items, extras)]
+        response = output_json({'items': items, 'next_cursor': page.next_cursor}, 200, headers)
+        response.mimetype = 'application/json'
+        return response
+    body = '{{"items": {}, "next_cursor": {}}}\n'.format(
+        compiled(schema).dumps_many(page.items, extras), _encode(page.next_cursor))
+    return Response(body, status=200, headers=headers, mimetype='application/json')
+
+
+def _compact_json():
+    """Whether flask-restx would write what the compiled serializer does, see output_json"""
+    settings = dict(current_app.config.get('RESTX_JSON', {}))
+    if current_app.debug:
+        settings.setdefault('indent', 4)
+    return settings == {'default': json_default}
@@ -0,0 +1,54 @@
+from flask_restx import reqparse
+from sqlalchemy.orm import load_only
+
+
+class Fieldset:
+    """
+    The `?fields=` sparse fieldset of a schema: the parser that reads it, the query
+    option that only loads the chosen columns and the narrowed schema that dumps them.
+    """
+
+    def __init__(self, schema):
+        self.base = schema
+        self.model = schema.Meta.model
+        self.names = tuple(schema.Meta.fields)
+        self._schemas = {}
+        self.parser = reqparse.RequestParser()
+        self.parser.add_argument('fields', type=self._name, action='split', location='args',
+                                 help='Comma separated fields to return, all by default: '
+                                      '{}.'.format(', '.join(self.names)))
+
+    def _name(self, value):
+        value = value.strip()
+        if value not in self.names:
+            raise ValueError("'{}' is not a field".format(value))
+        return value
+
+    def requested(self):
+        """Fields asked for by the current request in schema order, None for all"""
+        names = self.parser.parse_args()['fields']
+        if not names:
+            return None
+        chosen = set(names)
+        return tuple(name for name in self.names if name in chosen)
+
+    def restrict(self, query, fields, *keys):
+        """
+        `query` selecting only the columns of `fields`, plus the `keys` columns the
+        caller reads itself (pagination keys, updated_at for validators). The primary
+        key is always loaded. Expressions among `keys` (e.g. a search rank) are skipped.
+        """
+        if fields is None:
+            return query
+        columns = [getattr(self.model, name) for name in fields]
+        columns += [key for key in keys if getattr(key, 'class_', None) is self.model]
+        return query.options(load_only(*columns))
+
+    def schema(self, fields):
+        """The schema dumping only `fields`, the full schema for None"""
+        if fields is None:
+            return self.base
+        schema = self._schemas.get(fields)
+        if schema is None:
+            schema = self._schemas[fields] = type(self.base)(only=fields)
+        return schema
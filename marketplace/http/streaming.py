@@ -0,0 +1,71 @@
+import json
+from itertools import islice
+
+from flask import Response, current_app, request, stream_with_context
+from flask_restx import inputs, reqparse
+
+from marketplace.http.encoding import json_default
+from marketplace.http.expand import embedded
+from marketplace.http.serializer import compiled
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+stream_parser = reqparse.RequestParser()
+stream_parser.add_argument('stream', type=inputs.boolean, location='args',
+                           help='Stream every row as NDJSON (same as Accept: '
+                                'application/x-ndjson)')
+
+
+def wants_ndjson():
+    """True when the client asked for a streamed NDJSON body instead of a JSON page"""
+    if request.args.get('stream', '').lower() in ('1', 'true', 'yes'):
+        return True
+    best = request.accept_mimetypes.best_match(['application/json', NDJSON_MIMETYPE])
+    return best == NDJSON_MIMETYPE
+
+
+def ndjson_response(objects, chunk_size=1000):
+    """Stream JSON-able `objects` as NDJSON, writing `chunk_size` lines per chunk"""
+    lines = (json.dumps(obj, default=json_default) for obj in objects)
+    return ndjson_lines_response(lines, chunk_size)
+
+
+def ndjson_lines_response(lines, chunk_size=1000):
+    """Stream already encoded JSON `lines`, `chunk_size` lines per chunk"""
+    def generate():
+        chunk = []
+        for line in lines:
+            chunk.append(line)
+            if len(chunk) >= chunk_size:
+                yield '\n'.join(chunk) + '\n'
+                chunk = []
+        if chunk:
+            yield '\n'.join(chunk) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE)
+
+
+def stream_ndjson(query, schema, expand=None):
+    """
+    Stream `query` as newline-delimited JSON, one schema-dumped row per line.
+
+    Rows are fetched from a server-side cursor `STREAM_YIELD_PER` at a time and written
+    out in chunks of the same size, so peak memory is bounded by a single batch no matter
+    how large the result is. `expand` expansions are resolved once per batch.
+    """
+    batch_size = current_app.config.get('STREAM_YIELD_PER', 1000)
+    rows = query.yield_per(batch_size)
+    dumps = compiled(schema).dumps
+    if not expand:
+        return ndjson_lines_response((dumps(row) for row in rows), batch_size)
+
+    def lines():
+        rows_left = iter(rows)
+        while True:
+            batch = list(islice(rows_left, batch_size))
+            if not batch:
+                return
+            for row, extra in zip(batch, embedded(expand, batch)):
+                yield dumps(row, extra)
+
+    return ndjson_lines_response(lines(), batch_size)
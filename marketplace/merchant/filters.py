@@ -0,0 +1,36 @@
+import re
+
+from flask_restx import reqparse
+from sqlalchemy import func
+
+from marketplace.persistence.model import Merchant
+
+merchant_filter_parser = reqparse.RequestParser()
+merchant_filter_parser.add_argument('city', location='args', help='Only merchants in this city')
+merchant_filter_parser.add_argument('owner_id', type=int, location='args',
+                                    help='Only merchants of this owner')
+merchant_filter_parser.add_argument('name_prefix', location='args',
+                                    help='Merchants whose name starts with this, ignoring case')
+
+_LIKE_SPECIAL = re.compile(r'[\\%_]')
+
+
+def filter_merchants(query, args):
+    """
+    Narrow a Merchant query with the `merchant_filter_parser` arguments.
+
+    `city` and `owner_id` use (column, created_at, id) composites declared on Merchant so
+    a filtered keyset page stays an index range scan. `name_prefix` is a LIKE on
+    `lower(name)` with the user's wildcards escaped, which the `text_pattern_ops`
+    expression index serves as a range scan.
+    """
+    if args.get('city'):
+        query = query.filter(Merchant.city == args['city'])
+    if args.get('owner_id') is not None:
+        query = query.filter(Merchant.owner_id == args['owner_id'])
+    if args.get('name_prefix'):
+        # One literal 'prefix%' pattern (not `startswith`'s `:prefix || '%'`), so the planner
+        # sees a constant prefix it can turn into an index range
+        pattern = _LIKE_SPECIAL.sub(r'\\\g<0>', args['name_prefix'].lower()) + '%'
+        query = query.filter(func.lower(Merchant.name).like(pattern, escape='\\'))
+    return query
@@ -0,0 +1,72 @@
+from datetime import datetime
+
+from sqlalchemy import delete, event, func, inspect, literal, select
+from sqlalchemy.dialects.postgresql import insert
+
+from marketplace import db
+from marketplace.persistence.model import Merchant, MerchantCityStats
+
+stats_table = MerchantCityStats.__table__
+
+
+def _key(city):
+    return city if city is not None else ''
+
+
+def adjust(connection, city, delta):
+    """Add `delta` to the merchant count of `city`, in the transaction of `connection`"""
+    statement = insert(stats_table).values(city=_key(city), merchant_count=delta,
+                                           updated_at=datetime.utcnow())
+    connection.execute(statement.on_conflict_do_update(
+        index_elements=[stats_table.c.city],
+        set_={'merchant_count': stats_table.c.merchant_count + statement.excluded.merchant_count,
+              'updated_at': statement.excluded.updated_at}))
+
+
+def rebuild(connection):
+    """Recount every city from the merchants table, e.g. after a COPY or a migration"""
+    connection.execute(delete(stats_table))
+    city = func.coalesce(Merchant.city, '')
+    counts = select(city, func.count(Merchant.id), literal(datetime.utcnow())).group_by(city)
+    connection.execute(stats_table.insert().from_select(
+        ['city', 'merchant_count', 'updated_at'], counts))
+
+
+def city_counts():
+    """(city, count) of every city with merchants, the most merchants first"""
+    rows = db.session.execute(
+        select(MerchantCityStats.city, MerchantCityStats.merchant_count)
+        .where(MerchantCityStats.merchant_count > 0)
+        .order_by(MerchantCityStats.merchant_count.desc(), MerchantCityStats.city))
+    return [(city or None, count) for city, count in rows]
+
+
+# The counters move in the same transaction as the merchant rows, so they can never
+# drift from a committed state. A merchant write only locks the counter row of its city.
+
+@event.listens_for(Merchant, 'after_insert')
+def _count_insert(mapper, connection, target):
+    adjust(connection, target.city, 1)
+
+
+@event.listens_for(Merchant, 'before_delete')
+def _count_delete(mapper, connection, target):
+    adjust(connection, target.city, -1)
+
+
+@event.listens_for(Merchant.city, 'set', active_history=True)
+def _load_previous_city(target, value, oldvalue, initiator):
+    # Registered for `active_history` alone: the previous city is loaded on assignment
+    # even when expired, so the update below can take the merchant out of its count
+    pass
+
+
+@event.listens_for(Merchant, 'after_update')
+def _count_update(mapper, connection, target):
+    history = inspect(target).attrs.city.history
+    if not history.has_changes():
+        return
+    for city in history.deleted:
+        adjust(connection, city, -1)
+    for city in history.added:
+        adjust(connection, city, 1)
@@ -3,7 +3,17 @@ from flask_restx import Resource, Namespace, fields
 
 from marketplace import db
 from marketplace.auth.utils import token_required
-from marketplace.merchant.v1.serializers import merchant_schema, merchants_schema
+from marketplace.http.cache import response_cache
+from marketplace.http.conditional import Validators, is_conditional
+from marketplace.http.expand import embedded, expanded_dump, with_expansions
+from marketplace.http.idempotency import idempotency
+from marketplace.http.pagination import page_validators, paginate, pagination_parser
+from marketplace.http.serializer import page_response
+from marketplace.http.streaming import stream_ndjson, stream_parser, wants_ndjson
+from marketplace.merchant import stats
+from marketplace.merchant.filters import filter_merchants, merchant_filter_parser
+from marketplace.merchant.v1.serializers import (merchant_expand, merchant_fields,
+                                                 merchant_schema)
 from marketplace.persistence.model import Merchant
 
 # Create namespace
@@ -26,22 +36,61 @@ merchant_response = merchant_ns.model('MerchantResponse', {
     'updated_at': fields.DateTime(description='Last update date')
 })
 
+merchant_page_response = merchant_ns.model('MerchantPage', {
+    'items': fields.List(fields.Nested(merchant_response)),
+    'next_cursor': fields.String(description='Cursor of the next page, null on the last page')
+})
+
+city_stats_response = merchant_ns.model('MerchantCityStats', {
+    'city': fields.String(description='City, null for merchants without one'),
+    'merchant_count': fields.Integer(description='Merchants in the city')
+})
+
+merchant_stats_response = merchant_ns.model('MerchantStats', {
+    'items': fields.List(fields.Nested(city_stats_response)),
+    'total': fields.Integer(description='Merchants in every city')
+})
+
 
 @merchant_ns.route('/')
 class MerchantList(Resource):
     @merchant_ns.doc('list_merchants')
-    @merchant_ns.response(200, 'Success', [merchant_response])
+    @merchant_ns.response(200, 'Success', merchant_page_response)
+    @merchant_ns.expect(pagination_parser, stream_parser, merchant_filter_parser,
+                        merchant_expand.parser, merchant_fields.parser)
+    @response_cache.cached('merchants', 'users')
     def get(self):
-        """List all merchants"""
-        merchants = Merchant.query.all()
-        return merchants_schema.dump(merchants)
+        """List merchants, one keyset page at a time"""
+        keys = (Merchant.created_at, Merchant.id)
+        query = filter_merchants(Merchant.query, merchant_filter_parser.parse_args())
+        expand = merchant_expand.requested()
+        fields = merchant_fields.requested()
+        selected = merchant_fields.restrict(with_expansions(query, expand), fields,
+                                            Merchant.updated_at, *keys)
+        schema = merchant_fields.schema(fields)
+        if wants_ndjson():
+            return stream_ndjson(selected.order_by(*keys), schema, expand)
+
+        args = pagination_parser.parse_args()
+        # Embedded objects change without touching these rows, expanded pages carry no
+        # validators
+        updated_at = None if expand else Merchant.updated_at
+        if updated_at is not None and is_conditional():
+            validators = page_validators(query, keys, updated_at, fields, **args)
+            if validators.matches():
+                return validators.not_modified()
+
+        page = paginate(selected, keys, updated_at=updated_at, fields=fields, **args)
+        return page_response(schema, page, extras=embedded(expand, page.items))
 
     @merchant_ns.doc('create_merchant')
     @merchant_ns.expect(merchant_model)
     @merchant_ns.response(201, 'Merchant created', merchant_response)
     @merchant_ns.response(400, 'Validation error')
+    @merchant_ns.param('Idempotency-Key', 'Replays the first response to retries', _in='header')
     @merchant_ns.doc(security='apikey')
     @token_required
+    @idempotency.idempotent
     def post(self, current_user):
         """Create a new merchant (Auth required)"""
         data = request.get_json()
@@ -58,23 +107,58 @@ class MerchantList(Resource):
 
         try:
             merchant.save()
+            response_cache.invalidate('merchants')
             return merchant_schema.dump(merchant), 201
         except Exception as e:
             return {'message': str(e)}, 400
 
 
+@merchant_ns.route('/stats')
+class MerchantStats(Resource):
+    @merchant_ns.doc('merchant_stats')
+    @merchant_ns.response(200, 'Success', merchant_stats_response)
+    @response_cache.cached('merchants')
+    def get(self):
+        """Merchant counts per city"""
+        counts = stats.city_counts()
+        return {
+            'items': [{'city': city, 'merchant_count': count} for city, count in counts],
+            'total': sum(count for _, count in counts),
+        }
+
+
 @merchant_ns.route('/<int:id>')
 @merchant_ns.param('id', 'The merchant identifier')
 class MerchantResource(Resource):
     @merchant_ns.doc('get_merchant')
     @merchant_ns.response(200, 'Success', merchant_response)
+    @merchant_ns.response(304, 'Not modified')
     @merchant_ns.response(404, 'Merchant not found')
+    @merchant_ns.expect(merchant_expand.parser, merchant_fields.parser)
+    @response_cache.cached('merchant:{id}', 'users')
     def get(self, id):
         """Get a merchant by ID"""
-        merchant = Merchant.query.get(id)
+        expand = merchant_expand.requested()
+        fields = merchant_fields.requested()
+        if is_conditional() and not expand:
+            # Revalidate against updated_at alone, the row is only loaded when it changed
+            updated = db.session.query(Merchant.updated_at).filter(Merchant.id == id).first()
+            if updated is not None:
+                validators = Validators.build(updated.updated_at, 'merchant', id,
+                                              ','.join(fields or ()))
+                if validators.matches():
+                    return validators.not_modified()
+
+        query = merchant_fields.restrict(with_expansions(Merchant.query, expand), fields,
+                                         Merchant.updated_at)
+        merchant = query.get(id)
         if not merchant:
             return {'message': 'Merchant not found'}, 404
-        return merchant_schema.dump(merchant)
+        schema = merchant_fields.schema(fields)
+        if expand:
+            return expanded_dump(schema, merchant, expand)
+        validators = Validators.build(merchant.updated_at, 'merchant', id, ','.join(fields or ()))
+        return schema.dump(merchant), 200, validators.headers()
 
     @merchant_ns.doc('update_merchant')
     @merchant_ns.expect(merchant_model)
@@ -102,6 +186,7 @@ class MerchantResource(Resource):
 
         try:
             merchant.save()
+            response_cache.invalidate('merchants', 'merchant:{}'.format(id))
             return merchant_schema.dump(merchant)
         except Exception as e:
             return {'message': str(e)}, 400
@@ -124,6 +209,7 @@ class MerchantResource(Resource):
         try:
             db.session.delete(merchant)
             db.session.commit()
+            response_cache.invalidate('merchants', 'merchant:{}'.format(id))
             return '', 204
         except Exception as e:
             return {'message': str(e)}, 400
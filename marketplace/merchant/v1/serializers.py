@@ -1,5 +1,10 @@
+from sqlalchemy.orm import joinedload
+
 from marketplace import ma
+from marketplace.http.expand import Expandable, Expansion
+from marketplace.http.sparse import Fieldset
 from marketplace.persistence.model import Merchant
+from marketplace.user.v1.serializers import public_user_schema
 
 
 class MerchantSchema(ma.Schema):
@@ -10,3 +15,13 @@ class MerchantSchema(ma.Schema):
 
 merchant_schema = MerchantSchema()
 merchants_schema = MerchantSchema(many=True)
+merchant_fields = Fieldset(merchant_schema)
+
+# `?expand=` options, the owner comes joined into the same query. Merchants are public,
+# so only the owner's public fields are embedded
+merchant_expand = Expandable(
+    owner=Expansion([joinedload(Merchant.owner)],
+                    lambda merchants: [public_user_schema.dump(merchant.owner)
+                                       if merchant.owner is not None else None
+                                       for merchant in merchants]),
+)
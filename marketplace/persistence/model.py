@@ -2,15 +2,21 @@ import enum
 import uuid
 from datetime import datetime
 
-import bcrypt
-from sqlalchemy.dialects.postgresql import UUID, ARRAY, JSON
+from sqlalchemy import DDL, event
+from sqlalchemy.dialects.postgresql import UUID, ARRAY, JSON, TSVECTOR
+from sqlalchemy.orm import deferred, validates
 from sqlalchemy.types import Enum as SQLEnum
 
 from marketplace import db
+from marketplace.auth.hashing import password_hasher
 
 
 class User(db.Model):
     __tablename__ = 'users'
+    __table_args__ = (
+        # Keyset pagination order, see marketplace.http.pagination
+        db.Index('ix_users_created_at_id', 'created_at', 'id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
@@ -18,7 +24,7 @@ class User(db.Model):
     fullname = db.Column(db.String(120))
     phone = db.Column(db.String(20))
     is_admin = db.Column(db.Boolean, default=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     @property
@@ -27,16 +33,14 @@ class User(db.Model):
 
     @password.setter
     def password(self, password):
-        self.password_hash = bcrypt.hashpw(
-            password.encode('utf-8'),
-            bcrypt.gensalt()
-        ).decode('utf-8')
+        self.password_hash = password_hasher.hash(password)
 
     def verify_password(self, password):
-        return bcrypt.checkpw(
-            password.encode('utf-8'),
-            self.password_hash.encode('utf-8')
-        )
+        return password_hasher.verify(password, self.password_hash)
+
+    @property
+    def password_needs_rehash(self):
+        return password_hasher.needs_rehash(self.password_hash)
 
     def save(self):
         db.session.add(self)
@@ -45,13 +49,20 @@ class User(db.Model):
 
 class Merchant(db.Model):
     __tablename__ = 'merchants'
+    __table_args__ = (
+        # Keyset pagination order, see marketplace.http.pagination
+        db.Index('ix_merchants_created_at_id', 'created_at', 'id'),
+        # Listing filters, see marketplace.merchant.filters
+        db.Index('ix_merchants_city_created_at_id', 'city', 'created_at', 'id'),
+        db.Index('ix_merchants_owner_id_created_at_id', 'owner_id', 'created_at', 'id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(128), unique=True, nullable=False)
     description = db.Column(db.String(256))
     city = db.Column(db.String(128))
     owner_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     # Relationship
@@ -62,6 +73,27 @@ class Merchant(db.Model):
         db.session.commit()
 
 
+# Case-insensitive name prefix filter: `text_pattern_ops` lets LIKE 'prefix%' use the index
+# whatever the database collation. Declared outside the class to index an expression.
+db.Index('ix_merchants_lower_name', db.func.lower(Merchant.name).label('lower_name'),
+         postgresql_ops={'lower_name': 'text_pattern_ops'})
+
+
+# Merchants per city, kept up to date on every merchant write, see marketplace.merchant.stats
+class MerchantCityStats(db.Model):
+    __tablename__ = 'merchant_city_stats'
+
+    # Merchants without a city are counted under ''
+    city = db.Column(db.String(128), primary_key=True)
+    merchant_count = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+def normalize_currency(currency):
+    """Currency codes are stored uppercase, which the currency filter and its index rely on"""
+    return currency.upper() if isinstance(currency, str) else currency
+
+
 class ProductStatus(enum.Enum):
     ACTIVE = "active"
     INACTIVE = "inactive"
@@ -71,12 +103,16 @@ class ProductStatus(enum.Enum):
 
 class ProductCategory(db.Model):
     __tablename__ = 'product_categories'
+    __table_args__ = (
+        # Keyset pagination order, see marketplace.http.pagination
+        db.Index('ix_product_categories_created_at_id', 'created_at', 'id'),
+    )
 
     id = db.Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     name = db.Column(db.String(100), nullable=False)
     parent_id = db.Column(UUID(as_uuid=True), db.ForeignKey('product_categories.id'), nullable=True)
     description = db.Column(db.Text)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     # Self-referential relationship for hierarchical categories
@@ -87,6 +123,20 @@ class ProductCategory(db.Model):
 
 class ProductItem(db.Model):
     __tablename__ = 'product_items'
+    __table_args__ = (
+        # Keyset pagination order, see marketplace.http.pagination
+        db.Index('ix_product_items_created_at_id', 'created_at', 'id'),
+        # Listing filters, see marketplace.product.filters
+        db.Index('ix_product_items_category_id_created_at_id', 'category_id', 'created_at', 'id'),
+        db.Index('ix_product_items_seller_id_created_at_id', 'seller_id', 'created_at', 'id'),
+        db.Index('ix_product_items_status_created_at_id', 'status', 'created_at', 'id'),
+        db.Index('ix_product_items_currency_created_at_id', 'currency', 'created_at', 'id'),
+        db.Index('ix_product_items_price', 'price'),
+        db.Index('ix_product_items_in_stock_created_at_id', 'created_at', 'id',
+                 postgresql_where=db.text('stock_quantity > 0')),
+        db.Index('ix_product_items_tags', 'tags', postgresql_using='gin'),
+        db.Index('ix_product_items_search_vector', 'search_vector', postgresql_using='gin'),
+    )
 
     id = db.Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     seller_id = db.Column(UUID(as_uuid=True), nullable=False)
@@ -102,16 +152,52 @@ class ProductItem(db.Model):
     tags = db.Column(ARRAY(db.String), default=[])
     sku = db.Column(db.String(50), unique=True)
     attributes = db.Column(JSON)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+    # Full-text document kept up to date by Postgres, see marketplace.product.search.
+    # Deferred so regular product queries never read it.
+    search_vector = deferred(db.Column(TSVECTOR, db.Computed(
+        "setweight(to_tsvector('english', coalesce(name, '')), 'A') || "
+        "setweight(to_tsvector('english', coalesce(description, '')), 'B') || "
+        "product_tags_tsvector(tags)",
+        persisted=True
+    )))
+
     # Relationships
     category = db.relationship('ProductCategory', backref='products')
     pricing_history = db.relationship('ProductPricing', backref='product', lazy='dynamic')
 
+    @validates('currency')
+    def validate_currency(self, key, currency):
+        return normalize_currency(currency)
+
+
+# Tags of `ProductItem.search_vector`: lowercased words, NULL tags and elements skipped.
+# array_to_string() is only STABLE, which Postgres refuses in a generated column, so it is
+# wrapped in a function declared IMMUTABLE (it is, for varchar elements).
+# create_all() runs it below, migrations need `flask create-db-functions` before `db upgrade`.
+DB_FUNCTIONS = (
+    "CREATE OR REPLACE FUNCTION product_tags_tsvector(tags varchar[]) RETURNS tsvector "
+    "LANGUAGE sql IMMUTABLE PARALLEL SAFE AS "
+    "$$ SELECT to_tsvector('simple', lower(coalesce(array_to_string(tags, ' '), ''))) $$",
+)
+
+for statement in DB_FUNCTIONS:
+    event.listen(ProductItem.__table__, 'before_create',
+                 DDL(statement).execute_if(dialect='postgresql'))
+event.listen(ProductItem.__table__, 'after_drop', DDL(
+    "DROP FUNCTION IF EXISTS product_tags_tsvector(varchar[])").execute_if(dialect='postgresql'))
+
 
 class ProductPricing(db.Model):
     __tablename__ = 'product_pricing'
+    __table_args__ = (
+        # Keyset pagination order, see marketplace.http.pagination
+        db.Index('ix_product_pricing_created_at_id', 'created_at', 'id'),
+        # Effective price lookups, see marketplace.product.pricing
+        db.Index('ix_product_pricing_product_id_valid_from', 'product_id', 'valid_from'),
+    )
 
     id = db.Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     product_id = db.Column(UUID(as_uuid=True), db.ForeignKey('product_items.id'), nullable=False)
@@ -120,9 +206,65 @@ class ProductPricing(db.Model):
     currency = db.Column(db.String(3), nullable=False)
     valid_from = db.Column(db.DateTime, nullable=False)
     valid_to = db.Column(db.DateTime)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+    @validates('currency')
+    def validate_currency(self, key, currency):
+        return normalize_currency(currency)
+
+
+class ReservationStatus(enum.Enum):
+    HELD = "held"
+    COMMITTED = "committed"
+    RELEASED = "released"
+
+
+# Stock taken out of `ProductItem.stock_quantity` for a basket, see marketplace.product.stock
+class StockReservation(db.Model):
+    __tablename__ = 'stock_reservations'
+    __table_args__ = (
+        # Expiry sweep over the reservations still held
+        db.Index('ix_stock_reservations_held_expires_at', 'expires_at',
+                 postgresql_where=db.text("status = 'HELD'")),
+    )
+
+    id = db.Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    status = db.Column(SQLEnum(ReservationStatus), nullable=False,
+                       default=ReservationStatus.HELD)
+    expires_at = db.Column(db.DateTime, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    # Relationships
+    items = db.relationship('StockReservationItem', backref='reservation', lazy='selectin')
+
+
+class StockReservationItem(db.Model):
+    __tablename__ = 'stock_reservation_items'
+
+    reservation_id = db.Column(UUID(as_uuid=True), db.ForeignKey('stock_reservations.id'),
+                               primary_key=True)
+    product_id = db.Column(UUID(as_uuid=True), db.ForeignKey('product_items.id'),
+                           primary_key=True)
+    sku = db.Column(db.String(50), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+
+
+# Entries of the `database://` backend, see marketplace.http.cache.DatabaseBackend
+class SharedEntry(db.Model):
+    __tablename__ = 'shared_entries'
+    __table_args__ = (
+        # Sweep of expired entries, see `flask purge-expired-entries`
+        db.Index('ix_shared_entries_expires_at', 'expires_at'),
+    )
+
+    key = db.Column(db.String(255), primary_key=True)
+    value = db.Column(db.LargeBinary, nullable=False)
+    # NULL never expires
+    expires_at = db.Column(db.DateTime)
+
 
 class UserSession:
     """Mock class for testing"""
@@ -0,0 +1,81 @@
+import logging
+
+from sqlalchemy.engine import make_url
+
+log = logging.getLogger(__name__)
+
+
+def pool_size(max_connections, reserved, processes, threads, engines):
+    """
+    (pool_size, max_overflow) of one engine in one worker process.
+
+    The `max_connections - reserved` connections left for the application are split
+    evenly over every engine of every process, so all pools together can never exhaust
+    the server. Within that share a pool keeps one connection per request thread and
+    may overflow up to the share, but never by more than the thread count.
+    """
+    budget = max(max_connections - reserved, 0)
+    share = max(budget // max(processes * engines, 1), 1)
+    size = max(min(threads, share), 1)
+    return size, max(min(share - size, threads), 0)
+
+
+def configure(app):
+    """
+    Derive SQLALCHEMY_ENGINE_OPTIONS pool settings from the connection budget.
+
+    Must run before `db.init_app`. Every engine (the default one and each bind) is
+    assumed to live on the same server, which is true for the bundled configs and is
+    the safe assumption otherwise. Options already set in SQLALCHEMY_ENGINE_OPTIONS or
+    on a bind win, and SQLite URIs, whose pools take none of these, are left alone.
+    """
+    config = app.config
+    uri = config.get('SQLALCHEMY_DATABASE_URI')
+    if not uri or make_url(uri).get_backend_name() == 'sqlite':
+        return
+
+    # The default engine only serves CLI commands when binds are configured, requests
+    # go through `master`/`read`
+    engines = len(config.get('SQLALCHEMY_BINDS') or {}) or 1
+    size, overflow = pool_size(config.get('DATABASE_MAX_CONNECTIONS', 100),
+                               config.get('DATABASE_RESERVED_CONNECTIONS', 10),
+                               config.get('SERVER_PROCESSES', 1),
+                               config.get('SERVER_THREADS', 1), engines)
+
+    options = dict(config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    options.setdefault('pool_size', size)
+    options.setdefault('max_overflow', overflow)
+    options.setdefault('pool_timeout', config.get('SQLALCHEMY_POOL_TIMEOUT', 10))
+    options.setdefault('pool_recycle', config.get('SQLALCHEMY_POOL_RECYCLE', 1800))
+    config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+    # Flask-SQLAlchemy only applies SQLALCHEMY_ENGINE_OPTIONS to the default engine, a
+    # bind takes options when given as a dict (copied, the config class shares its dict)
+    binds = {}
+    for key, bind in (config.get('SQLALCHEMY_BINDS') or {}).items():
+        bind = dict(bind) if isinstance(bind, dict) else {'url': bind}
+        for name, value in options.items():
+            bind.setdefault(name, value)
+        binds[key] = bind
+    if binds:
+        config['SQLALCHEMY_BINDS'] = binds
+
+    processes = config.get('SERVER_PROCESSES', 1)
+    total = (options['pool_size'] + options['max_overflow']) * engines * processes
+    budget = config.get('DATABASE_MAX_CONNECTIONS', 100) - config.get(
+        'DATABASE_RESERVED_CONNECTIONS', 10)
+    if total > budget:
+        log.warning('Connection pools can open %d connections, more than the %d available; '
+                    'lower WEB_CONCURRENCY or raise DATABASE_MAX_CONNECTIONS', total, budget)
+
+
+def dispose_engines(app, db):
+    """
+    Drop the connections inherited from the parent process, without closing them.
+
+    Called in each gunicorn worker after the fork of a preloaded app: the sockets
+    belong to the parent, so the child must neither reuse nor close them, and starts
+    from empty pools instead.
+    """
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
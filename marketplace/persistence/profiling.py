@@ -0,0 +1,113 @@
+import logging
+import re
+import time
+from collections import Counter
+
+from flask import current_app, g, has_app_context, has_request_context, request
+from sqlalchemy import event
+
+log = logging.getLogger(__name__)
+
+# `IN (%(id_1)s, %(id_2)s, ...)` lists expanded to their length, collapsed to one shape
+_PLACEHOLDER_LIST = re.compile(r'\((?:\s*(?:\?|%\(\w+\)s|%s|:\w+)\s*,?)+\)')
+
+
+class SqlProfile:
+    """Queries run while serving one request"""
+
+    __slots__ = ('count', 'seconds', 'shapes')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.shapes = Counter()
+
+    def record(self, statement, elapsed):
+        self.count += 1
+        self.seconds += elapsed
+        self.shapes[statement_shape(statement)] += 1
+
+    def repeated(self, threshold):
+        """(shape, times) of statements run at least `threshold` times, the N+1 suspects"""
+        return [(shape, times) for shape, times in self.shapes.most_common()
+                if times >= threshold]
+
+
+def statement_shape(statement):
+    return _PLACEHOLDER_LIST.sub('(...)', ' '.join(statement.split()))
+
+
+def redact(parameters):
+    """Bind parameters with every value replaced by its type name"""
+    if isinstance(parameters, dict):
+        return {key: type(value).__name__ for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        if parameters and isinstance(parameters[0], (dict, list, tuple)):
+            return '{} rows like {}'.format(len(parameters), redact(parameters[0]))
+        return [type(value).__name__ for value in parameters]
+    return type(parameters).__name__
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['query_started'].pop()
+    elapsed = time.perf_counter() - started
+
+    if has_request_context():
+        profile = g.get('sql_profile')
+        if profile is None:
+            profile = g.sql_profile = SqlProfile()
+        profile.record(statement, elapsed)
+
+    threshold = current_app.config.get('SQL_SLOW_QUERY_SECONDS') if has_app_context() else None
+    if threshold is not None and elapsed >= threshold:
+        log.warning('Slow query (%.1f ms) on %s: %s params=%s', elapsed * 1000,
+                    conn.engine.url.render_as_string(hide_password=True),
+                    ' '.join(statement.split()), redact(parameters))
+
+
+def _handle_error(context):
+    # The statement failed, after_cursor_execute will not pop its start time
+    started = context.connection.info.get('query_started') if context.connection else None
+    if started:
+        started.pop()
+
+
+def init_app(app, db):
+    """
+    Count queries and DB time per request on every engine (default and binds).
+
+    Statements that run SQL_N_PLUS_ONE_THRESHOLD times or more within one request are
+    logged as N+1 suspects, statements slower than SQL_SLOW_QUERY_SECONDS are logged with
+    their bind parameters redacted to type names, and with SQL_SERVER_TIMING the totals
+    are reported in a `Server-Timing: db;dur=...` response header.
+    """
+    if not app.config.get('SQL_PROFILING_ENABLED', True):
+        return
+
+    with app.app_context():
+        engines = list(db.engines.values())
+    for engine in engines:
+        if not event.contains(engine, 'before_cursor_execute', _before_cursor_execute):
+            event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+            event.listen(engine, 'handle_error', _handle_error)
+
+    @app.after_request
+    def report_sql_profile(response):
+        profile = g.pop('sql_profile', None)
+        if profile is None:
+            return response
+
+        threshold = app.config.get('SQL_N_PLUS_ONE_THRESHOLD', 5)
+        for shape, times in profile.repeated(threshold) if threshold else ():
+            log.warning('Possible N+1 in %s %s: %d x %s', request.method,
+                        request.endpoint, times, shape)
+
+        if app.config.get('SQL_SERVER_TIMING'):
+            response.headers.add('Server-Timing', 'db;dur={:.2f};desc="{} queries"'.format(
+                profile.seconds * 1000, profile.count))
+        return response
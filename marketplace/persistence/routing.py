@@ -0,0 +1,151 @@
+import logging
+import threading
+import time
+
+from flask import current_app, g, has_request_context, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.sql.dml import UpdateBase
+
+log = logging.getLogger(__name__)
+
+WRITE_BIND = 'master'
+READ_BIND = 'read'
+STICKY_COOKIE = 'db_sticky'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+class ReplicaHealth:
+    """
+    Per-process view of whether the read replica can be used.
+
+    A replica is taken out of rotation for `SQLALCHEMY_REPLICA_RETRY_SECONDS` when a
+    probe or a statement on it fails with a connection error, and probed again (at most
+    every `SQLALCHEMY_REPLICA_PROBE_SECONDS`) before being trusted again.
+    """
+
+    def __init__(self):
+        self._down_until = 0.0
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def available(self, engine):
+        now = time.monotonic()
+        if now < self._down_until:
+            return False
+        probe_interval = current_app.config.get('SQLALCHEMY_REPLICA_PROBE_SECONDS', 5)
+        if now - self._checked_at < probe_interval:
+            return True
+        with self._lock:
+            if now - self._checked_at < probe_interval:
+                return now >= self._down_until
+            self._checked_at = now
+            try:
+                with engine.connect() as connection:
+                    connection.exec_driver_sql('SELECT 1')
+            except DBAPIError as e:
+                self.mark_down(e)
+                return False
+        return True
+
+    def mark_down(self, reason=None):
+        retry = current_app.config.get('SQLALCHEMY_REPLICA_RETRY_SECONDS', 30)
+        now = time.monotonic()
+        was_up = now >= self._down_until
+        self._down_until = now + retry
+        if was_up:
+            log.error('Read replica unavailable, reading from master for %ss: %s', retry, reason)
+
+    def reset(self):
+        self._down_until = 0.0
+        self._checked_at = 0.0
+
+
+replica_health = ReplicaHealth()
+
+
+class RoutingSession(Session):
+    """
+    Sends reads of safe (GET/HEAD) requests to the `read` bind and everything else,
+    including any flush, to the `master` bind. Falls back to the default engine when the
+    binds are not configured.
+
+    A statement that fails because the replica went away is run once more, on master:
+    the failure took the replica out of rotation, so the request is still answered.
+    """
+
+    def execute(self, *args, **kwargs):
+        return self._retry_on_master(super().execute, *args, **kwargs)
+
+    def scalar(self, *args, **kwargs):
+        return self._retry_on_master(super().scalar, *args, **kwargs)
+
+    def scalars(self, *args, **kwargs):
+        return self._retry_on_master(super().scalars, *args, **kwargs)
+
+    def _retry_on_master(self, method, *args, **kwargs):
+        try:
+            return method(*args, **kwargs)
+        except DBAPIError:
+            replica_failed = has_request_context() and g.pop('db_replica_failed', False)
+            # Only reads go to the replica, but the rollback would drop pending changes
+            if not replica_failed or self.new or self.dirty or self.deleted:
+                raise
+        log.warning('Read replica failed during a statement, retrying it on master')
+        # Releases the dead replica connection, the retry's get_bind() then picks master
+        self.rollback()
+        return method(*args, **kwargs)
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is not None:
+            return bind
+
+        engines = self._db.engines
+        master = engines.get(WRITE_BIND) or super().get_bind(mapper=mapper, clause=clause,
+                                                             **kwargs)
+        if self._flushing or isinstance(clause, UpdateBase) or not _reads_from_replica():
+            return master
+
+        replica = engines.get(READ_BIND)
+        if replica is not None and replica_health.available(replica):
+            return replica
+        return master
+
+
+def _reads_from_replica():
+    if not has_request_context() or request.method not in SAFE_METHODS:
+        return False
+    if not current_app.config.get('SQLALCHEMY_READ_REPLICA_ENABLED', True):
+        return False
+    # Read-your-writes: clients that wrote recently keep reading from master
+    return STICKY_COOKIE not in request.cookies and not g.get('db_use_master', False)
+
+
+def use_master():
+    """Pin the remaining statements of the current request to the master bind"""
+    g.db_use_master = True
+
+
+def init_app(app, db):
+    replica_health.reset()
+
+    with app.app_context():
+        replica = db.engines.get(READ_BIND)
+    if replica is not None and not event.contains(replica, 'handle_error', _on_replica_error):
+        event.listen(replica, 'handle_error', _on_replica_error)
+
+    @app.after_request
+    def stick_to_master_after_write(response):
+        if request.method not in SAFE_METHODS and response.status_code < 400:
+            response.set_cookie(STICKY_COOKIE, '1', httponly=True, samesite='Lax',
+                                max_age=app.config.get('SQLALCHEMY_STICKY_SECONDS', 5))
+        return response
+
+
+def _on_replica_error(context):
+    if context.is_disconnect or context.connection is None:
+        replica_health.mark_down(context.original_exception)
+        if has_request_context():
+            # Lets RoutingSession retry the failed statement on master
+            g.db_replica_failed = True
@@ -0,0 +1,345 @@
+"""
+Synthetic dataset generator for local, production-sized databases.
+
+Rows are generated as text and streamed straight into Postgres with `COPY ... FROM
+STDIN`, never materialized as ORM objects or held in memory as a whole. Everything is
+derived from the seed: the same seed and options on an empty database always produce
+the same rows, ids included.
+"""
+import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import bcrypt
+from sqlalchemy import func, select, text
+
+from marketplace.merchant import stats as merchant_stats
+from marketplace.persistence.model import (Merchant, ProductCategory, ProductItem,
+                                           ProductPricing, ProductStatus, User)
+
+log = logging.getLogger(__name__)
+
+BASE_TIME = datetime(2024, 1, 1)
+CITIES = ('Jakarta', 'Surabaya', 'Bandung', 'Medan', 'Semarang', 'Makassar', 'Denpasar',
+          'Yogyakarta', 'Palembang', 'Balikpapan')
+ADJECTIVES = ('red', 'blue', 'organic', 'vintage', 'compact', 'wireless', 'leather',
+              'wooden', 'steel', 'classic', 'premium', 'portable', 'smart', 'eco')
+NOUNS = ('chair', 'lamp', 'phone', 'jacket', 'kettle', 'backpack', 'speaker', 'watch',
+         'bottle', 'keyboard', 'sofa', 'camera', 'blender', 'sneaker', 'guitar', 'desk')
+CURRENCIES = ('USD', 'IDR', 'SGD')
+LINES_PER_CHUNK = 5000
+COPY_BUFFER = 1 << 20
+BCRYPT_ALPHABET = './ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789'
+
+
+class CopyStream:
+    """File-like view of an iterator of text chunks, as `cursor.copy_expert` reads it"""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+
+    def read(self, size=-1):
+        return next(self._chunks, '')
+
+    readline = read
+
+
+def chunked(lines, per_chunk=LINES_PER_CHUNK):
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) >= per_chunk:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
+
+
+def copy_rows(connection, table, lines):
+    """COPY text-format `lines` (tab separated, newline terminated) into `table`"""
+    columns = ', '.join(c.name for c in table.columns if c.computed is None)
+    with connection.cursor() as cursor:
+        cursor.copy_expert('COPY {} ({}) FROM STDIN'.format(table.name, columns),
+                           CopyStream(chunked(lines)), size=COPY_BUFFER)
+
+
+def escape(value):
+    """A value in COPY text format"""
+    if value is None:
+        return r'\N'
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def uuid_text(salt, n):
+    """Deterministic UUID `n` of a sequence, ids of a table share the random `salt`"""
+    h = '{:016x}{:016x}'.format(salt, n)
+    return '{}-{}-{}-{}-{}'.format(h[:8], h[8:12], h[12:16], h[16:20], h[20:])
+
+
+def id_prefix(salt):
+    """Shared start of `uuid_text(salt, n)` for any n below 2**48, append '%012x' % n"""
+    return uuid_text(salt, 0)[:-12]
+
+
+def timestamp(seconds):
+    return (BASE_TIME + timedelta(seconds=seconds)).isoformat(' ')
+
+
+def money(cents):
+    return '{}.{:02d}'.format(cents // 100, cents % 100)
+
+
+def password_hash(password, rounds, rng):
+    """One bcrypt hash shared by every generated user, with a salt taken from `rng`"""
+    salt = ''.join(rng.choice(BCRYPT_ALPHABET) for _ in range(21)) + rng.choice('.Oeu')
+    return bcrypt.hashpw(password.encode('utf-8'),
+                         '$2b${:02d}${}'.format(rounds, salt).encode()).decode('utf-8')
+
+
+class Seeder:
+    """
+    Loads users, merchants, a category tree and products with pricing history.
+
+    The category tree has `fanout` roots and every node down to `depth` levels has
+    `fanout` children; each category gets `products_per_category` products and each
+    product `prices_per_product` consecutive pricing periods. Products and pricing are
+    split across `jobs` connections COPYing in parallel. When those tables start empty
+    their secondary indexes are dropped for the load and rebuilt (in parallel) at the
+    end, which is much faster than maintaining them row by row.
+    """
+
+    def __init__(self, engine, seed=0, users=1000, merchants=100, depth=3, fanout=5,
+                 products_per_category=10, prices_per_product=1, password='this15secret',
+                 rounds=12, jobs=4, prefix=None):
+        self.engine = engine
+        self.seed = seed
+        self.users = users
+        self.merchants = merchants
+        self.depth = depth
+        self.fanout = fanout
+        self.products_per_category = products_per_category
+        self.prices_per_product = prices_per_product
+        self.password = password
+        self.rounds = rounds
+        self.jobs = max(1, jobs)
+        self.prefix = 's{}-'.format(seed) if prefix is None else prefix
+
+        rng = random.Random(seed)
+        self._salts = {name: rng.getrandbits(64)
+                       for name in ('category', 'product', 'seller', 'pricing')}
+        self._password_hash = password_hash(password, rounds, rng)
+
+    def run(self, truncate=False):
+        """Load everything, returns the number of rows written per table"""
+        counts = {}
+        with self.engine.begin() as connection:
+            if truncate:
+                connection.execute(text(
+                    'TRUNCATE stock_reservation_items, stock_reservations, product_pricing, '
+                    'product_items, product_categories, merchant_city_stats, merchants, users '
+                    'RESTART IDENTITY CASCADE'))
+            user_ids = self._load_users(connection, counts)
+            self._load_merchants(connection, user_ids, counts)
+            categories = self._load_categories(connection, counts)
+
+        if not categories:
+            return counts
+
+        big_tables = (ProductItem.__table__, ProductPricing.__table__)
+        with self.engine.begin() as connection:
+            empty = [t for t in big_tables
+                     if connection.execute(select(text('1')).select_from(t).limit(1)).first()
+                     is None]
+            for table in empty:
+                for index in table.indexes:
+                    index.drop(connection, checkfirst=True)
+        try:
+            counts['product_items'] = self._parallel(self._load_products, categories)
+            counts['product_pricing'] = self._parallel(self._load_pricing, categories)
+        finally:
+            self._rebuild_indexes(empty)
+
+        with self.engine.begin() as connection:
+            for table in (User.__table__, Merchant.__table__, ProductCategory.__table__) \
+                    + big_tables:
+                connection.execute(text('ANALYZE {}'.format(table.name)))
+        return counts
+
+    # Small tables, loaded in the first transaction
+
+    def _load_users(self, connection, counts):
+        if not self.users:
+            return list(connection.execute(select(User.id).limit(10000)).scalars())
+        base = self._next_id(connection, User)
+        rng = random.Random('{}:users'.format(self.seed))
+
+        def lines():
+            for i in range(self.users):
+                ts = timestamp(i)
+                yield '{}\t{}user{:07d}\t{}\tUser {}\t+628{:010d}\tf\t{}\t{}\n'.format(
+                    base + i, escape(self.prefix), i, self._password_hash, i,
+                    rng.randrange(10 ** 10), ts, ts)
+
+        self._timed('users', self.users, copy_rows, connection.connection, User.__table__,
+                    lines())
+        self._reset_sequence(connection, User)
+        counts['users'] = self.users
+        return range(base, base + self.users)
+
+    def _load_merchants(self, connection, user_ids, counts):
+        if not self.merchants:
+            return
+        if not user_ids:
+            raise ValueError('merchants need at least one user, seed some with --users')
+        base = self._next_id(connection, Merchant)
+        rng = random.Random('{}:merchants'.format(self.seed))
+
+        def lines():
+            for i in range(self.merchants):
+                ts = timestamp(i)
+                yield '{}\t{}Merchant {:07d}\tMerchant number {}\t{}\t{}\t{}\t{}\n'.format(
+                    base + i, escape(self.prefix), i, i, rng.choice(CITIES),
+                    user_ids[rng.randrange(len(user_ids))], ts, ts)
+
+        self._timed('merchants', self.merchants, copy_rows, connection.connection,
+                    Merchant.__table__, lines())
+        self._reset_sequence(connection, Merchant)
+        # COPY skips the ORM hooks that keep the per-city counters
+        merchant_stats.rebuild(connection)
+        counts['merchants'] = self.merchants
+
+    def _load_categories(self, connection, counts):
+        """Returns the category ids, in the order their products are numbered"""
+        salt = self._salts['category']
+        nodes = []  # (id, parent id, dotted path)
+        level = [(None, '')]
+        for _ in range(self.depth):
+            next_level = []
+            for parent_id, path in level:
+                for child in range(1, self.fanout + 1):
+                    node_id = uuid_text(salt, len(nodes))
+                    node_path = '{}.{}'.format(path, child) if path else str(child)
+                    nodes.append((node_id, parent_id, node_path))
+                    next_level.append((node_id, node_path))
+            level = next_level
+
+        def lines():
+            for i, (node_id, parent_id, path) in enumerate(nodes):
+                ts = timestamp(i)
+                yield '{}\t{}Category {}\t{}\t\\N\t{}\t{}\n'.format(
+                    node_id, escape(self.prefix), path, parent_id or r'\N', ts, ts)
+
+        self._timed('product_categories', len(nodes), copy_rows, connection.connection,
+                    ProductCategory.__table__, lines())
+        counts['product_categories'] = len(nodes)
+        return [node_id for node_id, _, _ in nodes]
+
+    # Products and pricing, sharded by category across `jobs` connections
+
+    def _parallel(self, load, categories):
+        shards = [range(job, len(categories), self.jobs) for job in range(self.jobs)]
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            total = sum(pool.map(lambda shard: load(categories, shard), shards))
+        log.info('%s: %d rows in %.1fs', load.__name__.replace('_load_', ''), total,
+                 time.perf_counter() - started)
+        return total
+
+    def _load_products(self, categories, shard):
+        per_category = self.products_per_category
+        product_id = id_prefix(self._salts['product'])
+        sellers = [uuid_text(self._salts['seller'], i) for i in range(max(1, self.merchants))]
+        names = [(adjective.title() + ' ' + noun.title(),
+                  'A {} {} for every day use'.format(adjective, noun),
+                  '{{{},{}}}'.format(adjective, noun))
+                 for adjective in ADJECTIVES for noun in NOUNS]
+        status = ProductStatus.ACTIVE.name
+        sku = escape(self.prefix) + 'SKU-'
+
+        def lines():
+            for c in shard:
+                rng = random.Random(self.seed * 1000003 + c).random
+                head = '\t' + categories[c] + '\t'
+                ts = timestamp(c)
+                tail = '\t{}\t{}\n'.format(ts, ts)
+                for n in range(c * per_category, (c + 1) * per_category):
+                    name, description, tags = names[int(rng() * len(names))]
+                    yield (f'{product_id}{n:012x}\t{sellers[int(rng() * len(sellers))]}{head}'
+                           f'{name} {n}\t{description}\t{money(100 + int(rng() * 499900))}\t'
+                           f'{CURRENCIES[int(rng() * 3)]}\t{int(rng() * 101)}\t{status}\t{{}}\t'
+                           f'{tags}\t{sku}{n:09d}\t{{}}{tail}')
+
+        return self._copy_shard(ProductItem.__table__, lines(),
+                                len(shard) * per_category)
+
+    def _load_pricing(self, categories, shard):
+        if not self.prices_per_product:
+            return 0
+        per_category = self.products_per_category
+        per_product = self.prices_per_product
+        product_id = id_prefix(self._salts['product'])
+        pricing_id = id_prefix(self._salts['pricing'])
+        period = 30 * 24 * 3600
+        # (valid_from, valid_to) of every pricing period, the last one is open ended
+        periods = [(timestamp(k * period),
+                    timestamp((k + 1) * period) if k + 1 < per_product else r'\N')
+                   for k in range(per_product)]
+
+        def lines():
+            for c in shard:
+                rng = random.Random(self.seed * 1000033 + c).random
+                for n in range(c * per_category, (c + 1) * per_category):
+                    currency = CURRENCIES[int(rng() * 3)]
+                    for k, (valid_from, valid_to) in enumerate(periods):
+                        base = 100 + int(rng() * 499900)
+                        discount = money(base * 9 // 10) if rng() < 0.3 else r'\N'
+                        yield (f'{pricing_id}{n * per_product + k:012x}\t{product_id}{n:012x}\t'
+                               f'{money(base)}\t{discount}\t{currency}\t{valid_from}\t'
+                               f'{valid_to}\t{valid_from}\t{valid_from}\n')
+
+        return self._copy_shard(ProductPricing.__table__, lines(),
+                                len(shard) * per_category * per_product)
+
+    def _copy_shard(self, table, lines, count):
+        connection = self.engine.raw_connection()
+        try:
+            copy_rows(connection, table, lines)
+            connection.commit()
+        finally:
+            connection.close()
+        return count
+
+    def _rebuild_indexes(self, tables):
+        indexes = [index for table in tables for index in table.indexes]
+        if not indexes:
+            return
+
+        def create(index):
+            with self.engine.begin() as connection:
+                index.create(connection, checkfirst=True)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            list(pool.map(create, indexes))
+        log.info('rebuilt %d indexes in %.1fs', len(indexes), time.perf_counter() - started)
+
+    # Helpers
+
+    def _timed(self, name, count, fn, *args):
+        started = time.perf_counter()
+        fn(*args)
+        log.info('%s: %d rows in %.1fs', name, count, time.perf_counter() - started)
+
+    @staticmethod
+    def _next_id(connection, model):
+        return (connection.execute(select(func.max(model.id))).scalar() or 0) + 1
+
+    @staticmethod
+    def _reset_sequence(connection, model):
+        table = model.__table__.name
+        connection.execute(text(
+            "SELECT setval(pg_get_serial_sequence('{0}', 'id'), "
+            "(SELECT max(id) FROM {0}))".format(table)))
@@ -0,0 +1,47 @@
+import threading
+import time
+
+from flask import current_app
+
+
+class SnapshotCache:
+    """
+    Per-worker in-memory snapshot of a small, read-mostly table.
+
+    `loader()` builds the snapshot and `fingerprint()` returns a cheap value that changes
+    whenever the table does (e.g. row count and max(updated_at)). Local writes call
+    `invalidate()` for an immediate rebuild, writes made by other workers are picked up
+    when the fingerprint is re-checked, at most every `check_interval_key` seconds.
+    """
+
+    def __init__(self, loader, fingerprint, check_interval_key, default_interval=5):
+        self._loader = loader
+        self._fingerprint = fingerprint
+        self._check_interval_key = check_interval_key
+        self._default_interval = default_interval
+        self._value = None
+        self._version = None
+        self._checked_at = 0.0
+        self._stale = True
+        self._lock = threading.Lock()
+
+    def get(self):
+        interval = current_app.config.get(self._check_interval_key, self._default_interval)
+        with self._lock:
+            now = time.monotonic()
+            if self._stale or self._value is None:
+                self._rebuild(now)
+            elif now - self._checked_at >= interval:
+                self._checked_at = now
+                if self._fingerprint() != self._version:
+                    self._rebuild(now)
+            return self._value
+
+    def invalidate(self):
+        self._stale = True
+
+    def _rebuild(self, now):
+        self._stale = False
+        self._version = self._fingerprint()
+        self._value = self._loader()
+        self._checked_at = now
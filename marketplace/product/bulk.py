@@ -0,0 +1,213 @@
+import json
+import uuid
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import SQLAlchemyError
+
+from marketplace import db
+from marketplace.http.cache import response_cache
+from marketplace.persistence.model import (ProductCategory, ProductItem, ProductStatus,
+                                           normalize_currency)
+
+REQUIRED_FIELDS = ('seller_id', 'category_id', 'name', 'price', 'currency')
+OPTIONAL_FIELDS = ('description', 'stock_quantity', 'images', 'tags', 'sku', 'attributes')
+
+products = ProductItem.__table__
+
+# Column limits: Numeric(10, 2) prices and int4 stock quantities
+PRICE_STEP = Decimal('0.01')
+MAX_PRICE = Decimal('99999999.99')
+INT32_MAX = 2 ** 31 - 1
+
+
+class RowError(ValueError):
+    pass
+
+
+def iter_ndjson(lines):
+    """Yield one parsed row (or the RowError it raised) per non-blank NDJSON line"""
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as e:
+            yield RowError('invalid JSON: {}'.format(e))
+
+
+def ingest_products(rows, batch_size=1000):
+    """
+    Insert `rows` (dicts in the `product_model` shape) in batches and yield one result
+    per input row, in input order.
+
+    Each batch is validated in Python, checked for unknown categories with a single
+    query and written with one multi-row `INSERT ... ON CONFLICT (sku) DO NOTHING
+    RETURNING sku`, so a duplicate or invalid row is reported without failing the rows
+    around it. Every batch is committed on its own.
+    """
+    seen_skus = set()
+    batch = []
+    for index, row in enumerate(rows):
+        batch.append((index, row))
+        if len(batch) >= batch_size:
+            yield from _ingest_batch(batch, seen_skus)
+            batch = []
+    if batch:
+        yield from _ingest_batch(batch, seen_skus)
+
+
+def _ingest_batch(batch, seen_skus):
+    now = datetime.utcnow()
+    results = {}
+    values = []
+    for index, row in batch:
+        try:
+            value = _to_values(row, now)
+        except RowError as e:
+            results[index] = _error(index, str(e))
+            continue
+        values.append((index, value))
+
+    category_ids = {value['category_id'] for _, value in values}
+    known = set(db.session.execute(
+        select(ProductCategory.id).where(ProductCategory.id.in_(category_ids))
+    ).scalars()) if category_ids else set()
+    accepted = []
+    for index, value in values:
+        sku = value['sku']
+        if value['category_id'] not in known:
+            results[index] = _error(index, 'unknown category_id {}'.format(value['category_id']))
+        elif sku is not None and sku in seen_skus:
+            results[index] = _error(index, 'duplicate sku {} in request'.format(sku))
+        else:
+            if sku is not None:
+                seen_skus.add(sku)
+            accepted.append((index, value))
+
+    if accepted:
+        statement = (insert(products)
+                     .on_conflict_do_nothing(index_elements=[products.c.sku])
+                     .returning(products.c.id))
+        try:
+            inserted = set(db.session.execute(
+                statement, [value for _, value in accepted]).scalars())
+            db.session.commit()
+            response_cache.invalidate('products')
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            inserted = None
+            error = str(getattr(e, 'orig', None) or e).strip()
+
+        for index, value in accepted:
+            if inserted is None:
+                results[index] = _error(index, error)
+            elif value['id'] in inserted:
+                results[index] = {'index': index, 'status': 'created', 'id': str(value['id'])}
+            else:
+                results[index] = _error(index, 'sku {} already exists'.format(value['sku']))
+
+    for index, _ in batch:
+        yield results[index]
+
+
+def _to_values(row, now):
+    if isinstance(row, RowError):
+        raise row
+    if not isinstance(row, dict):
+        raise RowError('row must be a JSON object')
+
+    missing = [field for field in REQUIRED_FIELDS if row.get(field) in (None, '')]
+    if missing:
+        raise RowError('missing field(s): {}'.format(', '.join(missing)))
+    unknown = set(row) - set(REQUIRED_FIELDS) - set(OPTIONAL_FIELDS)
+    if unknown:
+        raise RowError('unknown field(s): {}'.format(', '.join(sorted(unknown))))
+
+    # Every value is checked against its column: a row the database refuses would fail
+    # the INSERT of its whole batch
+    return {
+        'id': uuid.uuid4(),
+        'seller_id': _uuid(row, 'seller_id'),
+        'category_id': _uuid(row, 'category_id'),
+        'name': _string(row, 'name', 200),
+        'description': _string(row, 'description'),
+        'price': _price(row),
+        'currency': _currency(row),
+        'stock_quantity': _stock_quantity(row),
+        'status': ProductStatus.ACTIVE,
+        'images': _strings(row, 'images'),
+        'tags': _strings(row, 'tags'),
+        'sku': _string(row, 'sku', 50),
+        'attributes': row.get('attributes'),
+        'created_at': now,
+        'updated_at': now,
+    }
+
+
+def _price(row):
+    value = row['price']
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise RowError('invalid price')
+    try:
+        price = Decimal(str(value)).quantize(PRICE_STEP)
+    except InvalidOperation:
+        raise RowError('invalid price')
+    if not price.is_finite() or not 0 <= price <= MAX_PRICE:
+        raise RowError('price must be from 0 to {}'.format(MAX_PRICE))
+    return price
+
+
+def _stock_quantity(row):
+    value = row.get('stock_quantity')
+    if value is None:
+        return 0
+    if isinstance(value, bool) or not isinstance(value, int) or not 0 <= value <= INT32_MAX:
+        raise RowError('stock_quantity must be an integer from 0 to {}'.format(INT32_MAX))
+    return value
+
+
+def _currency(row):
+    currency = row['currency']
+    if not _is_text(currency) or len(currency) != 3:
+        raise RowError('currency must be a 3-letter code')
+    return normalize_currency(currency)
+
+
+def _string(row, field, max_length=None):
+    value = row.get(field)
+    if value is None:
+        return None
+    if not _is_text(value):
+        raise RowError('{} must be a string'.format(field))
+    if max_length is not None and len(value) > max_length:
+        raise RowError('{} is longer than {} characters'.format(field, max_length))
+    return value
+
+
+def _strings(row, field):
+    values = row.get(field)
+    if values is None:
+        return []
+    if not isinstance(values, list) or not all(_is_text(value) for value in values):
+        raise RowError('{} must be a list of strings'.format(field))
+    return values
+
+
+def _is_text(value):
+    # Postgres text cannot hold NUL characters
+    return isinstance(value, str) and '\x00' not in value
+
+
+def _uuid(row, field):
+    try:
+        return uuid.UUID(row[field])
+    except (AttributeError, TypeError, ValueError):
+        raise RowError('invalid {}'.format(field))
+
+
+def _error(index, message):
+    return {'index': index, 'status': 'error', 'error': message}
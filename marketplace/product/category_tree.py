@@ -0,0 +1,75 @@
+from sqlalchemy import event, func, literal, select
+
+from marketplace import db
+from marketplace.persistence.model import ProductCategory
+from marketplace.persistence.snapshot import SnapshotCache
+from marketplace.product.v1.serializers import category_schema
+
+
+class CategoryTree:
+    """Nested category hierarchy, `roots` are serialized nodes with a `children` list"""
+
+    def __init__(self, roots, nodes):
+        self.roots = roots
+        self._nodes = nodes
+
+    def subtree(self, category_id):
+        return self._nodes.get(str(category_id))
+
+    def descendant_ids(self, category_id):
+        """Ids of `category_id` and every category below it, empty if it doesn't exist"""
+        node = self.subtree(category_id)
+        ids, stack = [], [node] if node else []
+        while stack:
+            node = stack.pop()
+            ids.append(node['id'])
+            stack.extend(node['children'])
+        return ids
+
+
+def load_category_tree():
+    """
+    Fetch the whole hierarchy in one round trip with a recursive CTE walking down from
+    the roots. Rows come back ordered by depth, so every parent is placed before its
+    children while assembling.
+    """
+    columns = [ProductCategory.id, ProductCategory.name, ProductCategory.parent_id,
+               ProductCategory.description, ProductCategory.created_at,
+               ProductCategory.updated_at]
+
+    tree = (select(*columns, literal(0).label('depth'))
+            .where(ProductCategory.parent_id.is_(None))
+            .cte('category_tree', recursive=True))
+    tree = tree.union_all(
+        select(*columns, (tree.c.depth + 1).label('depth'))
+        .join(tree, ProductCategory.parent_id == tree.c.id)
+    )
+    rows = db.session.execute(select(tree).order_by(tree.c.depth, tree.c.name)).all()
+
+    roots, nodes = [], {}
+    for row in rows:
+        node = category_schema.dump(row)
+        node['children'] = []
+        nodes[node['id']] = node
+        if node['parent_id'] is None:
+            roots.append(node)
+        else:
+            nodes[node['parent_id']]['children'].append(node)
+    return CategoryTree(roots, nodes)
+
+
+def category_tree_version():
+    return db.session.execute(
+        select(func.count(ProductCategory.id), func.max(ProductCategory.updated_at))
+    ).one()
+
+
+category_tree = SnapshotCache(load_category_tree, category_tree_version,
+                              'CATEGORY_TREE_CHECK_SECONDS')
+
+
+@event.listens_for(ProductCategory, 'after_insert')
+@event.listens_for(ProductCategory, 'after_update')
+@event.listens_for(ProductCategory, 'after_delete')
+def _invalidate_category_tree(mapper, connection, target):
+    category_tree.invalidate()
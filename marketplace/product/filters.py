@@ -0,0 +1,66 @@
+import uuid
+from decimal import Decimal
+
+from flask_restx import inputs, reqparse
+from sqlalchemy import or_
+
+from marketplace.persistence.model import ProductItem, ProductStatus
+from marketplace.product.category_tree import category_tree
+
+product_filter_parser = reqparse.RequestParser()
+product_filter_parser.add_argument('category_id', type=uuid.UUID, location='args',
+                                   help='Only products of this category')
+product_filter_parser.add_argument('include_descendants', type=inputs.boolean, location='args',
+                                   default=False,
+                                   help='With category_id, also match its sub-categories')
+product_filter_parser.add_argument('seller_id', type=uuid.UUID, location='args')
+product_filter_parser.add_argument('status', location='args',
+                                   choices=[status.value for status in ProductStatus])
+product_filter_parser.add_argument('currency', location='args')
+product_filter_parser.add_argument('min_price', type=Decimal, location='args')
+product_filter_parser.add_argument('max_price', type=Decimal, location='args')
+product_filter_parser.add_argument('in_stock', type=inputs.boolean, location='args')
+product_filter_parser.add_argument('tags', action='split', location='args',
+                                   help='Comma separated tags')
+product_filter_parser.add_argument('tags_match', location='args', choices=('any', 'all'),
+                                   default='any',
+                                   help='Match products having any (default) or all of `tags`')
+
+
+def filter_products(query, args):
+    """
+    Narrow a ProductItem query with the `product_filter_parser` arguments.
+
+    Every filter is backed by an index declared on ProductItem: (column, created_at, id)
+    composites so a filtered keyset page stays an index range scan, a partial index for
+    `in_stock` and a GIN index for the `tags` array operators.
+    """
+    if args.get('category_id'):
+        if args.get('include_descendants'):
+            ids = category_tree.get().descendant_ids(args['category_id'])
+            query = query.filter(ProductItem.category_id.in_([uuid.UUID(i) for i in ids]))
+        else:
+            query = query.filter(ProductItem.category_id == args['category_id'])
+    if args.get('seller_id'):
+        query = query.filter(ProductItem.seller_id == args['seller_id'])
+    if args.get('status'):
+        query = query.filter(ProductItem.status == ProductStatus(args['status']))
+    if args.get('currency'):
+        query = query.filter(ProductItem.currency == args['currency'].upper())
+    if args.get('min_price') is not None:
+        query = query.filter(ProductItem.price >= args['min_price'])
+    if args.get('max_price') is not None:
+        query = query.filter(ProductItem.price <= args['max_price'])
+    if args.get('in_stock') is not None:
+        if args['in_stock']:
+            query = query.filter(ProductItem.stock_quantity > 0)
+        else:
+            query = query.filter(or_(ProductItem.stock_quantity <= 0,
+                                     ProductItem.stock_quantity.is_(None)))
+    tags = [tag.strip() for tag in args.get('tags') or [] if tag.strip()]
+    if tags:
+        if args.get('tags_match') == 'all':
+            query = query.filter(ProductItem.tags.contains(tags))
+        else:
+            query = query.filter(ProductItem.tags.overlap(tags))
+    return query
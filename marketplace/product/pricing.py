@@ -0,0 +1,129 @@
+import bisect
+from collections import defaultdict
+from datetime import datetime, timezone
+
+from flask import current_app
+from sqlalchemy import event, func, or_, select
+
+from marketplace import db
+from marketplace.persistence.model import ProductPricing
+from marketplace.persistence.snapshot import SnapshotCache
+
+_COLUMNS = (ProductPricing.id, ProductPricing.product_id, ProductPricing.base_price,
+            ProductPricing.discount_price, ProductPricing.currency,
+            ProductPricing.valid_from, ProductPricing.valid_to)
+
+
+def _price(row):
+    return {
+        'pricing_id': row.id,
+        'product_id': row.product_id,
+        'base_price': row.base_price,
+        'discount_price': row.discount_price,
+        'effective_price': row.discount_price if row.discount_price is not None
+        else row.base_price,
+        'currency': row.currency,
+        'valid_from': row.valid_from,
+        'valid_to': row.valid_to,
+    }
+
+
+def utc_naive(at):
+    """Pricing windows are stored as naive UTC"""
+    if at is None:
+        return datetime.utcnow()
+    if at.tzinfo is not None:
+        return at.astimezone(timezone.utc).replace(tzinfo=None)
+    return at
+
+
+def effective_prices(product_ids, at=None):
+    """
+    Resolve the price valid at `at` (default: now) for every id in `product_ids`.
+
+    :return: {product_id: price dict}, products without a valid price are left out
+    """
+    if current_app.config.get('PRICE_INDEX_ENABLED'):
+        index = price_index.get()
+        if at is None or index.covers(utc_naive(at)):
+            return index.lookup(product_ids, utc_naive(at))
+    return query_effective_prices(product_ids, utc_naive(at))
+
+
+def query_effective_prices(product_ids, at):
+    """
+    One round trip for the whole batch: `DISTINCT ON (product_id)` over the windows
+    covering `at`, newest `valid_from` first, served by the (product_id, valid_from)
+    index.
+    """
+    if not product_ids:
+        return {}
+    rows = db.session.execute(
+        select(*_COLUMNS)
+        .where(ProductPricing.product_id.in_(product_ids),
+               ProductPricing.valid_from <= at,
+               or_(ProductPricing.valid_to.is_(None), ProductPricing.valid_to > at))
+        .order_by(ProductPricing.product_id, ProductPricing.valid_from.desc())
+        .distinct(ProductPricing.product_id)
+    )
+    return {row.product_id: _price(row) for row in rows}
+
+
+class PriceIntervalIndex:
+    """
+    In-memory copy of the pricing windows that are still open when it is loaded,
+    per product sorted by `valid_from`, answering `lookup` with a bisect instead of a
+    query. Instants before the load time may need closed windows and are not covered.
+    """
+
+    def __init__(self, windows, loaded_at):
+        self._windows = windows
+        self._starts = {product_id: [price['valid_from'] for price in prices]
+                        for product_id, prices in windows.items()}
+        self.loaded_at = loaded_at
+
+    def covers(self, at):
+        return at >= self.loaded_at
+
+    def lookup(self, product_ids, at):
+        found = {}
+        for product_id in product_ids:
+            prices = self._windows.get(product_id)
+            if not prices:
+                continue
+            # Latest window starting at or before `at` that hasn't ended yet
+            position = bisect.bisect_right(self._starts[product_id], at)
+            for price in reversed(prices[:position]):
+                if price['valid_to'] is None or price['valid_to'] > at:
+                    found[product_id] = price
+                    break
+        return found
+
+
+def load_price_index():
+    loaded_at = datetime.utcnow()
+    rows = db.session.execute(
+        select(*_COLUMNS)
+        .where(or_(ProductPricing.valid_to.is_(None), ProductPricing.valid_to > loaded_at))
+        .order_by(ProductPricing.product_id, ProductPricing.valid_from)
+    )
+    windows = defaultdict(list)
+    for row in rows:
+        windows[row.product_id].append(_price(row))
+    return PriceIntervalIndex(dict(windows), loaded_at)
+
+
+def price_index_version():
+    return db.session.execute(
+        select(func.count(ProductPricing.id), func.max(ProductPricing.updated_at))
+    ).one()
+
+
+price_index = SnapshotCache(load_price_index, price_index_version, 'PRICE_INDEX_CHECK_SECONDS')
+
+
+@event.listens_for(ProductPricing, 'after_insert')
+@event.listens_for(ProductPricing, 'after_update')
+@event.listens_for(ProductPricing, 'after_delete')
+def _invalidate_price_index(mapper, connection, target):
+    price_index.invalidate()
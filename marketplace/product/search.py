@@ -0,0 +1,40 @@
+import re
+
+from flask_restx import reqparse
+
+from marketplace import db
+from marketplace.persistence.model import ProductItem
+
+search_parser = reqparse.RequestParser()
+search_parser.add_argument('q', required=True, location='args',
+                           help='Words to look for in product name, description and tags')
+
+_TERM = re.compile(r'\w+', re.UNICODE)
+
+
+def prefix_tsquery(text):
+    """
+    Turn free text into a `to_tsquery` expression that requires every word, matching
+    each one as a prefix (`shoe:* & runn:*`). Operators typed by the user are dropped.
+    """
+    return ' & '.join('{}:*'.format(term) for term in _TERM.findall(text.lower()))
+
+
+def search_products(text):
+    """
+    Query of `(ProductItem, rank)` rows matching `text`, through the GIN index on the
+    generated `search_vector` column, and its `(rank, id)` keyset keys. Page it
+    descending with `row_key=search_row_key`.
+    """
+    tsquery = db.func.to_tsquery('english', prefix_tsquery(text))
+    # ts_rank() is a float4: cast to double so the value the cursor carries compares
+    # equal to the one the next page's WHERE computes, ties would skip or repeat rows
+    rank = db.cast(db.func.ts_rank(ProductItem.search_vector, tsquery),
+                   db.Float(53)).label('rank')
+    query = (db.session.query(ProductItem, rank)
+             .filter(ProductItem.search_vector.op('@@')(tsquery)))
+    return query, (rank, ProductItem.id)
+
+
+def search_row_key(row, keys):
+    return row.rank, row.ProductItem.id
@@ -0,0 +1,156 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import case, func, select, update
+
+from marketplace import db
+from marketplace.http.cache import response_cache
+from marketplace.persistence.model import (ProductItem, ReservationStatus, StockReservation,
+                                           StockReservationItem)
+
+
+class BasketError(ValueError):
+    pass
+
+
+class InsufficientStock(Exception):
+    """Some SKUs of a basket are unknown or short of stock, nothing was reserved"""
+
+    def __init__(self, skus):
+        super().__init__('Insufficient stock for {}'.format(', '.join(skus)))
+        self.skus = skus
+
+
+class ReservationClosed(Exception):
+    """The reservation was already committed, released or has expired"""
+
+
+def parse_basket(items, max_items):
+    """{sku: quantity} of a `[{'sku': ..., 'quantity': ...}]` basket, repeated SKUs added up"""
+    if not isinstance(items, list) or not items:
+        raise BasketError('items must be a non-empty list')
+    basket = {}
+    for item in items:
+        if not isinstance(item, dict) or not isinstance(item.get('sku'), str):
+            raise BasketError('every item needs a sku')
+        quantity = item.get('quantity')
+        if isinstance(quantity, bool) or not isinstance(quantity, int) or quantity < 1:
+            raise BasketError('quantity of {} must be a positive integer'.format(item['sku']))
+        basket[item['sku']] = basket.get(item['sku'], 0) + quantity
+    if len(basket) > max_items:
+        raise BasketError('at most {} SKUs per reservation'.format(max_items))
+    return basket
+
+
+def _locked_products(*criteria):
+    # Products are locked in id order before they are updated, so two baskets sharing
+    # SKUs queue up behind each other instead of deadlocking
+    return ProductItem.id.in_(
+        select(ProductItem.id).where(*criteria).order_by(ProductItem.id).with_for_update())
+
+
+def reserve(user_id, basket, ttl):
+    """
+    Take the quantities of `basket` ({sku: quantity}) out of stock for `ttl` seconds.
+
+    One conditional `UPDATE ... WHERE stock_quantity >= n RETURNING` decrements every
+    SKU that has enough stock. Postgres re-checks the condition against the latest
+    committed row when a concurrent buyer got there first, so stock never goes
+    negative. Unless every SKU came back the transaction is rolled back and nothing is
+    reserved.
+
+    :raises InsufficientStock: listing the unknown or short SKUs
+    """
+    quantity = case(basket, value=ProductItem.sku)
+    rows = db.session.execute(
+        update(ProductItem)
+        .where(_locked_products(ProductItem.sku.in_(basket)),
+               ProductItem.stock_quantity >= quantity)
+        .values(stock_quantity=ProductItem.stock_quantity - quantity)
+        .returning(ProductItem.id, ProductItem.sku)
+        .execution_options(synchronize_session=False)
+    ).all()
+    if len(rows) < len(basket):
+        db.session.rollback()
+        reserved = {row.sku for row in rows}
+        raise InsufficientStock(sorted(sku for sku in basket if sku not in reserved))
+
+    reservation = StockReservation(user_id=user_id, status=ReservationStatus.HELD,
+                                   expires_at=datetime.utcnow() + timedelta(seconds=ttl))
+    reservation.items = [StockReservationItem(product_id=row.id, sku=row.sku,
+                                              quantity=basket[row.sku]) for row in rows]
+    db.session.add(reservation)
+    db.session.commit()
+    response_cache.invalidate('products')
+    return reservation
+
+
+def commit(reservation_id):
+    """
+    Make a held reservation final: the stock it took stays out for good.
+
+    :raises ReservationClosed: when it is no longer held or has expired
+    """
+    committed = db.session.execute(
+        update(StockReservation)
+        .where(StockReservation.id == reservation_id,
+               StockReservation.status == ReservationStatus.HELD,
+               StockReservation.expires_at > datetime.utcnow())
+        .values(status=ReservationStatus.COMMITTED)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.session.commit()
+    if not committed:
+        raise ReservationClosed()
+
+
+def release(reservation_id):
+    """
+    Put the stock of a held reservation back.
+
+    :raises ReservationClosed: when it was already committed or released
+    """
+    if not _release(StockReservation.id == reservation_id):
+        raise ReservationClosed()
+
+
+def release_expired(batch_size=1000):
+    """Release the held reservations past their expiry, returns how many were released"""
+    expired = (select(StockReservation.id)
+               .where(StockReservation.status == ReservationStatus.HELD,
+                      StockReservation.expires_at <= datetime.utcnow())
+               .limit(batch_size)
+               .with_for_update(skip_locked=True))
+    total = 0
+    while True:
+        released = len(_release(StockReservation.id.in_(expired)))
+        total += released
+        if released < batch_size:
+            return total
+
+
+def _release(criterion):
+    # Only the statement flipping HELD to RELEASED decides, a reservation released or
+    # committed concurrently matches nothing and its stock is not returned twice
+    ids = db.session.execute(
+        update(StockReservation)
+        .where(criterion, StockReservation.status == ReservationStatus.HELD)
+        .values(status=ReservationStatus.RELEASED)
+        .returning(StockReservation.id)
+        .execution_options(synchronize_session=False)
+    ).scalars().all()
+    if ids:
+        quantities = dict(db.session.execute(
+            select(StockReservationItem.product_id, func.sum(StockReservationItem.quantity))
+            .where(StockReservationItem.reservation_id.in_(ids))
+            .group_by(StockReservationItem.product_id)
+        ).all())
+        quantity = case(quantities, value=ProductItem.id)
+        db.session.execute(
+            update(ProductItem)
+            .where(_locked_products(ProductItem.id.in_(quantities)))
+            .values(stock_quantity=func.coalesce(ProductItem.stock_quantity, 0) + quantity)
+            .execution_options(synchronize_session=False))
+    db.session.commit()
+    if ids:
+        response_cache.invalidate('products')
+    return ids
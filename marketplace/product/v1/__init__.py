@@ -1 +1,2 @@
-from marketplace.product.v1.routes import category_ns, product_ns, pricing_ns   # noqa
+from marketplace.product.v1.routes import (category_ns, product_ns, pricing_ns,   # noqa
+                                           reservation_ns)
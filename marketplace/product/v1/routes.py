@@ -1,20 +1,39 @@
-from flask import request
-from flask_restx import Resource, Namespace, fields
+import uuid
+
+from flask import current_app, request
+from flask_restx import Resource, Namespace, fields, inputs, reqparse
 
 from marketplace import db
 from marketplace.auth.utils import token_required
+from marketplace.http.cache import response_cache
+from marketplace.http.conditional import is_conditional
+from marketplace.http.expand import embedded, with_expansions
+from marketplace.http.idempotency import idempotency
+from marketplace.http.pagination import page_validators, paginate, pagination_parser
+from marketplace.http.ratelimit import limiter
+from marketplace.http.serializer import page_response
+from marketplace.http.streaming import (NDJSON_MIMETYPE, ndjson_response, stream_ndjson,
+                                        stream_parser, wants_ndjson)
 from marketplace.persistence.model import (ProductCategory,
-                                           ProductItem, ProductPricing)
+                                           ProductItem, ProductPricing, StockReservation)
+from marketplace.product import stock
+from marketplace.product.bulk import ingest_products, iter_ndjson
+from marketplace.product.category_tree import category_tree
+from marketplace.product.filters import filter_products, product_filter_parser
+from marketplace.product.pricing import effective_prices
+from marketplace.product.search import (prefix_tsquery, search_parser, search_products,
+                                        search_row_key)
 from marketplace.product.v1.serializers import (
     category_schema, categories_schema,
-    product_schema, products_schema,
-    pricing_schema, pricings_schema
+    product_expand, product_fields, product_schema,
+    pricing_fields, pricing_schema, reservation_schema
 )
 
 # Create namespaces
 category_ns = Namespace('categories', description='Product category operations')
 product_ns = Namespace('products', description='Product operations')
 pricing_ns = Namespace('pricing', description='Product pricing operations')
+reservation_ns = Namespace('reservations', description='Stock reservation operations')
 
 # API Models
 category_model = category_ns.model('Category', {
@@ -23,6 +42,17 @@ category_model = category_ns.model('Category', {
     'description': fields.String(required=False, description='Category description')
 })
 
+category_node = category_ns.model('CategoryNode', {
+    'id': fields.String(description='Category ID'),
+    'name': fields.String(description='Category name'),
+    'parent_id': fields.String(description='Parent category ID'),
+    'description': fields.String(description='Category description'),
+    'created_at': fields.DateTime(description='Creation date'),
+    'updated_at': fields.DateTime(description='Last update date'),
+})
+category_node['children'] = fields.List(fields.Nested(category_node),
+                                        description='Child categories')
+
 product_model = product_ns.model('Product', {
     'seller_id': fields.String(required=True, description='Seller ID'),
     'category_id': fields.String(required=True, description='Category ID'),
@@ -37,6 +67,19 @@ product_model = product_ns.model('Product', {
     'attributes': fields.Raw(description='Product attributes')
 })
 
+bulk_result = product_ns.model('BulkProductResult', {
+    'index': fields.Integer(description='Position of the row in the request'),
+    'status': fields.String(description='`created` or `error`'),
+    'id': fields.String(description='ID of the created product'),
+    'error': fields.String(description='Why the row was rejected')
+})
+
+bulk_response = product_ns.model('BulkProductResponse', {
+    'created': fields.Integer(description='Rows inserted'),
+    'failed': fields.Integer(description='Rows rejected'),
+    'results': fields.List(fields.Nested(bulk_result))
+})
+
 pricing_model = pricing_ns.model('Pricing', {
     'product_id': fields.String(required=True, description='Product ID'),
     'base_price': fields.Float(required=True, description='Base price'),
@@ -46,15 +89,74 @@ pricing_model = pricing_ns.model('Pricing', {
     'valid_to': fields.DateTime(description='Valid to date')
 })
 
+reservation_item = reservation_ns.model('ReservationItem', {
+    'sku': fields.String(required=True, description='Stock Keeping Unit'),
+    'quantity': fields.Integer(required=True, min=1, description='Units to reserve')
+})
+
+reservation_model = reservation_ns.model('Reservation', {
+    'items': fields.List(fields.Nested(reservation_item), required=True,
+                         description='Basket to reserve, all or nothing')
+})
+
+reservation_response = reservation_ns.model('ReservationResponse', {
+    'id': fields.String(description='Reservation ID'),
+    'user_id': fields.Integer(description='Buyer'),
+    'status': fields.String(description='`held`, `committed` or `released`'),
+    'items': fields.List(fields.Nested(reservation_ns.model('ReservedItem', {
+        'product_id': fields.String(description='Product ID'),
+        'sku': fields.String(description='Stock Keeping Unit'),
+        'quantity': fields.Integer(description='Units reserved')
+    }))),
+    'expires_at': fields.DateTime(description='Released automatically after this date'),
+    'created_at': fields.DateTime(description='Creation date'),
+    'updated_at': fields.DateTime(description='Last update date')
+})
+
+
+effective_price_parser = reqparse.RequestParser()
+effective_price_parser.add_argument('product_id', type=uuid.UUID, action='split', required=True,
+                                    location='args', help='Comma separated product IDs')
+effective_price_parser.add_argument('at', type=inputs.datetime_from_iso8601, location='args',
+                                    help='Instant to resolve prices at, defaults to now')
+
+effective_price = pricing_ns.model('EffectivePrice', {
+    'pricing_id': fields.String(description='Pricing record in effect'),
+    'product_id': fields.String(description='Product ID'),
+    'base_price': fields.String(description='Base price'),
+    'discount_price': fields.String(description='Discount price'),
+    'effective_price': fields.String(description='Discount price if any, else base price'),
+    'currency': fields.String(description='Currency code'),
+    'valid_from': fields.DateTime(description='Valid from date'),
+    'valid_to': fields.DateTime(description='Valid to date')
+})
+
+effective_prices_response = pricing_ns.model('EffectivePrices', {
+    '*': fields.Wildcard(fields.Nested(effective_price, allow_null=True))
+})
+
 
 # Category Routes
 @category_ns.route('/')
 class CategoryList(Resource):
     @category_ns.doc('list_categories')
+    @category_ns.expect(pagination_parser, stream_parser)
+    @response_cache.cached('categories')
     def get(self):
-        """List all categories"""
-        categories = ProductCategory.query.all()
-        return categories_schema.dump(categories)
+        """List categories, one keyset page at a time"""
+        keys = (ProductCategory.created_at, ProductCategory.id)
+        query = ProductCategory.query
+        if wants_ndjson():
+            return stream_ndjson(query.order_by(*keys), category_schema)
+
+        args = pagination_parser.parse_args()
+        if is_conditional():
+            validators = page_validators(query, keys, ProductCategory.updated_at, **args)
+            if validators.matches():
+                return validators.not_modified()
+
+        page = paginate(query, keys, updated_at=ProductCategory.updated_at, **args)
+        return page_response(categories_schema, page)
 
     @category_ns.doc('create_category')
     @category_ns.expect(category_model)
@@ -67,50 +169,285 @@ class CategoryList(Resource):
         category = ProductCategory(**data)
         db.session.add(category)
         db.session.commit()
+        response_cache.invalidate('categories')
         return category_schema.dump(category), 201
 
 
+@category_ns.route('/tree')
+class CategoryTree(Resource):
+    @category_ns.doc('category_tree')
+    @category_ns.response(200, 'Success', [category_node])
+    def get(self):
+        """The whole category hierarchy, nested"""
+        return category_tree.get().roots
+
+
+@category_ns.route('/<uuid:id>/subtree')
+@category_ns.param('id', 'The category identifier')
+class CategorySubtree(Resource):
+    @category_ns.doc('category_subtree')
+    @category_ns.response(200, 'Success', category_node)
+    @category_ns.response(404, 'Category not found')
+    def get(self, id):
+        """A category and everything below it, nested"""
+        node = category_tree.get().subtree(id)
+        if node is None:
+            return {'message': 'Category not found'}, 404
+        return node
+
+
 # Product Routes
 @product_ns.route('/')
 class ProductList(Resource):
     @product_ns.doc('list_products')
+    @product_ns.expect(pagination_parser, stream_parser, product_filter_parser,
+                       product_expand.parser, product_fields.parser)
+    @limiter.limit('RATELIMIT_PRODUCT_LIST')
+    @response_cache.cached('products', 'categories', 'pricing')
     def get(self):
-        """List all products"""
-        products = ProductItem.query.all()
-        return products_schema.dump(products)
+        """List products, one keyset page at a time"""
+        keys = (ProductItem.created_at, ProductItem.id)
+        query = filter_products(ProductItem.query, product_filter_parser.parse_args())
+        expand = product_expand.requested()
+        fields = product_fields.requested()
+        selected = product_fields.restrict(with_expansions(query, expand), fields,
+                                           ProductItem.updated_at, *keys)
+        schema = product_fields.schema(fields)
+        if wants_ndjson():
+            return stream_ndjson(selected.order_by(*keys), schema, expand)
+
+        args = pagination_parser.parse_args()
+        # Embedded objects change without touching these rows, expanded pages carry no
+        # validators
+        updated_at = None if expand else ProductItem.updated_at
+        if updated_at is not None and is_conditional():
+            validators = page_validators(query, keys, updated_at, fields, **args)
+            if validators.matches():
+                return validators.not_modified()
+
+        page = paginate(selected, keys, updated_at=updated_at, fields=fields, **args)
+        return page_response(schema, page, extras=embedded(expand, page.items))
 
     @product_ns.doc('create_product')
     @product_ns.expect(product_model)
     @product_ns.response(201, 'Product created')
+    @product_ns.param('Idempotency-Key', 'Replays the first response to retries', _in='header')
     @product_ns.doc(security='apikey')
     @token_required
+    @idempotency.idempotent
     def post(self, current_user):
         """Create a new product"""
         data = request.get_json()
         product = ProductItem(**data)
         db.session.add(product)
         db.session.commit()
+        response_cache.invalidate('products')
         return product_schema.dump(product), 201
 
 
+@product_ns.route('/search')
+class ProductSearch(Resource):
+    @product_ns.doc('search_products')
+    @product_ns.expect(search_parser, pagination_parser, product_filter_parser,
+                       product_expand.parser, product_fields.parser)
+    @product_ns.response(400, 'Missing search terms')
+    @limiter.limit('RATELIMIT_PRODUCT_LIST')
+    def get(self):
+        """Full-text search over products, best matches first"""
+        text = search_parser.parse_args()['q']
+        if not prefix_tsquery(text):
+            return {'message': 'Search terms are required'}, 400
+
+        query, keys = search_products(text)
+        query = filter_products(query, product_filter_parser.parse_args())
+        expand = product_expand.requested()
+        fields = product_fields.requested()
+        query = product_fields.restrict(with_expansions(query, expand), fields, *keys)
+        args = pagination_parser.parse_args()
+        page = paginate(query, keys, descending=True, row_key=search_row_key, **args)
+        page = page._replace(items=[row.ProductItem for row in page.items])
+        return page_response(product_fields.schema(fields), page,
+                             extras=embedded(expand, page.items))
+
+
+@product_ns.route('/bulk')
+class ProductBulk(Resource):
+    @product_ns.doc('bulk_create_products')
+    @product_ns.expect([product_model])
+    @product_ns.response(200, 'Per-row results', bulk_response)
+    @product_ns.response(400, 'Validation error')
+    @product_ns.doc(security='apikey')
+    @token_required
+    def post(self, current_user):
+        """Create many products from a JSON array or an NDJSON body
+
+        NDJSON bodies are read and answered line by line, one result per input row.
+        """
+        batch_size = current_app.config.get('PRODUCT_BULK_BATCH_SIZE', 1000)
+        if request.mimetype == NDJSON_MIMETYPE:
+            results = ingest_products(iter_ndjson(request.stream), batch_size)
+            return ndjson_response(results, batch_size)
+
+        data = request.get_json()
+        if not isinstance(data, list):
+            return {'message': 'Expected a JSON array of products'}, 400
+
+        results = list(ingest_products(data, batch_size))
+        created = sum(1 for result in results if result['status'] == 'created')
+        return {'created': created, 'failed': len(results) - created, 'results': results}
+
+
 # Pricing Routes
 @pricing_ns.route('/')
 class PricingList(Resource):
     @pricing_ns.doc('list_pricing')
+    @pricing_ns.expect(pagination_parser, stream_parser, pricing_fields.parser)
     def get(self):
-        """List all pricing records"""
-        pricing = ProductPricing.query.all()
-        return pricings_schema.dump(pricing)
+        """List pricing records, one keyset page at a time"""
+        keys = (ProductPricing.created_at, ProductPricing.id)
+        query = ProductPricing.query
+        fields = pricing_fields.requested()
+        selected = pricing_fields.restrict(query, fields, ProductPricing.updated_at, *keys)
+        schema = pricing_fields.schema(fields)
+        if wants_ndjson():
+            return stream_ndjson(selected.order_by(*keys), schema)
+
+        args = pagination_parser.parse_args()
+        if is_conditional():
+            validators = page_validators(query, keys, ProductPricing.updated_at, fields, **args)
+            if validators.matches():
+                return validators.not_modified()
+
+        page = paginate(selected, keys, updated_at=ProductPricing.updated_at, fields=fields,
+                        **args)
+        return page_response(schema, page)
 
     @pricing_ns.doc('create_pricing')
     @pricing_ns.expect(pricing_model)
     @pricing_ns.response(201, 'Pricing created')
+    @pricing_ns.param('Idempotency-Key', 'Replays the first response to retries', _in='header')
     @pricing_ns.doc(security='apikey')
     @token_required
+    @idempotency.idempotent
     def post(self, current_user):
         """Create a new pricing record"""
         data = request.get_json()
         pricing = ProductPricing(**data)
         db.session.add(pricing)
         db.session.commit()
+        response_cache.invalidate('pricing')
         return pricing_schema.dump(pricing), 201
+
+
+@pricing_ns.route('/effective')
+class EffectivePricing(Resource):
+    @pricing_ns.doc('effective_pricing')
+    @pricing_ns.expect(effective_price_parser)
+    @pricing_ns.response(200, 'Prices keyed by product ID, null when none is valid',
+                         effective_prices_response)
+    @pricing_ns.response(400, 'Validation error')
+    def get(self):
+        """Resolve the price in effect for many products at once"""
+        args = effective_price_parser.parse_args()
+        product_ids = list(dict.fromkeys(args['product_id']))
+        if len(product_ids) > current_app.config.get('PRICE_RESOLVE_MAX_IDS', 500):
+            return {'message': 'Too many product IDs'}, 400
+
+        prices = effective_prices(product_ids, args['at'])
+        return {str(product_id): prices.get(product_id) for product_id in product_ids}
+
+
+# Reservation Routes
+@reservation_ns.route('/')
+class ReservationList(Resource):
+    @reservation_ns.doc('create_reservation')
+    @reservation_ns.expect(reservation_model)
+    @reservation_ns.response(201, 'Stock reserved', reservation_response)
+    @reservation_ns.response(400, 'Validation error')
+    @reservation_ns.response(409, 'Insufficient stock, nothing reserved')
+    @reservation_ns.param('Idempotency-Key', 'Replays the first response to retries', _in='header')
+    @reservation_ns.doc(security='apikey')
+    @token_required
+    @idempotency.idempotent
+    def post(self, current_user):
+        """Reserve stock for a whole basket of SKUs, all or nothing"""
+        data = request.get_json(silent=True) or {}
+        try:
+            basket = stock.parse_basket(
+                data.get('items'), current_app.config.get('STOCK_RESERVATION_MAX_ITEMS', 100))
+            reservation = stock.reserve(
+                current_user.id, basket,
+                current_app.config.get('STOCK_RESERVATION_TTL_SECONDS', 900))
+        except stock.BasketError as e:
+            return {'message': str(e)}, 400
+        except stock.InsufficientStock as e:
+            return {'message': 'Insufficient stock', 'skus': e.skus}, 409
+        return reservation_schema.dump(reservation), 201
+
+
+def _owned_reservation(current_user, id):
+    """The reservation `id`, or the error response when it is missing or someone else's"""
+    reservation = StockReservation.query.get(id)
+    if reservation is None:
+        return None, ({'message': 'Reservation not found'}, 404)
+    if not current_user.is_admin and reservation.user_id != current_user.id:
+        return None, ({'message': 'Access denied'}, 403)
+    return reservation, None
+
+
+@reservation_ns.route('/<uuid:id>')
+@reservation_ns.param('id', 'The reservation identifier')
+class Reservation(Resource):
+    @reservation_ns.doc('get_reservation')
+    @reservation_ns.response(200, 'Success', reservation_response)
+    @reservation_ns.response(404, 'Reservation not found')
+    @reservation_ns.doc(security='apikey')
+    @token_required
+    def get(self, current_user, id):
+        """Get a reservation"""
+        reservation, error = _owned_reservation(current_user, id)
+        if error:
+            return error
+        return reservation_schema.dump(reservation)
+
+
+@reservation_ns.route('/<uuid:id>/commit')
+@reservation_ns.param('id', 'The reservation identifier')
+class ReservationCommit(Resource):
+    @reservation_ns.doc('commit_reservation')
+    @reservation_ns.response(200, 'Reservation committed', reservation_response)
+    @reservation_ns.response(404, 'Reservation not found')
+    @reservation_ns.response(409, 'Reservation already committed, released or expired')
+    @reservation_ns.doc(security='apikey')
+    @token_required
+    def post(self, current_user, id):
+        """Make a held reservation final, e.g. once the order is paid"""
+        reservation, error = _owned_reservation(current_user, id)
+        if error:
+            return error
+        try:
+            stock.commit(id)
+        except stock.ReservationClosed:
+            return {'message': 'Reservation is no longer held'}, 409
+        return reservation_schema.dump(reservation)
+
+
+@reservation_ns.route('/<uuid:id>/release')
+@reservation_ns.param('id', 'The reservation identifier')
+class ReservationRelease(Resource):
+    @reservation_ns.doc('release_reservation')
+    @reservation_ns.response(200, 'Stock put back', reservation_response)
+    @reservation_ns.response(404, 'Reservation not found')
+    @reservation_ns.response(409, 'Reservation already committed or released')
+    @reservation_ns.doc(security='apikey')
+    @token_required
+    def post(self, current_user, id):
+        """Put the stock of a held reservation back"""
+        reservation, error = _owned_reservation(current_user, id)
+        if error:
+            return error
+        try:
+            stock.release(id)
+        except stock.ReservationClosed:
+            return {'message': 'Reservation is no longer held'}, 409
+        return reservation_schema.dump(reservation)
@@ -1,5 +1,11 @@
+from sqlalchemy.orm import joinedload
+
 from marketplace import ma
-from marketplace.persistence.model import ProductCategory, ProductItem, ProductPricing
+from marketplace.http.expand import Expandable, Expansion
+from marketplace.http.sparse import Fieldset
+from marketplace.persistence.model import (ProductCategory, ProductItem, ProductPricing,
+                                           StockReservation, StockReservationItem)
+from marketplace.product.pricing import effective_prices
 
 
 class ProductCategorySchema(ma.Schema):
@@ -23,6 +29,20 @@ class ProductPricingSchema(ma.Schema):
                   'valid_from', 'valid_to', 'created_at', 'updated_at')
 
 
+class StockReservationItemSchema(ma.Schema):
+    class Meta:
+        model = StockReservationItem
+        fields = ('product_id', 'sku', 'quantity')
+
+
+class StockReservationSchema(ma.Schema):
+    items = ma.Nested(StockReservationItemSchema, many=True)
+
+    class Meta:
+        model = StockReservation
+        fields = ('id', 'user_id', 'status', 'items', 'expires_at', 'created_at', 'updated_at')
+
+
 # Initialize schemas
 category_schema = ProductCategorySchema()
 categories_schema = ProductCategorySchema(many=True)
@@ -30,3 +50,23 @@ product_schema = ProductItemSchema()
 products_schema = ProductItemSchema(many=True)
 pricing_schema = ProductPricingSchema()
 pricings_schema = ProductPricingSchema(many=True)
+reservation_schema = StockReservationSchema()
+product_fields = Fieldset(product_schema)
+pricing_fields = Fieldset(pricing_schema)
+
+
+def _current_prices(products):
+    # One batched lookup for the whole page instead of one per product
+    prices = effective_prices([product.id for product in products])
+    return [prices.get(product.id) for product in products]
+
+
+# `?expand=` options: the category comes joined into the same query, current prices are
+# resolved for the whole page at once (see marketplace.product.pricing)
+product_expand = Expandable(
+    category=Expansion([joinedload(ProductItem.category)],
+                       lambda products: [category_schema.dump(product.category)
+                                         if product.category is not None else None
+                                         for product in products]),
+    current_price=Expansion([], _current_prices),
+)
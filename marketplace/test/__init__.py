@@ -25,3 +25,6 @@ class BaseTestCase(TestCase):
     def tearDown(self):
         db.session.remove()
         db.drop_all()
+        # Every test builds its own app, close its pools rather than wait for the GC
+        for engine in db.engines.values():
+            engine.dispose()
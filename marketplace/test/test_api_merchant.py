@@ -1,7 +1,15 @@
 import json
-from unittest.mock import patch
+import multiprocessing
+import threading
+import time
 
-from marketplace.persistence.model import Merchant, User, UserSession
+from flask import Flask
+from werkzeug.test import EnvironBuilder
+
+from marketplace.auth.utils import generate_token
+from marketplace.http.cache import response_cache
+from marketplace.http.idempotency import Idempotency
+from marketplace.persistence.model import Merchant, SharedEntry, User
 from marketplace.test import BaseTestCase, Constants
 
 
@@ -17,46 +25,257 @@ def init_data():
     merchant.name = Constants.MERCHANT_NAME
     merchant.description = Constants.MERCHANT_DESC
     merchant.city = Constants.MERCHANT_CITY
+    merchant.owner_id = user.id
     merchant.save()
 
 
 class MerchantApiTestCase(BaseTestCase):
 
-    # This decorator will mock a function authorize_user_token()
-    @patch('marketplace.v1.authorize_user_token')
-    def test_get_merchant_list_ok(self, mock_session):
+    def test_get_merchant_list_ok(self):
         # Init required data for testing purpose
         init_data()
+        merchant = Merchant.query.first()
 
-        # mock'ed authorize_user_token() will return this value
-        mock_session.return_value = UserSession()
-
-        uri = '/api/v1/merchant/data?id=1'
+        uri = '/merchant/{}'.format(merchant.id)
 
-        response = self.client.get(uri, headers={
-            'Content-Type': 'application/json',
-            'auth-token-key': "ABCDEFGH12345",
-            'username-key': '{}'.format(Constants.USERNAME)})
+        response = self.client.get(uri, headers={'Content-Type': 'application/json'})
 
         # Assert HTTP Response
         self.assertEquals(response.status_code, 200)
         json_result = json.loads(response.data)
-        self.assertEquals(json_result.get('merchant_name'), Constants.MERCHANT_NAME)
+        self.assertEquals(json_result.get('name'), Constants.MERCHANT_NAME)
 
-    @patch('marketplace.v1.authorize_user_token')
-    def test_get_merchant_list_nok(self, mock_session):
+    def test_get_merchant_list_nok(self):
         # Init required data for testing purpose
         init_data()
+        merchant = Merchant.query.first()
 
-        # mock'ed authorize_user_token() will return this value
-        mock_session.return_value = UserSession()
-
-        uri = '/api/v1/merchant/data?id=2'
+        uri = '/merchant/{}'.format(merchant.id + 1)
 
-        response = self.client.get(uri, headers={
-            'Content-Type': 'application/json',
-            'auth-token-key': "ABCDEFGH12345",
-            'username-key': '{}'.format(Constants.USERNAME)})
+        response = self.client.get(uri, headers={'Content-Type': 'application/json'})
 
         # Assert HTTP Response
         self.assertEquals(response.status_code, 404)
+
+    def test_get_merchant_list_not_modified(self):
+        init_data()
+
+        uri = '/merchant/?limit=10'
+
+        response = self.client.get(uri)
+        self.assertEquals(response.status_code, 200)
+        etag = response.headers.get('ETag')
+        self.assertTrue(etag.startswith('W/'))
+
+        response = self.client.get(uri, headers={'If-None-Match': etag})
+        self.assertEquals(response.status_code, 304)
+        self.assertEquals(response.headers.get('ETag'), etag)
+
+        # The sparse fieldset is another representation of the same rows
+        response = self.client.get(uri + '&fields=id,name')
+        fields_etag = response.headers.get('ETag')
+        self.assertNotEqual(fields_etag, etag)
+        response = self.client.get(uri + '&fields=id,name', headers={'If-None-Match': etag})
+        self.assertEquals(response.status_code, 200)
+        response = self.client.get(uri + '&fields=id,name',
+                                   headers={'If-None-Match': fields_etag})
+        self.assertEquals(response.status_code, 304)
+
+        merchant = Merchant.query.first()
+        headers = {'Authorization': 'Bearer {}'.format(generate_token(merchant.owner_id)),
+                   'Content-Type': 'application/json'}
+        response = self.client.put('/merchant/{}'.format(merchant.id),
+                                   data=json.dumps({'city': 'Bandung'}), headers=headers)
+        self.assertEquals(response.status_code, 200)
+
+        response = self.client.get(uri, headers={'If-None-Match': etag})
+        self.assertEquals(response.status_code, 200)
+        self.assertNotEqual(response.headers.get('ETag'), etag)
+
+    def test_get_merchant_not_modified(self):
+        init_data()
+        uri = '/merchant/{}'.format(Merchant.query.first().id)
+
+        etag = self.client.get(uri).headers.get('ETag')
+        fields_etag = self.client.get(uri + '?fields=id,name').headers.get('ETag')
+        self.assertNotEqual(fields_etag, etag)
+
+        # A copy of one fieldset does not validate another
+        response = self.client.get(uri + '?fields=id,name', headers={'If-None-Match': etag})
+        self.assertEquals(response.status_code, 200)
+        self.assertIn('name', json.loads(response.data))
+        response = self.client.get(uri, headers={'If-None-Match': fields_etag})
+        self.assertEquals(response.status_code, 200)
+        self.assertIn('city', json.loads(response.data))
+
+        response = self.client.get(uri + '?fields=id,name',
+                                   headers={'If-None-Match': fields_etag})
+        self.assertEquals(response.status_code, 304)
+
+    def test_get_merchant_cached_ok(self):
+        init_data()
+        merchant = Merchant.query.first()
+        headers = {'Authorization': 'Bearer {}'.format(generate_token(merchant.owner_id)),
+                   'Content-Type': 'application/json'}
+        uri = '/merchant/{}'.format(merchant.id)
+
+        response = self.client.get(uri)
+        self.assertEquals(response.headers.get('X-Cache'), 'MISS')
+        response = self.client.get(uri)
+        self.assertEquals(response.headers.get('X-Cache'), 'HIT')
+
+        # Updating the merchant invalidates its cached responses
+        response = self.client.put(uri, data=json.dumps({'city': 'Bandung'}), headers=headers)
+        self.assertEquals(response.status_code, 200)
+
+        response = self.client.get(uri)
+        self.assertEquals(response.headers.get('X-Cache'), 'MISS')
+        self.assertEquals(json.loads(response.data)['city'], 'Bandung')
+
+    def test_get_merchant_cache_invalidated_across_workers(self):
+        init_data()
+        merchant = Merchant.query.first()
+        uri = '/merchant/{}'.format(merchant.id)
+        self.assertEquals(self.client.get(uri).headers.get('X-Cache'), 'MISS')
+        self.assertEquals(self.client.get(uri).headers.get('X-Cache'), 'HIT')
+
+        # A write handled by another worker, whose memory:// bodies this process never sees
+        worker = multiprocessing.get_context('fork').Process(
+            target=response_cache.invalidate, args=['merchant:{}'.format(merchant.id)])
+        worker.start()
+        worker.join()
+        self.assertEquals(worker.exitcode, 0)
+        self.assertEquals(self.client.get(uri).headers.get('X-Cache'), 'MISS')
+
+    def test_get_merchant_cache_waiter_ok(self):
+        init_data()
+        uri = '/merchant/999'
+        with self.app.test_request_context(uri):
+            key, _ = response_cache._key(['merchant:999', 'users'])
+
+        # Another request is rendering this key and will not store its 404: once its
+        # lock is gone the waiter renders right away instead of polling for the lock time
+        response_cache.backend.add(key + ':lock', b'1', response_cache.lock_seconds)
+        threading.Timer(0.2, response_cache.backend.delete, [key + ':lock']).start()
+        started = time.monotonic()
+        response = self.client.get(uri)
+        self.assertEquals(response.status_code, 404)
+        self.assertLess(time.monotonic() - started, response_cache.lock_seconds / 2)
+
+    def test_get_metrics_ok(self):
+        init_data()
+        self.client.get('/merchant/')
+
+        response = self.client.get('/metrics')
+        self.assertEquals(response.status_code, 200)
+        body = response.data.decode()
+        self.assertIn('# TYPE http_request_duration_seconds histogram', body)
+        self.assertIn('http_request_duration_seconds_count{endpoint=', body)
+        self.assertIn('http_requests_in_flight{endpoint="metrics",method="GET"} 1', body)
+
+    def test_get_metrics_closed_stream_ok(self):
+        init_data()
+        # Bodies closed by the server before any of it was read, like a client hanging up
+        for path, headers in (('/nowhere', {}),
+                              ('/merchant/', {'Accept': 'application/x-ndjson'})):
+            environ = EnvironBuilder(path=path, headers=headers).get_environ()
+            self.app(environ, lambda status, response_headers: None).close()
+
+        body = self.client.get('/metrics').data.decode()
+        self.assertIn('http_request_duration_seconds_count'
+                      '{endpoint="none",method="GET",status="404"} 1', body)
+        self.assertRegex(body, r'http_request_duration_seconds_count'
+                               r'\{endpoint="merchants_merchant_list[^"]*",method="GET",'
+                               r'status="200"\} 1')
+        self.assertIn('http_requests_in_flight{endpoint="none",method="GET"} 0', body)
+        self.assertRegex(body, r'http_requests_in_flight'
+                               r'\{endpoint="merchants_merchant_list[^"]*",method="GET"\} 0')
+
+    def test_get_merchant_server_timing_ok(self):
+        init_data()
+        self.app.config['SQL_SERVER_TIMING'] = True
+
+        response = self.client.get('/merchant/')
+
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue(response.headers.get('Server-Timing').startswith('db;dur='))
+
+    def test_get_merchant_stats_ok(self):
+        init_data()
+        merchant = Merchant.query.first()
+        headers = {'Authorization': 'Bearer {}'.format(generate_token(merchant.owner_id)),
+                   'Content-Type': 'application/json'}
+
+        response = self.client.post('/merchant/', headers=headers, data=json.dumps(
+            {'name': 'Second Shop', 'city': Constants.MERCHANT_CITY}))
+        self.assertEquals(response.status_code, 201)
+
+        response = self.client.get('/merchant/?name_prefix=second')
+        self.assertEquals([item['name'] for item in json.loads(response.data)['items']],
+                          ['Second Shop'])
+
+        response = self.client.get('/merchant/stats')
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(json.loads(response.data), {
+            'items': [{'city': Constants.MERCHANT_CITY, 'merchant_count': 2}], 'total': 2})
+
+        # Moving a merchant to another city moves it between counters
+        response = self.client.put('/merchant/{}'.format(merchant.id), headers=headers,
+                                   data=json.dumps({'city': 'Bandung'}))
+        self.assertEquals(response.status_code, 200)
+
+        response = self.client.get('/merchant/stats')
+        self.assertEquals(json.loads(response.data)['items'], [
+            {'city': 'Bandung', 'merchant_count': 1},
+            {'city': Constants.MERCHANT_CITY, 'merchant_count': 1}])
+
+    def test_get_merchant_expand_owner_ok(self):
+        init_data()
+        merchant = Merchant.query.first()
+
+        response = self.client.get('/merchant/?expand=owner')
+        self.assertEquals(response.status_code, 200)
+        item = json.loads(response.data)['items'][0]
+        self.assertEquals(item['owner']['username'], Constants.USERNAME)
+        self.assertNotIn('password_hash', item['owner'])
+        # Anonymous callers only see the owner's public fields
+        self.assertEquals(sorted(item['owner']), ['id', 'username'])
+        self.assertNotIn('phone', item['owner'])
+
+        response = self.client.get('/merchant/{}?expand=owner'.format(merchant.id))
+        owner = json.loads(response.data)['owner']
+        self.assertEquals(owner['id'], merchant.owner_id)
+        self.assertNotIn('phone', owner)
+
+        response = self.client.get('/merchant/?expand=products')
+        self.assertEquals(response.status_code, 400)
+
+    def test_post_merchant_idempotent_ok(self):
+        init_data()
+        merchant = Merchant.query.first()
+        headers = {'Authorization': 'Bearer {}'.format(generate_token(merchant.owner_id)),
+                   'Content-Type': 'application/json',
+                   'Idempotency-Key': 'create-second-shop'}
+        payload = json.dumps({'name': 'Second Shop', 'city': Constants.MERCHANT_CITY})
+
+        first = self.client.post('/merchant/', headers=headers, data=payload)
+        retry = self.client.post('/merchant/', headers=headers, data=payload)
+        self.assertEquals(first.status_code, 201)
+        self.assertEquals(retry.status_code, 201)
+        self.assertEquals(retry.headers.get('Idempotent-Replayed'), 'true')
+        self.assertEquals(json.loads(retry.data)['id'], json.loads(first.data)['id'])
+        self.assertEquals(Merchant.query.filter_by(name='Second Shop').count(), 1)
+        # Stored where every worker finds it, not in this process
+        self.assertEquals(SharedEntry.query.count(), 1)
+
+        response = self.client.post('/merchant/', headers=headers,
+                                    data=json.dumps({'name': 'Third Shop'}))
+        self.assertEquals(response.status_code, 422)
+
+    def test_idempotency_memory_backend_single_process_only(self):
+        app = Flask(__name__)
+        app.config.update(IDEMPOTENCY_URL='memory://', SERVER_PROCESSES=2)
+        self.assertRaises(RuntimeError, Idempotency().init_app, app)
+
+        app.config['SERVER_PROCESSES'] = 1
+        Idempotency().init_app(app)
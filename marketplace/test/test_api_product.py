@@ -1,9 +1,15 @@
+import gzip
 import json
-from unittest.mock import patch
 from uuid import uuid4
 
+from marketplace import db
+from marketplace.auth.utils import generate_token
+from marketplace.http.encoding import json_default
+from marketplace.http.pagination import encode_cursor
+from marketplace.http.serializer import compiled
 from marketplace.persistence.model import (User, ProductCategory,
                                            ProductItem, ProductPricing, ProductStatus)
+from marketplace.product.v1.serializers import pricing_schema, product_schema
 from marketplace.test import BaseTestCase, Constants
 
 
@@ -13,13 +19,14 @@ def init_product_data():
     user.username = Constants.USERNAME
     user.password = Constants.PASSWORD
     user.phone = Constants.PHONE_NUMBER
-    user.save()
+    db.session.add(user)
 
     # Create test category
     category = ProductCategory()
     category.name = "Test Category"
     category.description = "Test Category Description"
-    category.save()
+    db.session.add(category)
+    db.session.flush()
 
     # Create test product
     product = ProductItem()
@@ -32,7 +39,8 @@ def init_product_data():
     product.stock_quantity = 10
     product.status = ProductStatus.ACTIVE
     product.sku = "TEST-SKU-001"
-    product.save()
+    db.session.add(product)
+    db.session.flush()
 
     # Create test pricing
     pricing = ProductPricing()
@@ -40,26 +48,50 @@ def init_product_data():
     pricing.base_price = 100.00
     pricing.currency = "USD"
     pricing.valid_from = "2024-01-01T00:00:00"
-    pricing.save()
+    db.session.add(pricing)
+    db.session.commit()
 
     return category, product, pricing
 
 
 class ProductApiTestCase(BaseTestCase):
-    @patch('marketplace.auth.utils.token_required')
-    def test_get_categories_ok(self, mock_auth):
+    @staticmethod
+    def token():
+        user = User.query.filter_by(username=Constants.USERNAME).first()
+        return generate_token(user.id)
+
+    def test_get_categories_ok(self):
         category, _, _ = init_product_data()
 
-        response = self.client.get('/api/v1/product/categories')
+        response = self.client.get('/product/categories/')
 
         self.assertEqual(response.status_code, 200)
         data = json.loads(response.data)
-        self.assertTrue(isinstance(data, list))
-        self.assertEqual(data[0]['name'], "Test Category")
+        self.assertTrue(isinstance(data['items'], list))
+        self.assertEqual(data['items'][0]['name'], "Test Category")
+
+    def test_get_category_tree_ok(self):
+        category, _, _ = init_product_data()
 
-    @patch('marketplace.auth.utils.token_required')
-    def test_create_category_ok(self, mock_auth):
-        mock_auth.return_value = True
+        child = ProductCategory()
+        child.name = "Child Category"
+        child.parent_id = category.id
+        db.session.add(child)
+        db.session.commit()
+
+        response = self.client.get('/product/categories/tree')
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]['children'][0]['name'], "Child Category")
+
+        response = self.client.get(
+            '/product/categories/{}/subtree'.format(child.id))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)['children'], [])
+
+    def test_create_category_ok(self):
+        init_product_data()
 
         payload = {
             "name": "New Category",
@@ -67,11 +99,11 @@ class ProductApiTestCase(BaseTestCase):
         }
 
         response = self.client.post(
-            '/api/v1/product/categories',
+            '/product/categories/',
             data=json.dumps(payload),
             headers={
                 'Content-Type': 'application/json',
-                'Authorization': f'Bearer test-token'  # noqa
+                'Authorization': 'Bearer {}'.format(self.token())
             }
         )
 
@@ -79,21 +111,177 @@ class ProductApiTestCase(BaseTestCase):
         data = json.loads(response.data)
         self.assertEqual(data['name'], "New Category")
 
-    @patch('marketplace.auth.utils.token_required')
-    def test_get_products_ok(self, mock_auth):
+    def test_get_products_ok(self):
         _, product, _ = init_product_data()
 
-        response = self.client.get('/api/v1/product/items')
+        response = self.client.get('/product/items/')
+
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertTrue(isinstance(data['items'], list))
+        self.assertEqual(data['items'][0]['name'], "Test Product")
+        self.assertIsNone(data['next_cursor'])
+
+    def test_compiled_serializer_matches_schema(self):
+        _, product, pricing = init_product_data()
+        product = ProductItem.query.get(product.id)
+        pricing = ProductPricing.query.get(pricing.id)
+
+        for schema, obj in ((product_schema, product), (pricing_schema, pricing)):
+            self.assertEqual(compiled(schema).dumps(obj),
+                             json.dumps(schema.dump(obj), default=json_default))
+
+    def test_get_products_follows_restx_json(self):
+        init_product_data()
+
+        # Debug mode: flask-restx indents, so the page is not written compact either.
+        # Every request has its own query string, none is served from the response cache
+        response = self.client.get('/product/items/?limit=10')
+        self.assertEqual(response.content_type, 'application/json')
+        self.assertEqual(response.data.decode(),
+                         json.dumps(json.loads(response.data), indent=4) + '\n')
+
+        self.app.debug = False
+        self.app.config['RESTX_JSON'].pop('indent', None)
+        response = self.client.get('/product/items/?limit=20')
+        self.assertEqual(response.data.decode(), json.dumps(json.loads(response.data)) + '\n')
+
+        self.app.config['RESTX_JSON']['sort_keys'] = True
+        response = self.client.get('/product/items/?limit=30')
+        self.assertEqual(response.data.decode(),
+                         json.dumps(json.loads(response.data), sort_keys=True) + '\n')
+
+    def test_get_products_paginated_ok(self):
+        category, product, _ = init_product_data()
+
+        second = ProductItem()
+        second.seller_id = uuid4()
+        second.category_id = category.id
+        second.name = "Second Product"
+        second.price = 50.00
+        second.currency = "USD"
+        second.sku = "TEST-SKU-003"
+        db.session.add(second)
+        db.session.commit()
+
+        response = self.client.get('/product/items/?limit=1')
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertEqual(len(data['items']), 1)
+        self.assertEqual(data['items'][0]['name'], "Test Product")
+        self.assertIsNotNone(data['next_cursor'])
 
+        response = self.client.get(
+            '/product/items/?limit=1&cursor={}'.format(data['next_cursor']))
         self.assertEqual(response.status_code, 200)
         data = json.loads(response.data)
-        self.assertTrue(isinstance(data, list))
-        self.assertEqual(data[0]['name'], "Test Product")
+        self.assertEqual(data['items'][0]['name'], "Second Product")
+        self.assertIsNone(data['next_cursor'])
+
+    def test_get_products_invalid_cursor_nok(self):
+        init_product_data()
+
+        response = self.client.get('/product/items/?cursor=not-a-cursor')
+
+        self.assertEqual(response.status_code, 400)
+
+        # Well-formed cursor whose id is a number instead of a UUID
+        response = self.client.get('/product/items/?cursor={}'.format(
+            encode_cursor(['2024-01-01T00:00:00', 42])))
+        self.assertEqual(response.status_code, 400)
+
+    def test_get_products_filtered_ok(self):
+        category, product, _ = init_product_data()
+
+        uri = '/product/items/?category_id={}&status=active&in_stock=true&min_price=50'
+        response = self.client.get(uri.format(category.id))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.data)['items']), 1)
+
+        response = self.client.get('/product/items/?seller_id={}'.format(uuid4()))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)['items'], [])
+
+        # Stored uppercase whatever the case it was written in, like the filter value
+        product.currency = 'idr'
+        db.session.commit()
+        self.assertEqual(product.currency, 'IDR')
+        response = self.client.get('/product/items/?currency=idr')
+        self.assertEqual(len(json.loads(response.data)['items']), 1)
+
+    def test_get_products_sparse_fields_ok(self):
+        _, product, _ = init_product_data()
+
+        response = self.client.get('/product/items/?fields=id,name,price,currency'
+                                   '&expand=category,current_price')
+        self.assertEqual(response.status_code, 200)
+        item = json.loads(response.data)['items'][0]
+        self.assertEqual(sorted(item), ['category', 'currency', 'current_price', 'id',
+                                        'name', 'price'])
+        self.assertEqual(item['id'], str(product.id))
+        self.assertEqual(item['category']['name'], "Test Category")
+        self.assertEqual(item['current_price']['base_price'], '100.00')
+
+        response = self.client.get('/product/items/?fields=name,secret')
+        self.assertEqual(response.status_code, 400)
+
+    def test_get_products_stream_gzip_ok(self):
+        init_product_data()
+
+        plain = self.client.get('/product/items/?stream=1')
+        response = self.client.get('/product/items/?stream=1',
+                                   headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertEqual(gzip.decompress(response.data), plain.data)
+
+    def test_search_products_ok(self):
+        init_product_data()
 
-    @patch('marketplace.auth.utils.token_required')
-    def test_create_product_ok(self, mock_auth):
+        response = self.client.get('/product/items/search?q=test prod')
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertEqual(data['items'][0]['name'], "Test Product")
+
+        response = self.client.get('/product/items/search?q=nothingmatches')
+        self.assertEqual(json.loads(response.data)['items'], [])
+
+    def test_search_products_paginated_ok(self):
+        category, _, _ = init_product_data()
+        for i in range(5):
+            db.session.add(ProductItem(seller_id=uuid4(), category_id=category.id,
+                                       name="Tagged {}".format(i), price=10, currency="USD",
+                                       sku="TAG-SKU-{}".format(i), tags=['Summer', None]))
+        db.session.commit()
+
+        # Tags are matched lowercased, NULL elements are skipped, and pages of tied
+        # ranks neither skip nor repeat rows
+        names, cursor = [], ''
+        for _ in range(6):
+            response = self.client.get('/product/items/search?q=summer&limit=2' + cursor)
+            self.assertEqual(response.status_code, 200)
+            data = json.loads(response.data)
+            names += [item['name'] for item in data['items']]
+            if data['next_cursor'] is None:
+                break
+            cursor = '&cursor=' + data['next_cursor']
+        self.assertEqual(sorted(names), ["Tagged {}".format(i) for i in range(5)])
+
+    def test_get_products_stream_ok(self):
+        init_product_data()
+
+        response = self.client.get('/product/items/',
+                                   headers={'Accept': 'application/x-ndjson'})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        lines = response.data.decode('utf-8').splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(json.loads(lines[0])['name'], "Test Product")
+
+    def test_create_product_ok(self):
         category, _, _ = init_product_data()
-        mock_auth.return_value = True
 
         payload = {
             "seller_id": str(uuid4()),
@@ -107,11 +295,11 @@ class ProductApiTestCase(BaseTestCase):
         }
 
         response = self.client.post(
-            '/api/v1/product/items',
+            '/product/items/',
             data=json.dumps(payload),
             headers={
                 'Content-Type': 'application/json',
-                'Authorization': f'Bearer test-token'  # noqa
+                'Authorization': 'Bearer {}'.format(self.token())
             }
         )
 
@@ -119,21 +307,68 @@ class ProductApiTestCase(BaseTestCase):
         data = json.loads(response.data)
         self.assertEqual(data['name'], "New Product")
 
-    @patch('marketplace.auth.utils.token_required')
-    def test_get_pricing_ok(self, mock_auth):
+    def test_bulk_create_products_ok(self):
+        category, _, _ = init_product_data()
+
+        row = {
+            "seller_id": str(uuid4()),
+            "category_id": str(category.id),
+            "name": "Bulk Product",
+            "price": 10.00,
+            "currency": "usd",
+            "sku": "BULK-SKU-001"
+        }
+        # Rows the database would refuse are reported one by one, the valid row is kept
+        invalid = [dict(row, sku="BULK-SKU-002", category_id=str(uuid4())),
+                   dict(row, sku="BULK-SKU-003", name=12345),
+                   dict(row, sku="BULK-SKU-004", images="abc"),
+                   dict(row, sku="BULK-SKU-005", tags=["ok", 1]),
+                   dict(row, sku="BULK-SKU-006", price=123456789.0),
+                   dict(row, sku="BULK-SKU-007", stock_quantity=2 ** 31),
+                   dict(row, sku="BULK-SKU-008", seller_id=42),
+                   dict(row, sku=["BULK-SKU-009"])]
+        payload = [row, dict(row, sku="TEST-SKU-001")] + invalid
+
+        response = self.client.post(
+            '/product/items/bulk',
+            data=json.dumps(payload),
+            headers={
+                'Content-Type': 'application/json',
+                'Authorization': 'Bearer {}'.format(self.token())
+            }
+        )
+
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertEqual(data['created'], 1)
+        self.assertEqual([r['status'] for r in data['results']],
+                         ['created'] + ['error'] * (len(payload) - 1))
+        self.assertEqual(ProductItem.query.filter_by(sku='BULK-SKU-001').one().currency, 'USD')
+
+    def test_get_pricing_ok(self):
         _, _, pricing = init_product_data()
 
-        response = self.client.get('/api/v1/product/pricing')
+        response = self.client.get('/product/pricing/')
+
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertTrue(isinstance(data['items'], list))
+        self.assertEqual(float(data['items'][0]['base_price']), 100.00)
+
+    def test_get_effective_pricing_ok(self):
+        _, product, _ = init_product_data()
+        missing = uuid4()
+
+        response = self.client.get('/product/pricing/effective?product_id={},{}'.format(
+            product.id, missing))
 
         self.assertEqual(response.status_code, 200)
         data = json.loads(response.data)
-        self.assertTrue(isinstance(data, list))
-        self.assertEqual(float(data[0]['base_price']), 100.00)
+        self.assertEqual(float(data[str(product.id)]['effective_price']), 100.00)
+        self.assertIsNone(data[str(missing)])
 
-    @patch('marketplace.auth.utils.token_required')
-    def test_create_pricing_ok(self, mock_auth):
+    def test_create_pricing_ok(self):
         _, product, _ = init_product_data()
-        mock_auth.return_value = True
 
         payload = {
             "product_id": str(product.id),
@@ -143,14 +378,38 @@ class ProductApiTestCase(BaseTestCase):
         }
 
         response = self.client.post(
-            '/api/v1/product/pricing',
+            '/product/pricing/',
             data=json.dumps(payload),
             headers={
                 'Content-Type': 'application/json',
-                'Authorization': f'Bearer test-token'  # noqa
+                'Authorization': 'Bearer {}'.format(self.token())
             }
         )
 
         self.assertEqual(response.status_code, 201)
         data = json.loads(response.data)
         self.assertEqual(float(data['base_price']), 150.00)
+
+    def test_reserve_stock_ok(self):
+        _, product, _ = init_product_data()
+        headers = {'Authorization': 'Bearer {}'.format(self.token())}
+
+        response = self.client.post('/product/reservations/',
+                                    json={'items': [{'sku': 'TEST-SKU-001', 'quantity': 8}]},
+                                    headers=headers)
+        self.assertEqual(response.status_code, 201)
+        reservation = json.loads(response.data)
+        self.assertEqual(reservation['status'], 'held')
+        self.assertEqual(ProductItem.query.get(product.id).stock_quantity, 2)
+
+        response = self.client.post('/product/reservations/',
+                                    json={'items': [{'sku': 'TEST-SKU-001', 'quantity': 3}]},
+                                    headers=headers)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(json.loads(response.data)['skus'], ['TEST-SKU-001'])
+
+        response = self.client.post(
+            '/product/reservations/{}/release'.format(reservation['id']),
+            headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(ProductItem.query.get(product.id).stock_quantity, 10)
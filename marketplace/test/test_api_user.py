@@ -1,8 +1,15 @@
 from unittest.mock import patch
 
+import bcrypt
 from flask import json
+from sqlalchemy import delete, update
 
-from marketplace.persistence.model import Merchant, User, UserSession
+from marketplace import db
+from marketplace.auth.hashing import password_hasher
+from marketplace.auth.principal_cache import principal_cache
+from marketplace.auth.utils import generate_token
+from marketplace.http.ratelimit import limiter
+from marketplace.persistence.model import Merchant, User
 from marketplace.test import BaseTestCase, Constants
 
 
@@ -17,21 +24,48 @@ def init_data():
     merchant.name = 'Merchant Test'
     merchant.description = 'Merchant Test Description'
     merchant.city = 'Jakarta'
+    merchant.owner_id = user.id
     merchant.save()
 
 
 class UserApiTestCase(BaseTestCase):
 
-    @patch('marketplace.v1.authorize_user_token')
-    def test_get_user_data_ok(self, mock_session):
-        pass
+    def test_get_user_data_ok(self):
+        init_data()
+        user = User.query.filter_by(username=Constants.USERNAME).first()
+
+        uri = '/user/users/{}'.format(Constants.USERNAME)
+
+        response = self.client.get(uri, headers={
+            'Authorization': 'Bearer {}'.format(generate_token(user.id))})
+
+        # Assert HTTP Response
+        self.assertEquals(response.status_code, 200)
+        json_result = json.loads(response.data)
+        self.assertEquals(json_result.get('username'), Constants.USERNAME)
+        self.assertNotIn('password_hash', json_result)
 
-    @patch('marketplace.v1.authorize_user_token')
-    def test_post_user_login_ok(self, mock_session):
+    def test_get_user_data_not_modified(self):
         init_data()
-        mock_session.return_value = UserSession()
+        user = User.query.filter_by(username=Constants.USERNAME).first()
+        uri = '/user/users/{}'.format(Constants.USERNAME)
+        auth = {'Authorization': 'Bearer {}'.format(generate_token(user.id))}
 
-        uri = '/api/v1/user/auth/login'
+        etag = self.client.get(uri, headers=auth).headers.get('ETag')
+        fields_etag = self.client.get(uri + '?fields=id,phone', headers=auth).headers.get('ETag')
+        self.assertNotEqual(fields_etag, etag)
+
+        response = self.client.get(uri, headers=dict(auth, **{'If-None-Match': fields_etag}))
+        self.assertEquals(response.status_code, 200)
+        self.assertIn('username', json.loads(response.data))
+        response = self.client.get(uri + '?fields=id,phone',
+                                   headers=dict(auth, **{'If-None-Match': fields_etag}))
+        self.assertEquals(response.status_code, 304)
+
+    def test_post_user_login_ok(self):
+        init_data()
+
+        uri = '/user/auth/login'
 
         post_data = {
             "username": Constants.USERNAME,
@@ -39,12 +73,129 @@ class UserApiTestCase(BaseTestCase):
         }
 
         response = self.client.post(uri, data=json.dumps(post_data),
-                                    headers={
-                                        'Content-Type': 'application/json',
-                                        'auth-token-key': '',
-                                        'username-key': '{}'.format(Constants.USERNAME)})
+                                    headers={'Content-Type': 'application/json'})
 
         # Assert HTTP Response
         self.assertEquals(response.status_code, 200)
         json_result = json.loads(response.data)
         self.assertEquals(json_result.get('username'), 'testuser')
+        self.assertTrue(json_result.get('token'))
+
+    def test_post_user_login_unknown_user_nok(self):
+        init_data()
+        post_data = {
+            "username": "nobody",
+            "password": Constants.PASSWORD
+        }
+
+        # An unknown user costs a bcrypt check like a wrong password does
+        with patch('marketplace.auth.hashing.bcrypt.checkpw', wraps=bcrypt.checkpw) as check:
+            response = self.client.post('/user/auth/login', data=json.dumps(post_data),
+                                        headers={'Content-Type': 'application/json'})
+        self.assertEquals(response.status_code, 401)
+        self.assertEquals(check.call_count, 1)
+
+    def test_token_principal_cache_ok(self):
+        init_data()
+        user = User.query.filter_by(username=Constants.USERNAME).first()
+        headers = {'Authorization': 'Bearer {}'.format(generate_token(user.id))}
+        uri = '/user/users/{}'.format(Constants.USERNAME)
+
+        self.client.get(uri, headers=headers)
+        hits = principal_cache.stats()['hits']
+        response = self.client.get(uri, headers=headers)
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(principal_cache.stats()['hits'], hits + 1)
+
+        # Flushed but rolled back writes leave it cached, only commits invalidate
+        user.fullname = 'Pending'
+        db.session.flush()
+        db.session.rollback()
+        self.assertEquals(principal_cache.stats()['size'], 1)
+
+        # Updating the user drops its cached principal
+        response = self.client.put(uri, data=json.dumps({'fullname': 'Renamed'}),
+                                   headers=dict(headers, **{'Content-Type': 'application/json'}))
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(principal_cache.stats()['size'], 0)
+
+    def test_token_principal_cache_privileges_ok(self):
+        init_data()
+        user = User(username='otheruser', phone=Constants.PHONE_NUMBER)
+        user.password = Constants.PASSWORD
+        user.save()
+        headers = {'Authorization': 'Bearer {}'.format(generate_token(user.id))}
+        uri = '/user/users/{}'.format(Constants.USERNAME)
+
+        response = self.client.get(uri, headers=headers)
+        self.assertEquals(response.status_code, 403)
+
+        # Granted by another worker: no local invalidation, is_admin is not cached though
+        db.session.execute(update(User).where(User.id == user.id).values(is_admin=True))
+        db.session.commit()
+        response = self.client.get(uri, headers=headers)
+        self.assertEquals(response.status_code, 200)
+
+        # Deleted by another worker: the cached principal is dropped
+        db.session.execute(delete(User).where(User.id == user.id))
+        db.session.commit()
+        response = self.client.get(uri, headers=headers)
+        self.assertEquals(response.status_code, 401)
+
+    def test_post_user_login_rehash_ok(self):
+        init_data()
+        self.app.config['BCRYPT_LOG_ROUNDS'] = 5
+        password_hasher.init_app(self.app)
+
+        post_data = {
+            "username": Constants.USERNAME,
+            "password": Constants.PASSWORD
+        }
+        response = self.client.post('/user/auth/login', data=json.dumps(post_data),
+                                    headers={'Content-Type': 'application/json'})
+
+        # Hash made with the test work factor is upgraded to the new one on login
+        self.assertEquals(response.status_code, 200)
+        user = User.query.filter_by(username=Constants.USERNAME).first()
+        self.assertTrue(user.password_hash.startswith('$2b$05$'))
+        self.assertFalse(user.password_needs_rehash)
+
+    def test_post_user_login_hasher_busy_nok(self):
+        init_data()
+        post_data = {
+            "username": Constants.USERNAME,
+            "password": Constants.PASSWORD
+        }
+        # Every bcrypt slot is taken for longer than a login may wait
+        with patch.object(password_hasher, 'timeout', 0.01):
+            for _ in range(password_hasher.concurrency):
+                password_hasher._slots.acquire()
+            try:
+                response = self.client.post('/user/auth/login', data=json.dumps(post_data),
+                                            headers={'Content-Type': 'application/json'})
+            finally:
+                for _ in range(password_hasher.concurrency):
+                    password_hasher._slots.release()
+
+        self.assertEquals(response.status_code, 503)
+        self.assertEquals(response.headers.get('Retry-After'), '1')
+
+    def test_post_user_login_rate_limited_nok(self):
+        init_data()
+        self.app.config.update(RATELIMIT_ENABLED=True, RATELIMIT_STORAGE_URL='memory://',
+                               RATELIMIT_LOGIN='2 per minute')
+        limiter.init_app(self.app)
+
+        post_data = {
+            "username": Constants.USERNAME,
+            "password": "wrong-password"
+        }
+        for _ in range(2):
+            response = self.client.post('/user/auth/login', data=json.dumps(post_data),
+                                        headers={'Content-Type': 'application/json'})
+            self.assertEquals(response.status_code, 401)
+
+        response = self.client.post('/user/auth/login', data=json.dumps(post_data),
+                                    headers={'Content-Type': 'application/json'})
+        self.assertEquals(response.status_code, 429)
+        self.assertEquals(response.headers['Retry-After'], '30')
@@ -0,0 +1,74 @@
+import unittest
+
+from sqlalchemy import text
+
+from marketplace import db
+from marketplace.persistence.routing import (READ_BIND, STICKY_COOKIE, WRITE_BIND, replica_health,
+                                             use_master)
+from marketplace.test import BaseTestCase, Constants
+
+
+class RoutingTestCase(BaseTestCase):
+    def tearDown(self):
+        replica_health.reset()
+        super().tearDown()
+
+    def bind(self, method='GET', **kwargs):
+        with self.app.test_request_context('/product/items/', method=method, **kwargs):
+            return db.session.get_bind()
+
+    def test_binds_follow_database_url(self):
+        # Without READ_DATABASE_URL both binds point at DATABASE_URL, like create_all does
+        self.assertEqual(db.engines[WRITE_BIND].url, db.engines[None].url)
+        self.assertEqual(db.engines[READ_BIND].url, db.engines[None].url)
+
+    def test_safe_request_reads_from_replica(self):
+        self.assertIs(self.bind('GET'), db.engines[READ_BIND])
+        self.assertIs(self.bind('HEAD'), db.engines[READ_BIND])
+
+    def test_write_request_uses_master(self):
+        self.assertIs(self.bind('POST'), db.engines[WRITE_BIND])
+        self.assertIs(self.bind('DELETE'), db.engines[WRITE_BIND])
+
+    def test_sticky_client_reads_from_master(self):
+        self.assertIs(self.bind('GET', headers={'Cookie': STICKY_COOKIE + '=1'}),
+                      db.engines[WRITE_BIND])
+
+    def test_write_sets_sticky_cookie(self):
+        response = self.client.post('/user/auth/login', json={
+            'username': Constants.USERNAME, 'password': Constants.PASSWORD})
+        self.assertEqual(response.status_code, 401)
+        self.assertNotIn(STICKY_COOKIE, response.headers.get('Set-Cookie', ''))
+
+        response = self.client.post('/user/users/', json={
+            'username': Constants.USERNAME, 'password': Constants.PASSWORD,
+            'fullname': 'Test User', 'phone': Constants.PHONE_NUMBER})
+        self.assertEqual(response.status_code, 201)
+        self.assertIn(STICKY_COOKIE + '=1', response.headers.get('Set-Cookie', ''))
+
+    def test_use_master_pins_request(self):
+        with self.app.test_request_context('/product/items/'):
+            use_master()
+            self.assertIs(db.session.get_bind(), db.engines[WRITE_BIND])
+
+    def test_failover_to_master_when_replica_down(self):
+        replica_health.mark_down('test')
+        self.assertIs(self.bind('GET'), db.engines[WRITE_BIND])
+
+        replica_health.reset()
+        self.assertIs(self.bind('GET'), db.engines[READ_BIND])
+
+    def test_read_retried_on_master_when_replica_drops(self):
+        with self.app.test_request_context('/product/items/'):
+            pid = db.session.scalar(text('SELECT pg_backend_pid()'))
+            self.assertIs(db.session.get_bind(), db.engines[READ_BIND])
+            # The replica connection of this request dies under it
+            with db.engines[WRITE_BIND].connect() as connection:
+                connection.execute(text('SELECT pg_terminate_backend(:pid)'), {'pid': pid})
+
+            self.assertEqual(db.session.execute(text('SELECT 1')).scalar(), 1)
+            self.assertIs(db.session.get_bind(), db.engines[WRITE_BIND])
+
+
+if __name__ == '__main__':
+    unittest.main()
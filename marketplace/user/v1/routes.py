@@ -3,10 +3,19 @@ import logging
 from flask import request
 from flask_restx import Resource, Api, Namespace, fields
 
+from marketplace import db
+from marketplace.auth.hashing import password_hasher
 from marketplace.auth.utils import token_required, admin_required, generate_token
+from marketplace.http.cache import response_cache
+from marketplace.http.conditional import Validators, is_conditional
+from marketplace.http.idempotency import idempotency
+from marketplace.http.pagination import page_validators, paginate, pagination_parser
+from marketplace.http.ratelimit import limiter
+from marketplace.http.serializer import page_response
+from marketplace.http.streaming import stream_ndjson, stream_parser, wants_ndjson
 from marketplace.persistence.model import User
 from marketplace.user.v1 import user_bp
-from marketplace.user.v1.serializers import user_schema, users_schema
+from marketplace.user.v1.serializers import user_fields, user_schema
 
 # Create API namespace
 api = Api(user_bp,
@@ -54,6 +63,11 @@ user_response = users_ns.model('User', {
     'updated_at': fields.DateTime(description='Last Update Date')
 })
 
+user_page_response = users_ns.model('UserPage', {
+    'items': fields.List(fields.Nested(user_response)),
+    'next_cursor': fields.String(description='Cursor of the next page, null on the last page')
+})
+
 login_response = auth_ns.model('LoginResponse', {
     'token': fields.String(description='JWT token'),
     'username': fields.String(description='Username')
@@ -67,6 +81,8 @@ class UserLogin(Resource):
     @auth_ns.expect(login_model)
     @auth_ns.response(200, 'Success', login_response)
     @auth_ns.response(401, 'Invalid credentials')
+    @auth_ns.response(429, 'Too many login attempts')
+    @limiter.limit('RATELIMIT_LOGIN')
     def post(self):
         """User login endpoint"""
         data = request.get_json()
@@ -76,7 +92,16 @@ class UserLogin(Resource):
         log.info("Login request received for user: %s", username)
 
         user = User.query.filter_by(username=username).first()
-        if user and user.verify_password(password):
+        # Unknown usernames are checked against a dummy hash, so they take as long as a
+        # wrong password and the timing does not reveal which accounts exist
+        verified = password_hasher.verify(password, user.password_hash if user else None)
+        if user and verified:
+            if user.password_needs_rehash:
+                # Work factor changed since this hash was made, upgrade it while we
+                # still have the plain password
+                user.password = password
+                user.save()
+
             token = generate_token(user.id)
             return {
                 'token': token,
@@ -92,18 +117,35 @@ class UserLogin(Resource):
 @users_ns.route('/')
 class UserList(Resource):
     @users_ns.doc('list_users')
-    @users_ns.response(200, 'Success', [user_response])
+    @users_ns.response(200, 'Success', user_page_response)
+    @users_ns.expect(pagination_parser, stream_parser, user_fields.parser)
     @users_ns.doc(security='apikey')
     @admin_required
     def get(self, current_user):
-        """List all users (Admin only)"""
-        users = User.query.all()
-        return users_schema.dump(users)
+        """List users, one keyset page at a time (Admin only)"""
+        keys = (User.created_at, User.id)
+        query = User.query
+        fields = user_fields.requested()
+        selected = user_fields.restrict(query, fields, User.updated_at, *keys)
+        schema = user_fields.schema(fields)
+        if wants_ndjson():
+            return stream_ndjson(selected.order_by(*keys), schema)
+
+        args = pagination_parser.parse_args()
+        if is_conditional():
+            validators = page_validators(query, keys, User.updated_at, fields, **args)
+            if validators.matches():
+                return validators.not_modified()
+
+        page = paginate(selected, keys, updated_at=User.updated_at, fields=fields, **args)
+        return page_response(schema, page)
 
     @users_ns.doc('create_user')
     @users_ns.expect(user_create_model)
     @users_ns.response(201, 'User created', user_response)
     @users_ns.response(400, 'Validation error')
+    @users_ns.param('Idempotency-Key', 'Replays the first response to retries', _in='header')
+    @idempotency.idempotent
     def post(self):
         """Create a new user (Public endpoint for registration)"""
         data = request.get_json()
@@ -130,6 +172,7 @@ class UserResource(Resource):
     @users_ns.doc('get_user')
     @users_ns.response(200, 'Success', user_response)
     @users_ns.response(404, 'User not found')
+    @users_ns.expect(user_fields.parser)
     @users_ns.doc(security='apikey')
     @token_required
     def get(self, current_user, username):
@@ -138,10 +181,23 @@ class UserResource(Resource):
         if not current_user.is_admin and current_user.username != username:
             return {'message': 'Access denied'}, 403
 
-        user = User.query.filter_by(username=username).first()
+        fields = user_fields.requested()
+        if is_conditional():
+            # Revalidate against updated_at alone, the row is only loaded when it changed
+            updated = db.session.query(User.id, User.updated_at).filter(
+                User.username == username).first()
+            if updated is not None:
+                validators = Validators.build(updated.updated_at, 'user', updated.id,
+                                              ','.join(fields or ()))
+                if validators.matches():
+                    return validators.not_modified()
+
+        query = user_fields.restrict(User.query, fields, User.updated_at)
+        user = query.filter_by(username=username).first()
         if not user:
             return {'message': 'User not found'}, 404
-        return user_schema.dump(user)
+        validators = Validators.build(user.updated_at, 'user', user.id, ','.join(fields or ()))
+        return user_fields.schema(fields).dump(user), 200, validators.headers()
 
     @users_ns.doc('update_user')
     @users_ns.expect(user_update_model)
@@ -168,6 +224,7 @@ class UserResource(Resource):
 
         try:
             user.save()
+            response_cache.invalidate('users')
             return user_schema.dump(user)
         except Exception as e:
             return {'message': str(e)}, 400
@@ -184,7 +241,9 @@ class UserResource(Resource):
             return {'message': 'User not found'}, 404
 
         try:
-            User.query.delete(user)
+            db.session.delete(user)
+            db.session.commit()
+            response_cache.invalidate('users')
             return '', 204
         except Exception as e:
             return {'message': str(e)}, 400
@@ -1,4 +1,5 @@
 from marketplace import ma
+from marketplace.http.sparse import Fieldset
 from marketplace.persistence.model import User
 
 
@@ -10,3 +11,15 @@ class UserSchema(ma.Schema):
 
 user_schema = UserSchema()
 users_schema = UserSchema(many=True)
+user_fields = Fieldset(user_schema)
+
+
+# What anyone may see of a user embedded in a public resource (e.g. a merchant's owner),
+# contact details stay behind the owner-or-admin check of the users endpoints
+class PublicUserSchema(ma.Schema):
+    class Meta:
+        model = User
+        fields = ('id', 'username')
+
+
+public_user_schema = PublicUserSchema()
@@ -1,7 +1,6 @@
 import logging
-import time
 
-from flask import Blueprint, g, request, session
+from flask import Blueprint, g, request
 from flask_restplus import Api
 
 from common.authenticator.session_management import authorize_user_token
@@ -36,18 +35,6 @@ api.init_app(api_v1_blueprint)
 NO_AUTH_ENDPOINTS = ['api.v1.doc', 'api.v1.specs', 'api.v1.user_user_auth_login_api']
 
 
-def statsd_put_start_endpoint(request):
-    endpoint = request.endpoint
-    session['endpoint'] = endpoint
-    session['start'] = time.time()
-
-
-def statsd_put_end_endpoint():
-    endpoint = session['endpoint']
-    start = session['start']
-    return endpoint, start
-
-
 @api_v1_blueprint.before_request
 def before_api_request():
     """
@@ -56,9 +43,6 @@ def before_api_request():
 
     :return: None
     """
-    # Start Point of a request, will count how long (miliseconds) for a request to be processed
-    statsd_put_start_endpoint(request)
-
     # By-Pass Swagger Endpoints and Login
     if request.endpoint in NO_AUTH_ENDPOINTS:
         return
@@ -94,7 +78,5 @@ def after_api_request(response):
 
     :return: None
     """
-    # Calculate total time after processing a request
-    endpoint, start = statsd_put_end_endpoint()
-    log.info("[Complete Request {} Time {}s]".format(endpoint, int(time.time() - start)))
+    # Request latency is recorded app-wide, see marketplace.http.metrics
     return response
@@ -0,0 +1,11 @@
+#!/usr/bin/env python
+"""
+WSGI entry point for production servers (`gunicorn wsgi:app`).
+
+Unlike `manage.py` it carries no CLI commands, test runner or coverage, only the app.
+"""
+import os
+
+from marketplace import create_app
+
+app = create_app(os.getenv('FLASK_CONFIG') or 'production')